@@ -1,15 +1,23 @@
+# The conversion machinery pulls in libdjvu, Pillow, fpdf, pdfrw, Rich and multiprocessing, which take a noticeable
+# amount of time to import. We only import it once the arguments have been validated, so that e.g. --help,
+# --version and invalid invocations respond immediately.
+
+# ruff: noqa: PLC0415
+
+import contextlib
 import functools
 import logging
 import operator
-from time import time
+import pathlib
+from collections.abc import Callable
+from typing import TYPE_CHECKING
 
 import click
-import djvu.decode
 
-from dpsprep.concurrency import concurrently_process_document
 from dpsprep.exceptions import DpsPrepConcurrencyError
-from dpsprep.logging import configure_logging, human_readable_size
+from dpsprep.logging import configure_logging
 from dpsprep.options import (
+    DEFAULT_MAX_PAGE_MEMORY,
     DpiOverridesClickType,
     DpsPrepOptions,
     ImageMode,
@@ -18,15 +26,14 @@ from dpsprep.options import (
     OcrOptionClickType,
     QualityOverridesClickType,
     SocrOptionClickType,
-    get_default_pool_size,
 )
 from dpsprep.range import RangeOptionGroup
-from dpsprep.workflow import (
-    attempt_to_optimize_result,
-    combine_document,
-    destroy_workdir,
-    initialize_workdir,
-)
+from dpsprep.resources import get_default_max_memory, get_default_pool_size
+from dpsprep.workdir import WorkingDirectory
+
+
+if TYPE_CHECKING:
+    from dpsprep.concurrency import SubprocessDocumentProcessor
 
 
 logger = logging.getLogger(__name__)
@@ -37,43 +44,63 @@ logger = logging.getLogger(__name__)
 @click.option('--ocr', 'ocr_options', type=OcrOptionClickType(), default=None, help='Perform OCR via OCRmyPDF rather than trying to convert the text layer. If this parameter has a value, it should be a JSON dictionary of options to be passed to OCRmyPDF.')
 # Other options
 @click.option('--tmp', 'tmp_root', type=click.Path(exists=True, file_okay=False, writable=True, resolve_path=True), help="Override the default temporary directory (Python's tempfile.gettempdir() with a preference for /var/tmp on Unix-like systems).")
-@click.option('-p', '--pool-size', type=click.IntRange(min=1), default=None, help='Size of the MultiProcessing pool that handles page-by-page operations. Defaults to os.process_cpu_count() with a fallback to 2 * os.cpu_count()')
+@click.option('--max-page-memory', type=click.IntRange(min=1), default=DEFAULT_MAX_PAGE_MEMORY, help=f'The amount of memory in MiB that a worker may use for rendering a page. Larger pages are rendered and compressed in horizontal strips, each of which becomes a separate image in the PDF. Defaults to {DEFAULT_MAX_PAGE_MEMORY}.')
+@click.option('--max-memory', type=click.IntRange(min=1), default=None, help='The amount of memory in MiB that the pages processed at the same time may use, based on their dimensions. Pages wait for running ones to finish if they do not fit. Defaults to the cgroup memory limit (e.g. of a container) without the memory needed by the processes themselves, and to no limit outside of cgroups.')
+@click.option('-p', '--pool-size', type=click.IntRange(min=1), default=None, help='Size of the MultiProcessing pool that handles page-by-page operations. Defaults to os.process_cpu_count() with a fallback to 2 * os.cpu_count(), limited by the cgroup CPU quota and memory limit (e.g. of a container).')
 @click.option('-O3', 'optlevel', flag_value=3, help='Use the aggressive lossy PDF image optimization from OCRmyPDF.')
 @click.option('-O2', 'optlevel', flag_value=2, help='Use the PDF image optimization from OCRmyPDF.')
 @click.option('-O1', 'optlevel', flag_value=1, help='Use the lossless PDF image optimization from OCRmyPDF (without performing OCR).')
+@click.option('--jbig2', is_flag=True, help='Compress bitonal images using JBIG2 via a locally installed jbig2enc rather than group4. Every 16 consecutive bitonal pages share a symbol dictionary. Note that symbol matching is lossy and may substitute similar-looking glyphs.')
+@click.option('--in-memory', is_flag=True, help='Pass the processed pages from the workers to the main process via shared memory rather than the working directory. The output file is written directly unless OCR or optimization is requested. Interrupted conversions cannot be resumed in this mode.')
+@click.option('--page-cache-size', type=click.IntRange(min=1), default=None, help='Reuse the encoded pages of previous conversions and store the new ones in a cache in the temporary directory, which is limited to the given number of MiB by removing the least recently used pages after every conversion. Pages are cached based on their DjVu data and on the options that affect them, so identical pages are reused even across documents. The cache is not used with --in-memory. Disabled by default.')
+@click.option('--metrics-json', 'metrics_path', type=click.Path(dir_okay=False, writable=True, resolve_path=True, path_type=pathlib.Path), default=None, help='Write timings, output sizes and peak memory usage for every page and every stage of the conversion to the given file as JSON. In batch mode, every document is written on a separate line.')
+@click.option('--profile', 'profile_dir', type=click.Path(file_okay=False, writable=True, resolve_path=True, path_type=pathlib.Path), default=None, help='Profile the workers and the combination and optimization steps via cProfile. Every process writes its own file to the given directory, and the files are merged into merged.prof at the end. Existing .prof files in the directory are removed.')
 @click.option('-t', '--no-text', is_flag=True, help='Disable the generation of text layers. Implied by --ocr.')
 @click.option('-v', '--verbose', is_flag=True, help='Display debug messages.')
 @click.option('-o', 'deprecated_overwrite', is_flag=True, help='Deprecated flag for overwriting destination file. The short variant of --overwrite has been renamed to -f.')
 @click.option('-f', '--overwrite', is_flag=True, help='Overwrite destination file.')
 @click.option('-w', '--preserve-working', is_flag=True, help='Preserve the working directory after script termination.')
 @click.option('-d', '--delete-working', is_flag=True, help='Delete any existing files in the working directory prior to writing to it.')
+@click.option('--fast-fingerprint', is_flag=True, help='Identify the working directory of a source file that has already been hashed by its device, inode, size and modification time rather than by hashing its contents again.')
+@click.option('-b', '--batch', is_flag=True, help='Convert many documents using a shared worker pool. SRC must be either a directory, which is searched recursively for DjVu files, or a text file listing one DjVu file per line. DEST, if given, is the output directory. Documents whose destination is newer than the source are skipped unless --overwrite is given.')
 # Range options
 @click.option('-q', '--quality', 'quality_overrides', type=QualityOverridesClickType(), multiple=True, default=[], help="Determine the quality of images in output. Valid values range between 1 and 100. Used only for JPEG compression, i.e. RGB and Grayscale images. Passed directly to Pillow and to OCRmyPDF's optimizer.")
+@click.option('--target-dpi', 'target_dpi_overrides', type=DpiOverridesClickType(), multiple=True, default=[], help='Render pages whose DPI exceeds the given value at that DPI. Unlike --dpi, this reduces the number of pixels, and thus the processing time and the output size, without changing the page size. Pages are never scaled up.')
 @click.option('--dpi', 'dpi_overrides', type=DpiOverridesClickType(), multiple=True, default=[], help='Override the DPI values encoded in the DjVu file for individual pages.')
-@click.option('-m', '--mode', 'mode_overrides', type=ImageModeOverridesClickType(), multiple=True, default=['infer'], help='Override the image modes encoded in the DjVu file for individual pages. Valid values are "infer" (default), "bitonal", "grayscale" and "rgb". It sometimes makes sense to force bitonal images since they compress well.')
+@click.option('-m', '--mode', 'mode_overrides', type=ImageModeOverridesClickType(), multiple=True, default=['infer'], help='Override the image modes encoded in the DjVu file for individual pages. Valid values are "infer" (default), "auto", "bitonal", "grayscale", "rgb" and "layered". It sometimes makes sense to force bitonal images since they compress well. The "auto" mode chooses between "bitonal", "grayscale" and "rgb" based on the colors that actually appear on the page. The "layered" mode splits compound pages into a subsampled background, a full-resolution mask and subsampled foreground colors, like DjVu itself does.')
 @click.version_option()
-@click.argument('dest', type=click.Path(exists=False, dir_okay=False, resolve_path=True), required=False)
-@click.argument('src', type=click.Path(exists=True, dir_okay=False, resolve_path=True), required=True)
+@click.argument('dest', type=click.Path(exists=False, resolve_path=True), required=False)
+@click.argument('src', type=click.Path(exists=True, resolve_path=True, path_type=pathlib.Path), required=True)
 @click.command(epilog='See dpsprep(1) for more details.')
 @click.pass_context
 def dpsprep(
     ctx: click.Context,
     # Positional arguments
-    src: str,
+    src: pathlib.Path,
     dest: str | None,
     # Range options
     mode_overrides: tuple[RangeOptionGroup[ImageMode], ...],
     dpi_overrides: tuple[RangeOptionGroup[int], ...],
+    target_dpi_overrides: tuple[RangeOptionGroup[int], ...],
     quality_overrides: tuple[RangeOptionGroup[int], ...],
     # Other options
+    batch: bool,
+    fast_fingerprint: bool,
     delete_working: bool,
     preserve_working: bool,
     overwrite: bool,
     deprecated_overwrite: bool,
     verbose: bool,
     no_text: bool,
+    page_cache_size: int | None,
+    in_memory: bool,
+    jbig2: bool,
     optlevel: int | None,
     pool_size: int | None,
+    max_memory: int | None,
+    max_page_memory: int,
+    metrics_path: pathlib.Path | None,
+    profile_dir: pathlib.Path | None,
     tmp_root: str | None,
     # OCR options
     ocr_options: JsonObject | None,
@@ -90,7 +117,9 @@ def dpsprep(
 
     Furthermore, --mode can be passed multiple times with the same effect as placing commas.
     """
-    configure_logging(verbose=verbose)
+    # The daemon configures logging once for all jobs and passes its worker pool as the context object
+    if ctx.obj is None:
+        configure_logging(verbose=verbose)
 
     if deprecated_overwrite:
         click.echo(
@@ -106,45 +135,139 @@ def dpsprep(
     if ocr_options and socr_options:
         raise click.ClickException('Cannot specify both --ocr and -socr simultaneously.')
 
-    workdir = initialize_workdir(src, dest, tmp_root, delete_working)
-
-    if not overwrite and workdir.dest.exists():
-        raise click.ClickException(f'File {workdir.dest} already exists.')
-
-    options = DpsPrepOptions(
-        workdir=workdir,
+    pool_size = pool_size or get_default_pool_size()
+    max_memory = get_default_max_memory(pool_size) if max_memory is None else max_memory * 1024 * 1024
+    make_options = functools.partial(
+        DpsPrepOptions,
         mode_overrides=functools.reduce(operator.or_, mode_overrides),
         dpi_overrides=functools.reduce(operator.or_, dpi_overrides, RangeOptionGroup([])),
+        target_dpi_overrides=functools.reduce(operator.or_, target_dpi_overrides, RangeOptionGroup([])),
         quality_overrides=functools.reduce(operator.or_, quality_overrides, RangeOptionGroup([])),
         no_text=no_text or bool(ocr_options or socr_options),
+        page_cache_size=None if page_cache_size is None else page_cache_size * 1024 * 1024,
+        in_memory=in_memory,
+        jbig2=jbig2 and is_jbig2enc_available(),
         ocr_options=ocr_options or socr_options,
         optlevel=optlevel,
-        pool_size=pool_size or get_default_pool_size(),
+        max_page_memory=max_page_memory * 1024 * 1024,
+        pool_size=pool_size,
         verbose=verbose,
+        metrics_path=metrics_path,
+        profile_dir=profile_dir,
     )
 
-    start_time = time()
-    document = djvu.decode.Context().new_document(
-        djvu.decode.FileURI(workdir.src),
-    )
-    document.decoding_job.wait()
-    djvu_size = workdir.src.stat().st_size
+    if metrics_path is not None:
+        # The reports of individual documents are appended to the file
+        metrics_path.write_text('', encoding='utf-8')
+
+    if profile_dir is not None:
+        # The workers of the daemon outlive the job, so their profiles would accumulate across jobs
+        if ctx.obj is not None:
+            raise click.ClickException('The --profile option is not supported by the daemon.')
+
+        from dpsprep.profiling import open_profiling_session
+
+        # The profiles are merged when the context is closed, i.e. also after a failed conversion
+        ctx.with_resource(open_profiling_session(profile_dir))
+
+    if batch:
+        run_batch(
+            ctx,
+            make_options,
+            src,
+            dest,
+            tmp_root,
+            pool_size=pool_size,
+            max_memory=max_memory,
+            verbose=verbose,
+            delete_working=delete_working,
+            preserve_working=preserve_working,
+            overwrite=overwrite,
+            fast_fingerprint=fast_fingerprint,
+        )
+        return
+
+    if src.is_dir():
+        raise click.ClickException(f'{src} is a directory. Use --batch to convert all documents in it.')
+
+    if dest is not None and pathlib.Path(dest).is_dir():
+        raise click.ClickException(f'{dest} is a directory.')
+
+    from dpsprep.conversion import finish_conversion, start_conversion
+    from dpsprep.workflow import initialize_workdir
+
+    workdir = initialize_workdir(src, dest, tmp_root, delete_working, fast_fingerprint=fast_fingerprint)
+
+    if not overwrite and workdir.dest.exists():
+        raise click.ClickException(f'File {workdir.dest} already exists.')
 
-    try:
-        concurrently_process_document(options, document)
-    except DpsPrepConcurrencyError:
-        # We assume that the actual error has been logged, so we ignore its message.
-        ctx.abort()
+    options = make_options(workdir=workdir)
 
-    combine_document(options, document)
+    with open_processor(ctx, pool_size, max_memory, verbose) as processor:
+        conversion = start_conversion(processor, options)
 
-    combined_size = workdir.combined_pdf_path.stat().st_size
-    logger.info(f'Produced a combined output file with size {human_readable_size(combined_size)} in {time() - start_time:.2f}s. This is {round(100 * combined_size / djvu_size, 2)}% of the DjVu source file.')
+        try:
+            finish_conversion(processor, conversion, preserve_working)
+        except DpsPrepConcurrencyError:
+            # We assume that the actual error has been logged, so we ignore its message.
+            ctx.abort()
 
-    attempt_to_optimize_result(options, djvu_size, combined_size)
 
-    if preserve_working:
-        logger.info(f'Working directory {workdir.working} will be preserved.')
-    else:
-        logger.info(f'Deleting the working directory {workdir.working}.')
-        destroy_workdir(workdir)
+def open_processor(ctx: click.Context, pool_size: int, max_memory: int | None, verbose: bool) -> contextlib.AbstractContextManager['SubprocessDocumentProcessor']:
+    """Create a worker pool unless the command is invoked by the daemon, which passes its own warm pool as the context object."""
+    from dpsprep.concurrency import SubprocessDocumentProcessor
+
+    if isinstance(ctx.obj, SubprocessDocumentProcessor):
+        return contextlib.nullcontext(ctx.obj)
+
+    return SubprocessDocumentProcessor(pool_size, verbose, max_memory)
+
+
+def is_jbig2enc_available() -> bool:
+    from dpsprep.jbig2 import find_jbig2enc
+
+    if find_jbig2enc() is None:
+        logger.error('Cannot detect jbig2enc. Bitonal images will be compressed using group4.')
+        return False
+
+    return True
+
+
+def run_batch(
+    ctx: click.Context,
+    make_options: Callable[[WorkingDirectory], DpsPrepOptions],
+    src: pathlib.Path,
+    dest: str | None,
+    tmp_root: str | None,
+    *,
+    pool_size: int,
+    max_memory: int | None,
+    verbose: bool,
+    delete_working: bool,
+    preserve_working: bool,
+    overwrite: bool,
+    fast_fingerprint: bool,
+) -> None:
+    dest_dir = None if dest is None else pathlib.Path(dest)
+
+    if dest_dir is not None and dest_dir.exists() and not dest_dir.is_dir():
+        raise click.ClickException(f'The batch destination {dest_dir} must be a directory.')
+
+    from dpsprep.conversion import convert_batch
+
+    with open_processor(ctx, pool_size, max_memory, verbose) as processor:
+        failures = convert_batch(
+            processor,
+            make_options,
+            src,
+            dest_dir,
+            tmp_root,
+            delete_working=delete_working,
+            preserve_working=preserve_working,
+            overwrite=overwrite,
+            fast_fingerprint=fast_fingerprint,
+        )
+
+    if failures > 0:
+        logger.error(f'Failed to convert {failures} document(s).')
+        ctx.exit(1)
@@ -1 +1,2 @@
-from .api import concurrently_process_document
+from .api import finish_processing_document, start_processing_document
+from .processor import SubprocessDocumentProcessor
@@ -3,9 +3,14 @@ import logging
 import djvu.decode
 
 from dpsprep.logging import human_readable_size
+from dpsprep.manifest import WorkdirManifest, get_page_bg_fingerprint, get_text_layer_fingerprint
+from dpsprep.metrics import ConversionMetrics
 from dpsprep.options import DpsPrepOptions
+from dpsprep.page_plan import PagePlan
+from dpsprep.workdir import get_text_layer_chunks
 
-from .processor import SubprocessDocumentProcessor
+from .processor import PayloadHandler, SubprocessDocumentProcessor
+from .scheduling import estimate_page_memory, get_page_processing_order
 
 
 logger = logging.getLogger(__name__)
@@ -13,11 +18,43 @@ logger = logging.getLogger(__name__)
 
 # Due to some compatibility issues, we only support multiprocessing-based concurrency with explicit message passing.
 # This is discussed in the concurrency notes in the project's wiki.
-def concurrently_process_document(options: DpsPrepOptions, document: djvu.decode.Document) -> None:
+def start_processing_document(processor: SubprocessDocumentProcessor, options: DpsPrepOptions, document: djvu.decode.Document, on_payload: PayloadHandler | None = None, metrics: ConversionMetrics | None = None) -> int:
     djvu_size = options.workdir.src.stat().st_size
-    logger.info(f'Processing {options.workdir.src} with {len(document.pages)} pages and size {human_readable_size(djvu_size)} using {options.pool_size} workers.')
+    logger.info(f'Processing {options.workdir.src} with {len(document.pages)} pages and size {human_readable_size(djvu_size)} using {processor.pool_size} workers.')
 
-    proc = SubprocessDocumentProcessor(options, document)
-    proc.process()
+    plan = PagePlan.compile(options, range(len(document.pages)))
 
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Page settings: {plan.describe()}.')
+
+    page_order = get_page_processing_order(options, document)
+    text_chunks = [] if options.no_text else get_text_layer_chunks(len(document.pages))
+
+    def estimate_memory(i: int) -> int:
+        return estimate_page_memory(options, plan[i], document.pages[i], i)
+
+    if options.in_memory:
+        return processor.submit(options, plan, page_order, estimate_memory, text_chunks, on_payload, metrics=metrics)
+
+    # The files in the working directory are written atomically and recorded in the manifest once they are done,
+    # so we can resume without reading them again
+    manifest = WorkdirManifest.load(options.workdir.manifest_path)
+    remaining_pages = [
+        i for i in page_order
+        if not manifest.is_complete(options.workdir.get_page_image_path(i), get_page_bg_fingerprint(options, plan[i]))
+    ]
+    remaining_chunks = [
+        chunk for chunk in text_chunks
+        if not manifest.is_complete(options.workdir.get_text_layer_pdf_path(chunk), get_text_layer_fingerprint(plan, chunk))
+    ]
+    done_count = len(page_order) + len(text_chunks) - len(remaining_pages) - len(remaining_chunks)
+
+    if done_count > 0:
+        logger.info(f'Reusing {done_count} already processed items from the working directory.')
+
+    return processor.submit(options, plan, remaining_pages, estimate_memory, remaining_chunks, on_payload, manifest, metrics)
+
+
+def finish_processing_document(processor: SubprocessDocumentProcessor, job_id: int) -> None:
+    processor.wait(job_id)
     logger.info('Processed all pages.')
@@ -1,20 +1,89 @@
 import logging
+import os
 from dataclasses import dataclass
+from typing import NamedTuple
+
+from dpsprep.manifest import ManifestEntry
+from dpsprep.metrics import TaskMetrics
+
+from .shared_memory import SharedMemoryPayload
 
 
 @dataclass(frozen=True)
 class ExceptionWorkerMessage:
+    job_id: int
     error: BaseException
+    page_index: int | None = None
 
 
-@dataclass(frozen=True)
-class LogRecordWorkerMessage:
-    record: logging.LogRecord
+class LogRecordWorkerMessage(NamedTuple):
+    """The parts of a log record that the parent process needs in order to handle it.
+
+    Pickling a full LogRecord is comparatively expensive because it carries the unformatted arguments,
+    the exception info and a dozen derived attributes.
+    """
+    name: str
+    levelno: int
+    pathname: str
+    lineno: int
+    func_name: str | None
+    message: str
+    exc_text: str | None
+    created: float
+    process: int | None
+
+    @classmethod
+    def from_record(cls, record: logging.LogRecord) -> 'LogRecordWorkerMessage':
+        exc_text = record.exc_text
+
+        if exc_text is None and record.exc_info:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+
+        return cls(
+            name=record.name,
+            levelno=record.levelno,
+            pathname=record.pathname,
+            lineno=record.lineno,
+            func_name=record.funcName,
+            message=record.getMessage(),
+            exc_text=exc_text,
+            created=record.created,
+            process=record.process,
+        )
+
+    def to_record(self) -> logging.LogRecord:
+        filename = os.path.basename(self.pathname)
+
+        return logging.makeLogRecord({
+            'name': self.name,
+            'levelno': self.levelno,
+            'levelname': logging.getLevelName(self.levelno),
+            'pathname': self.pathname,
+            'filename': filename,
+            'module': os.path.splitext(filename)[0],
+            'lineno': self.lineno,
+            'funcName': self.func_name,
+            # The message is already formatted, so there are no arguments
+            'msg': self.message,
+            'exc_text': self.exc_text,
+            'created': self.created,
+            'msecs': (self.created - int(self.created)) * 1000,
+            'process': self.process,
+        })
 
 
 @dataclass(frozen=True)
 class TaskDoneWorkerMessage:
-    pass
+    job_id: int
+    payload: SharedMemoryPayload | None = None
+    # Identifies the page whose reserved memory can be released by the parent process
+    page_index: int | None = None
+    # Files written to the working directory are recorded by the parent process
+    manifest_entry: ManifestEntry | None = None
+    # Only sent if requested via --metrics-json
+    metrics: TaskMetrics | None = None
 
 
 WorkerMessage = ExceptionWorkerMessage | LogRecordWorkerMessage | TaskDoneWorkerMessage
+# The workers send their messages in batches in order to reduce the number of system calls and wakeups of the parent
+WorkerMessageBatch = list[WorkerMessage]
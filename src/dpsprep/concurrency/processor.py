@@ -1,97 +1,328 @@
 # Due to some compatibility issues, we only support multiprocessing-based concurrency with explicit message passing.
 # This is discussed in the concurrency notes in the project's wiki.
 
+import contextlib
+import functools
 import logging
 import multiprocessing
+import threading
+from collections import deque
+from collections.abc import Callable, Iterator, Sequence
+from dataclasses import dataclass
+from multiprocessing.connection import wait
 from multiprocessing.pool import Pool
-from typing import TYPE_CHECKING
+from types import TracebackType
+from typing import TYPE_CHECKING, Any, cast
 
-import djvu.decode
 from rich.progress import Progress, TaskID
 
 from dpsprep.concurrency.message import ExceptionWorkerMessage, LogRecordWorkerMessage, TaskDoneWorkerMessage
 from dpsprep.exceptions import DpsPrepConcurrencyError
+from dpsprep.logging import human_readable_size
+from dpsprep.manifest import WorkdirManifest
+from dpsprep.metrics import ConversionMetrics
 from dpsprep.options import DpsPrepOptions
+from dpsprep.page_plan import PagePlan
 
-from .worker import SubprocessWorker
+from .shared_memory import SharedMemoryPayload, import_from_shared_memory
+from .worker import SubprocessWorker, initialize_worker_process
 
 
 if TYPE_CHECKING:
     from multiprocessing.connection import Connection
 
-    from .message import WorkerMessage
+    from .message import WorkerMessage, WorkerMessageBatch
 
 
 logger = logging.getLogger(__name__)
 
 
-class SubprocessDocumentProcessor:
+PayloadHandler = Callable[[SharedMemoryPayload, bytes], None]
+
+# How often the background message handler checks whether the parent needs the processor again
+BACKGROUND_POLL_INTERVAL = 0.1
+
+
+@dataclass
+class DocumentJob:
     options: DpsPrepOptions
-    document: djvu.decode.Document
+    rich_task: TaskID
+    remaining: int
+    on_payload: PayloadHandler | None = None
+    manifest: WorkdirManifest | None = None
+    metrics: ConversionMetrics | None = None
+    error: BaseException | None = None
+
+
+@dataclass(frozen=True)
+class QueuedTask:
+    job_id: int
+    function: Callable[..., None]
+    arguments: tuple[Any, ...]
+    # The estimated memory needed for rendering a page, which is reserved while the page is being processed
+    memory: int = 0
+    page_index: int | None = None
+
+
+class SubprocessDocumentProcessor:
+    """A worker pool that outlives individual documents.
+
+    Several documents can be submitted at once. Their tasks are queued in the same pool, so the pages
+    of the next document keep the workers busy while the parent process combines the previous one.
+
+    Every page is a separate task, so the workers pull pages from the pool's queue as soon as they become idle.
+
+    If max_memory is set, pages are only passed to the pool once their estimated memory fits into what
+    remains of it after subtracting the pages that are already being processed.
+    """
+    pool_size: int
+    verbose: bool
+    max_memory: int | None
 
-    parent_conn: 'Connection[WorkerMessage]'
-    child_conn: 'Connection[WorkerMessage]'
+    # One pipe per worker, and one through which the pool's result handler thread reports task failures
+    parent_conns: list['Connection[WorkerMessageBatch]']
+    child_conns: list['Connection[WorkerMessageBatch]']
+    error_parent_conn: 'Connection[WorkerMessageBatch]'
+    error_child_conn: 'Connection[WorkerMessageBatch]'
     pool: Pool
 
     rich_progress: Progress
-    rich_task: TaskID
+    jobs: dict[int, DocumentJob]
+    last_job_id: int
+
+    queued_tasks: deque[QueuedTask]
+    reserved_memory: dict[tuple[int, int], int]
+    total_reserved_memory: int
 
-    def __init__(self, options: DpsPrepOptions, document: djvu.decode.Document) -> None:
-        self.options = options
-        self.document = document
+    def __init__(self, pool_size: int, verbose: bool, max_memory: int | None = None) -> None:
+        self.pool_size = pool_size
+        self.verbose = verbose
+        self.max_memory = max_memory
 
-        self.parent_conn, self.child_conn = multiprocessing.Pipe()
-        self.pool = Pool(processes=self.options.pool_size)
+        if max_memory is not None:
+            logger.debug(f'Limiting the estimated memory of the pages processed at the same time to {human_readable_size(max_memory)}.')
+
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in range(self.pool_size)]
+        self.parent_conns = [parent_conn for parent_conn, _ in pipes]
+        self.child_conns = [child_conn for _, child_conn in pipes]
+        self.error_parent_conn, self.error_child_conn = multiprocessing.Pipe(duplex=False)
+        self.pool = Pool(
+            processes=self.pool_size,
+            initializer=initialize_worker_process,
+            initargs=(self.child_conns, [multiprocessing.Lock() for _ in pipes], multiprocessing.Value('i', 0), self.verbose),
+        )
 
         self.rich_progress = Progress()
-        self.rich_task = self.rich_progress.add_task('Processing', total=len(document.pages) + 1)
+        self.jobs = {}
+        self.last_job_id = 0
+
+        self.queued_tasks = deque()
+        self.reserved_memory = {}
+        self.total_reserved_memory = 0
+
+    def __enter__(self) -> 'SubprocessDocumentProcessor':
+        self.rich_progress.start()
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc_value: BaseException | None, traceback: TracebackType | None) -> None:
+        if exc_type is None:
+            self.pool.close()
+        else:
+            self.pool.terminate()
 
-        self.active_tasks = 0
+        self.pool.join()
+        self.queued_tasks.clear()
 
-    def on_child_error(self, err: BaseException | None) -> None:
+        # Tasks of failed jobs may have sent shared memory payloads that nobody has released yet
+        while self.handle_ready_messages(timeout=0):
+            pass
+
+        self.rich_progress.stop()
+
+    def on_child_error(self, job_id: int, page_index: int | None, err: BaseException | None) -> None:
         if err:
             logger.exception('Worker error.', exc_info=err)
-            self.child_conn.send(ExceptionWorkerMessage(err))
+            self.error_child_conn.send([ExceptionWorkerMessage(job_id, err, page_index)])
 
-    def process(self) -> None:
-        worker = SubprocessWorker(self.options, self.child_conn)
+    def submit(
+        self,
+        options: DpsPrepOptions,
+        plan: PagePlan,
+        page_order: Sequence[int],
+        estimate_page_memory: Callable[[int], int],
+        text_chunks: Sequence[range],
+        on_payload: PayloadHandler | None = None,
+        manifest: WorkdirManifest | None = None,
+        metrics: ConversionMetrics | None = None,
+    ) -> int:
+        """Queue the tasks for a document and return the job identifier.
 
-        with self.rich_progress:
-            if not self.options.no_text:
-                self.pool.apply_async(
-                    worker.process_text,
-                    error_callback=self.on_child_error,
-                )
+        In in-memory mode, on_payload is called in the parent process with the data produced by each task.
+        Otherwise, the files written by the tasks are recorded in the manifest as soon as they are done.
+        The metrics of the tasks, if requested, are added to metrics.
+        The estimated memory of page i is estimate_page_memory(i). Since estimating takes a while, every page is dispatched
+        before the next one is estimated, so the workers start right away. Without a memory limit, nothing is estimated.
+        """
+        self.last_job_id += 1
+        job_id = self.last_job_id
+        worker = SubprocessWorker(options, job_id)
+        total = len(page_order) + len(text_chunks)
 
-            for worker_id in range(self.options.pool_size):
-                self.pool.apply_async(
-                    worker.process_page_bg, [worker_id],
-                    error_callback=self.on_child_error,
-                )
+        self.jobs[job_id] = DocumentJob(
+            options=options,
+            rich_task=self.rich_progress.add_task(f'Processing {options.workdir.src.name}', total=total),
+            remaining=total,
+            on_payload=on_payload,
+            manifest=manifest,
+            metrics=metrics,
+        )
 
-            self.pool.close()
+        # The text layer chunks are cheap compared to the pages, so we queue them first
+        self.queued_tasks.extend(QueuedTask(job_id, worker.process_text, (chunk, plan.restrict(chunk))) for chunk in text_chunks)
+        self.dispatch_tasks()
+
+        for i in page_order:
+            memory = 0 if self.max_memory is None else estimate_page_memory(i)
+            self.queued_tasks.append(QueuedTask(job_id, worker.process_page_bg, (i, plan.restrict(range(i, i + 1))), memory, i))
+            self.dispatch_tasks()
+
+        return job_id
+
+    def dispatch_tasks(self) -> None:
+        """Pass the queued tasks to the pool as long as their estimated memory fits into the limit.
+
+        The tasks are dispatched in order, so a large page holds back the following ones rather than being overtaken
+        by them indefinitely. A page that exceeds the limit on its own is dispatched once no other page is running.
+        """
+        while len(self.queued_tasks) > 0:
+            task = self.queued_tasks[0]
+
+            if self.max_memory is not None and self.total_reserved_memory > 0 and self.total_reserved_memory + task.memory > self.max_memory:
+                return
+
+            self.queued_tasks.popleft()
+
+            # The remaining tasks of a failed job are dropped
+            if task.job_id not in self.jobs:
+                continue
+
+            if task.page_index is not None:
+                self.reserved_memory[(task.job_id, task.page_index)] = task.memory
+                self.total_reserved_memory += task.memory
+
+            self.pool.apply_async(
+                task.function, task.arguments,
+                error_callback=functools.partial(self.on_child_error, task.job_id, task.page_index),
+            )
+
+    def release_memory(self, job_id: int, page_index: int | None) -> None:
+        if page_index is not None:
+            self.total_reserved_memory -= self.reserved_memory.pop((job_id, page_index), 0)
+
+    def handle_ready_messages(self, timeout: float | None) -> bool:
+        """Wait until any of the pipes has messages and handle them. Return whether there were any messages."""
+        ready_conns = cast("list['Connection[WorkerMessageBatch]']", wait([*self.parent_conns, self.error_parent_conn], timeout))
+
+        for conn in ready_conns:
+            for message in conn.recv():
+                self.handle_message(message)
+
+        # Finished pages may have freed enough memory for the next ones
+        self.dispatch_tasks()
+
+        return len(ready_conns) > 0
+
+    @contextlib.contextmanager
+    def handle_messages_in_background(self) -> Iterator[None]:
+        """Handle the messages of the workers in a separate thread while the parent process is busy otherwise.
+
+        Queued tasks are only dispatched once the memory of finished pages is released, so without this the workers
+        would run out of tasks while the parent combines a document. The processor must not be used in the meantime.
+        """
+        # Nothing can arrive if there are no other jobs
+        if len(self.jobs) == 0:
+            yield
+            return
+
+        stopped = threading.Event()
+        errors: list[BaseException] = []
+
+        def handle_messages() -> None:
+            try:
+                while not stopped.is_set():
+                    self.handle_ready_messages(timeout=BACKGROUND_POLL_INTERVAL)
+            except BaseException as err:  # noqa: BLE001
+                errors.append(err)
+
+        thread = threading.Thread(target=handle_messages, name='dpsprep-messages', daemon=True)
+        thread.start()
+
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def handle_message(self, data: 'WorkerMessage') -> None:
+        match data:
+            case LogRecordWorkerMessage():
+                logger.handle(data.to_record())
+
+            # Tasks of a failed job may still be running, so we ignore messages for jobs that are no longer tracked.
+            case ExceptionWorkerMessage():
+                self.release_memory(data.job_id, data.page_index)
+
+                if job := self.jobs.get(data.job_id):
+                    job.error = data.error
+
+            case TaskDoneWorkerMessage():
+                self.release_memory(data.job_id, data.page_index)
+                job = self.jobs.get(data.job_id)
+
+                # The shared memory must be released even if the job is no longer tracked
+                if data.payload is not None:
+                    payload_data = import_from_shared_memory(data.payload)
+
+                    if job is not None and job.on_payload is not None and job.error is None:
+                        try:
+                            job.on_payload(data.payload, payload_data)
+                        except Exception as err:  # noqa: BLE001
+                            logger.exception('Could not handle the output of a worker.', exc_info=err)
+                            job.error = err
+
+                if job is not None and job.manifest is not None and data.manifest_entry is not None:
+                    try:
+                        job.manifest.record(data.manifest_entry)
+                    except OSError as err:
+                        logger.debug(f'Could not update {job.manifest.path}: {err}')
+
+                if job is not None and job.metrics is not None and data.metrics is not None:
+                    job.metrics.add_task(data.metrics)
 
-            while not self.rich_progress.finished:
-                try:
-                    if self.parent_conn.poll(0.1):
-                        match data := self.parent_conn.recv():
-                            case ExceptionWorkerMessage():
-                                raise DpsPrepConcurrencyError('Worker error') from data.error  # noqa: TRY301
+                if job is not None:
+                    job.remaining -= 1
+                    self.rich_progress.advance(job.rich_task)
 
-                            case LogRecordWorkerMessage():
-                                logger.handle(data.record)
+    def wait(self, job_id: int) -> None:
+        """Wait until all tasks of the given job are done, while also handling the messages of other jobs."""
+        job = self.jobs[job_id]
 
-                            case TaskDoneWorkerMessage():
-                                self.rich_progress.advance(self.rich_task)
+        try:
+            # The parent sleeps until a worker sends a batch of messages rather than polling periodically
+            while job.remaining > 0 and job.error is None:
+                self.handle_ready_messages(timeout=None)
 
-                except KeyboardInterrupt:
-                    logger.info('Conversion interrupted. Terminating all workers.')
-                    self.pool.terminate()
-                    raise
+        except KeyboardInterrupt:
+            logger.info('Conversion interrupted. Terminating all workers.')
+            self.pool.terminate()
+            raise
 
-                except DpsPrepConcurrencyError:
-                    logger.info('Terminating all other workers.')
-                    self.pool.terminate()
-                    raise
+        finally:
+            self.rich_progress.remove_task(job.rich_task)
+            del self.jobs[job_id]
 
-            self.pool.join()
+        if job.error is not None:
+            raise DpsPrepConcurrencyError('Worker error') from job.error
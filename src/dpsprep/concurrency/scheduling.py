@@ -0,0 +1,63 @@
+import logging
+from collections.abc import Sequence
+
+import djvu.decode
+
+from dpsprep.images import RENDER_MEMORY_FACTOR, estimate_render_size, get_render_size
+from dpsprep.options import DpsPrepOptions
+from dpsprep.page_plan import PageSettings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_page_file_size(page: djvu.decode.Page, i: int) -> int:
+    try:
+        return page.file.size or 0
+    except (djvu.decode.NotAvailable, djvu.decode.JobFailed):
+        logger.debug(f'Could not determine the file size of page {i + 1}.')
+        return 0
+
+
+def get_page_processing_order(options: DpsPrepOptions, document: djvu.decode.Document) -> Sequence[int]:
+    """Order the pages so that the most expensive ones are processed first.
+
+    Workers pull pages from a shared queue, so processing the large pages first keeps them from finishing long
+    after all the other workers have become idle.
+
+    We cannot know the page type (e.g. bitonal or compound) without decoding the page, and even its dimensions
+    require waiting for the page's INFO chunk. So we use the size of the page's component file, which is known from
+    the document's directory - the color layers take up most of the space.
+
+    In in-memory mode, the parent process must hold every page until all preceding pages are done, so we
+    keep the natural order there.
+    """
+    if options.in_memory:
+        return range(len(document.pages))
+
+    file_sizes = [get_page_file_size(page, i) for i, page in enumerate(document.pages)]
+    return sorted(range(len(file_sizes)), key=file_sizes.__getitem__, reverse=True)
+
+
+def estimate_page_memory(options: DpsPrepOptions, settings: PageSettings, page: djvu.decode.Page, i: int) -> int:
+    """Estimate how much memory rendering the page takes, which is bounded because larger pages are rendered in strips.
+
+    The size of the rendered image is determined from the page's INFO chunk. Waiting for it takes a while for every page,
+    so the processor only estimates a page once the preceding ones have been handed to the workers.
+    """
+    try:
+        page.get_info(wait=True)
+        render_size = estimate_render_size(
+            *get_render_size(
+                page.width,
+                page.height,
+                settings.dpi or page.dpi,
+                settings.target_dpi,
+            ),
+            settings.mode,
+        )
+    except (djvu.decode.NotAvailable, djvu.decode.JobFailed):
+        logger.debug(f'Could not determine the size of page {i + 1}.')
+        return 0
+
+    return min(RENDER_MEMORY_FACTOR * render_size, options.max_page_memory)
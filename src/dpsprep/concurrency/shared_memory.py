@@ -0,0 +1,50 @@
+import enum
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+class PayloadKind(enum.Enum):
+    PAGE_BG = enum.auto()
+    TEXT_LAYER = enum.auto()
+
+
+@dataclass(frozen=True)
+class SharedMemoryPayload:
+    """A handle to encoded data that a worker has placed in shared memory.
+
+    Args:
+        name: The name of the shared memory block.
+        size: The size of the data, which may be smaller than the block.
+        kind: What the data represents.
+        index: The zero-based page index for page backgrounds or the first page of the chunk for text layers.
+
+    """
+    name: str
+    size: int
+    kind: PayloadKind
+    index: int
+
+
+def export_to_shared_memory(data: bytes | bytearray, kind: PayloadKind, index: int) -> SharedMemoryPayload:
+    shm = SharedMemory(create=True, size=max(len(data), 1))
+    assert shm.buf is not None
+    shm.buf[:len(data)] = data
+
+    # The parent process is responsible for unlinking the block, so we must prevent the resource tracker
+    # from "cleaning up" after the worker. The track parameter of SharedMemory is only available since Python 3.13.
+    resource_tracker.unregister(shm._name, 'shared_memory')  # type: ignore[attr-defined] # noqa: SLF001
+    shm.close()
+
+    return SharedMemoryPayload(shm.name, len(data), kind, index)
+
+
+def import_from_shared_memory(payload: SharedMemoryPayload) -> bytes:
+    shm = SharedMemory(name=payload.name)
+
+    try:
+        assert shm.buf is not None
+        return bytes(shm.buf[:payload.size])
+    finally:
+        shm.close()
+        shm.unlink()
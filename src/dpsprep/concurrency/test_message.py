@@ -0,0 +1,21 @@
+import logging
+import pickle
+
+from .message import LogRecordWorkerMessage
+
+
+def test_log_record_message_roundtrip() -> None:
+    try:
+        raise ValueError('invalid page')
+    except ValueError as err:
+        record = logging.getLogger('dpsprep.images').makeRecord(
+            'dpsprep.images', logging.WARNING, '/src/dpsprep/images.py', 42, 'Page %d: %s', (3, 'skipped'), (type(err), err, err.__traceback__), 'process_page',
+        )
+
+    message = pickle.loads(pickle.dumps(LogRecordWorkerMessage.from_record(record)))
+    restored = message.to_record()
+
+    assert restored.getMessage() == 'Page 3: skipped'
+    assert (restored.levelname, restored.filename, restored.module, restored.lineno) == ('WARNING', 'images.py', 'images', 42)
+    assert restored.exc_text is not None
+    assert 'ValueError: invalid page' in logging.Formatter().format(restored)
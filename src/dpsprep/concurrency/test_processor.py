@@ -0,0 +1,54 @@
+import pathlib
+from time import sleep, time
+from typing import cast
+
+from dpsprep.options import DpsPrepOptions
+from dpsprep.profiling import get_worker_profile_name, profile_section
+
+from .message import TaskDoneWorkerMessage
+from .processor import DocumentJob, QueuedTask, SubprocessDocumentProcessor
+from .worker import worker_state
+
+
+def finish_page(job_id: int, page_index: int) -> None:
+    worker_state.send(TaskDoneWorkerMessage(job_id, page_index=page_index))
+
+
+def finish_profiled_page(job_id: int, page_index: int, profile_dir: pathlib.Path) -> None:
+    with profile_section(profile_dir, get_worker_profile_name(), dump_interval=3600):
+        finish_page(job_id, page_index)
+
+
+def test_queued_tasks_advance_in_background() -> None:
+    # Only one page fits into the memory limit at a time, so the others are dispatched as the previous ones finish
+    with SubprocessDocumentProcessor(pool_size=1, verbose=False, max_memory=1) as processor:
+        job_id = 1
+        processor.jobs[job_id] = DocumentJob(cast('DpsPrepOptions', None), processor.rich_progress.add_task('Test', total=3), remaining=3)
+        processor.queued_tasks.extend(QueuedTask(job_id, finish_page, (job_id, i), memory=1, page_index=i) for i in range(3))
+        processor.dispatch_tasks()
+
+        assert len(processor.queued_tasks) == 2
+
+        # The parent is busy with something else, e.g. combining the previous document
+        with processor.handle_messages_in_background():
+            deadline = time() + 10
+
+            while processor.jobs[job_id].remaining > 0 and time() < deadline:
+                sleep(0.01)
+
+        assert len(processor.queued_tasks) == 0
+        processor.wait(job_id)
+
+
+def test_worker_profiles_are_written_on_shutdown(tmp_path: pathlib.Path) -> None:
+    with SubprocessDocumentProcessor(pool_size=1, verbose=False) as processor:
+        job_id = 1
+        processor.jobs[job_id] = DocumentJob(cast('DpsPrepOptions', None), processor.rich_progress.add_task('Test', total=1), remaining=1)
+        processor.queued_tasks.append(QueuedTask(job_id, finish_profiled_page, (job_id, 0, tmp_path), memory=0, page_index=0))
+        processor.dispatch_tasks()
+        processor.wait(job_id)
+
+        # The task does not take long enough for a periodic dump
+        assert list(tmp_path.iterdir()) == []
+
+    assert [path.suffix for path in tmp_path.iterdir()] == ['.prof']
@@ -1,73 +1,196 @@
+import contextlib
 import logging
+import multiprocessing.util
+import pathlib
 import signal
+from collections import OrderedDict
+from collections.abc import Iterator, Sequence
 from typing import TYPE_CHECKING
 
 import djvu.decode
 
+from dpsprep.images import RenderBuffer
+from dpsprep.metrics import TaskMetrics
 from dpsprep.options import DpsPrepOptions
-from dpsprep.workflow.processing import process_page_bg, process_text
+from dpsprep.page_plan import PagePlan
+from dpsprep.profiling import WORKER_PROFILE_DUMP_INTERVAL, dump_profiles, get_worker_profile_name, profile_section
+from dpsprep.workflow.processing import process_page_bg, process_page_bg_in_memory, process_text, process_text_in_memory
 
-from .message import LogRecordWorkerMessage, TaskDoneWorkerMessage, WorkerMessage
+from .message import LogRecordWorkerMessage, TaskDoneWorkerMessage, WorkerMessage, WorkerMessageBatch
+from .shared_memory import PayloadKind, export_to_shared_memory
 
 
 if TYPE_CHECKING:
     from multiprocessing.connection import Connection
+    from multiprocessing.sharedctypes import Synchronized
+    from multiprocessing.synchronize import Lock
 
 
+# In batch mode, a worker may alternate between the pages of two consecutive documents.
+MAX_CACHED_DOCUMENTS = 2
+
+# Verbose tasks send their log messages in several batches rather than accumulating them until the task is done.
+MAX_BATCH_SIZE = 64
+
 logger = logging.getLogger(__name__)
 
 
 class SubprocessWorkerLoggerHandler(logging.Handler):
-    conn: 'Connection[WorkerMessage]'
+    def emit(self, record: logging.LogRecord) -> None:
+        worker_state.send(LogRecordWorkerMessage.from_record(record))
 
-    def __init__(self, conn: 'Connection[WorkerMessage]') -> None:
-        super().__init__()
-        self.conn = conn
 
-    def emit(self, record: logging.LogRecord) -> None:
-        self.conn.send(LogRecordWorkerMessage(record))
+class SubprocessWorkerState:
+    """State of a worker process that persists between tasks."""
+    conn: 'Connection[WorkerMessageBatch] | None'
+    conn_lock: 'Lock | None'
+    pending_messages: WorkerMessageBatch
+    is_batching: bool
+    documents: OrderedDict[tuple[pathlib.Path, int, int], djvu.decode.Document]
+    render_buffer: RenderBuffer
 
+    def __init__(self) -> None:
+        self.conn = None
+        self.conn_lock = None
+        self.pending_messages = []
+        self.is_batching = False
+        self.documents = OrderedDict()
+        self.render_buffer = RenderBuffer()
 
-class SubprocessWorker:
-    options: DpsPrepOptions
-    child_conn: 'Connection[WorkerMessage]'
+    def send(self, message: WorkerMessage) -> None:
+        self.pending_messages.append(message)
 
-    def __init__(self, options: DpsPrepOptions, child_conn: 'Connection[WorkerMessage]') -> None:
-        self.options = options
-        self.child_conn = child_conn
+        if not self.is_batching or len(self.pending_messages) >= MAX_BATCH_SIZE:
+            self.flush()
 
-    def setup_child_process(self) -> None:
-        # First, we disable the SIGINT handler altogether.
-        # See https://stackoverflow.com/a/6191991/2756776
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    def flush(self) -> None:
+        assert self.conn is not None and self.conn_lock is not None, 'The worker process has not been initialized'
 
-        # Then, we setup a special logger that pipes its messages to the parent via a multiprocessing Pipe.
-        base_logger = logging.getLogger('dpsprep')
-        base_logger.setLevel(logging.DEBUG if self.options.verbose else logging.INFO)
-        base_logger.handlers.clear()
-        base_logger.addHandler(SubprocessWorkerLoggerHandler(self.child_conn))
+        if len(self.pending_messages) > 0:
+            with self.conn_lock:
+                self.conn.send(self.pending_messages)
 
-    def process_text(self) -> None:
-        self.setup_child_process()
+            self.pending_messages = []
 
-        # The document must be read anew because the underlying structures are not properly copied.
-        document = djvu.decode.Context().new_document(
-            djvu.decode.FileURI(self.options.workdir.src),
-        )
-        document.decoding_job.wait()
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[None]:
+        """Send the messages of a task at once when it ends, whether successfully or not."""
+        self.is_batching = True
 
-        process_text(self.options, document)
-        self.child_conn.send(TaskDoneWorkerMessage())
+        try:
+            yield
+        finally:
+            self.is_batching = False
+            self.flush()
 
-    def process_page_bg(self, worker_id: int) -> None:
-        self.setup_child_process()
+    def get_document(self, path: pathlib.Path) -> djvu.decode.Document:
+        """Open a document or reuse one that has already been opened by this process.
+
+        The document must be read anew in every process because the underlying structures are not properly copied.
+        The daemon keeps its workers between jobs, so we also reopen the document if the file has been replaced since.
+        """
+        stat = path.stat()
+        key = (path, stat.st_mtime_ns, stat.st_size)
+
+        if key in self.documents:
+            self.documents.move_to_end(key)
+            return self.documents[key]
 
-        # The document must be read anew because the underlying structures are not properly copied.
         document = djvu.decode.Context().new_document(
-            djvu.decode.FileURI(self.options.workdir.src),
+            djvu.decode.FileURI(path),
         )
         document.decoding_job.wait()
 
-        for i in range(worker_id, len(document.pages), self.options.pool_size):
-            process_page_bg(self.options, document, i)
-            self.child_conn.send(TaskDoneWorkerMessage())
+        self.documents[key] = document
+
+        while len(self.documents) > MAX_CACHED_DOCUMENTS:
+            self.documents.popitem(last=False)
+
+        return document
+
+
+worker_state = SubprocessWorkerState()
+
+
+def initialize_worker_process(conns: Sequence['Connection[WorkerMessageBatch]'], conn_locks: Sequence['Lock'], conn_counter: 'Synchronized[int]', verbose: bool) -> None:
+    # First, we disable the SIGINT handler altogether.
+    # See https://stackoverflow.com/a/6191991/2756776
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The daemon handles SIGTERM itself, but its workers should simply terminate
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Every worker has its own pipe, so the workers do not contend for a shared lock when sending messages.
+    # A worker that replaces a crashed one may share the pipe of another worker, so the pipes still need locks.
+    with conn_counter.get_lock():
+        worker_state.conn = conns[conn_counter.value % len(conns)]
+        worker_state.conn_lock = conn_locks[conn_counter.value % len(conns)]
+        conn_counter.value += 1
+
+    # Then, we setup a special logger that pipes its messages to the parent.
+    base_logger = logging.getLogger('dpsprep')
+    base_logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    base_logger.handlers.clear()
+    base_logger.addHandler(SubprocessWorkerLoggerHandler())
+
+    # Pool workers exit via multiprocessing's own exit handling, which runs the finalizers with an exit priority but not atexit
+    multiprocessing.util.Finalize(None, dump_profiles, exitpriority=0)
+
+
+class SubprocessWorker:
+    options: DpsPrepOptions
+    job_id: int
+
+    def __init__(self, options: DpsPrepOptions, job_id: int) -> None:
+        self.options = options
+        self.job_id = job_id
+
+    def get_document(self, metrics: TaskMetrics) -> djvu.decode.Document:
+        # The document is only opened by the first task of every worker
+        with metrics.measure('open'):
+            return worker_state.get_document(self.options.workdir.src)
+
+    def finish_metrics(self, metrics: TaskMetrics) -> TaskMetrics | None:
+        return metrics.finish() if self.options.metrics_path is not None else None
+
+    def profile(self) -> contextlib.AbstractContextManager[None]:
+        # The profile is written when the worker shuts down, and periodically in case the worker is terminated instead
+        return profile_section(self.options.profile_dir, get_worker_profile_name(), dump_interval=WORKER_PROFILE_DUMP_INTERVAL)
+
+    def run_text_task(self, chunk: range, plan: PagePlan) -> TaskDoneWorkerMessage:
+        metrics = TaskMetrics('text', chunk.start)
+        document = self.get_document(metrics)
+
+        if self.options.in_memory:
+            data = process_text_in_memory(plan, document, chunk, metrics)
+            payload = export_to_shared_memory(data, PayloadKind.TEXT_LAYER, chunk.start)
+            return TaskDoneWorkerMessage(self.job_id, payload, metrics=self.finish_metrics(metrics))
+
+        entry = process_text(self.options, plan, document, chunk, metrics)
+        return TaskDoneWorkerMessage(self.job_id, manifest_entry=entry, metrics=self.finish_metrics(metrics))
+
+    def run_page_bg_task(self, i: int, plan: PagePlan) -> TaskDoneWorkerMessage:
+        metrics = TaskMetrics('page', i)
+        document = self.get_document(metrics)
+
+        if self.options.in_memory:
+            data = process_page_bg_in_memory(self.options, plan, document, i, worker_state.render_buffer, metrics)
+            payload = export_to_shared_memory(data, PayloadKind.PAGE_BG, i)
+            return TaskDoneWorkerMessage(self.job_id, payload, page_index=i, metrics=self.finish_metrics(metrics))
+
+        entry = process_page_bg(self.options, plan, document, i, worker_state.render_buffer, metrics)
+        return TaskDoneWorkerMessage(self.job_id, page_index=i, manifest_entry=entry, metrics=self.finish_metrics(metrics))
+
+    # The plan only covers the pages of the task, so that it is cheap to send along with it
+    def process_text(self, chunk: range, plan: PagePlan) -> None:
+        with worker_state.batch():
+            with self.profile():
+                message = self.run_text_task(chunk, plan)
+
+            worker_state.send(message)
+
+    def process_page_bg(self, i: int, plan: PagePlan) -> None:
+        with worker_state.batch():
+            with self.profile():
+                message = self.run_page_bg_task(i, plan)
+
+            worker_state.send(message)
@@ -0,0 +1,30 @@
+import pathlib
+
+import pytest
+
+from .options import DEFAULT_MAX_PAGE_MEMORY, DpsPrepOptions
+from .range import RangeOptionGroup
+from .workdir import WorkingDirectory
+
+
+@pytest.fixture
+def default_options() -> DpsPrepOptions:
+    """The options that dpsprep uses without any flags, except for a single worker. Use dataclasses.replace to adjust them."""
+    return DpsPrepOptions(
+        workdir=WorkingDirectory(pathlib.Path('book.djvu'), pathlib.Path('book.pdf'), pathlib.Path('working')),
+        mode_overrides=RangeOptionGroup([]),
+        dpi_overrides=RangeOptionGroup([]),
+        target_dpi_overrides=RangeOptionGroup([]),
+        quality_overrides=RangeOptionGroup([]),
+        no_text=False,
+        page_cache_size=None,
+        in_memory=False,
+        jbig2=False,
+        max_page_memory=DEFAULT_MAX_PAGE_MEMORY * 1024 * 1024,
+        pool_size=1,
+        verbose=False,
+        metrics_path=None,
+        profile_dir=None,
+        ocr_options=None,
+        optlevel=None,
+    )
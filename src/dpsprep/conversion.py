@@ -0,0 +1,282 @@
+import logging
+import os
+import pathlib
+from collections import deque
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from time import time
+from typing import BinaryIO
+
+import djvu.decode
+
+from dpsprep.concurrency import SubprocessDocumentProcessor, finish_processing_document, start_processing_document
+from dpsprep.concurrency.shared_memory import PayloadKind, SharedMemoryPayload
+from dpsprep.images import EncodedPage
+from dpsprep.jbig2 import create_jbig2_encoder
+from dpsprep.logging import human_readable_size
+from dpsprep.metrics import ConversionMetrics
+from dpsprep.options import DpsPrepOptions
+from dpsprep.page_cache import prune_page_cache
+from dpsprep.pdf import IncrementalPdfCombiner
+from dpsprep.profiling import PARENT_PROFILE_NAME, profile_section
+from dpsprep.workdir import WorkingDirectory
+from dpsprep.workflow import (
+    attempt_to_optimize_result,
+    combine_document,
+    destroy_workdir,
+    extract_outline,
+    finish_combination_without_text,
+    get_combination_target,
+    is_combined_directly_into_destination,
+    prepare_workdir,
+    resolve_workdir,
+)
+
+
+DJVU_SUFFIXES = frozenset(['.djvu', '.djv'])
+
+# How many documents are queued in the pool while the parent process is combining the oldest one.
+BATCH_LOOKAHEAD = 1
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryCombination:
+    """Combine the pages of a document in the parent process as soon as the workers produce them."""
+    options: DpsPrepOptions
+    target: pathlib.Path
+    file: BinaryIO
+    combiner: IncrementalPdfCombiner
+
+    def __init__(self, options: DpsPrepOptions, page_count: int) -> None:
+        self.options = options
+        self.target = get_combination_target(options)
+        self.file = open(self.target, 'wb')  # noqa: SIM115
+        self.combiner = IncrementalPdfCombiner(self.file, page_count, with_text=not options.no_text, jbig2_encoder=create_jbig2_encoder(options))
+
+    def handle_payload(self, payload: SharedMemoryPayload, data: bytes) -> None:
+        with profile_section(self.options.profile_dir, PARENT_PROFILE_NAME):
+            match payload.kind:
+                case PayloadKind.PAGE_BG:
+                    self.combiner.add_page_image(payload.index, EncodedPage.deserialize(data))
+
+                case PayloadKind.TEXT_LAYER:
+                    self.combiner.add_text_layer_pdf(payload.index, data)
+
+    def finish(self, document: djvu.decode.Document, metrics: ConversionMetrics) -> pathlib.Path:
+        """Write the outline and return the path to the combined file."""
+        with metrics.measure('outline'):
+            outline = extract_outline(document)
+
+        logger.info('Combining everything.')
+
+        with metrics.measure('combine'):
+            self.combiner.close(outline)
+            self.file.close()
+
+        if is_combined_directly_into_destination(self.options):
+            os.replace(self.target, self.options.workdir.dest)
+            return self.options.workdir.dest
+
+        if self.options.no_text:
+            finish_combination_without_text(self.options, metrics)
+
+        return self.options.workdir.combined_pdf_path
+
+    def abort(self) -> None:
+        self.combiner.abort()
+        self.file.close()
+        self.target.unlink(missing_ok=True)
+
+
+@dataclass(frozen=True)
+class PendingConversion:
+    options: DpsPrepOptions
+    document: djvu.decode.Document
+    job_id: int
+    metrics: ConversionMetrics
+    combination: InMemoryCombination | None = None
+
+
+def open_djvu_document(path: pathlib.Path) -> djvu.decode.Document:
+    document = djvu.decode.Context().new_document(
+        djvu.decode.FileURI(path),
+    )
+    document.decoding_job.wait()
+    return document
+
+
+def start_conversion(processor: SubprocessDocumentProcessor, options: DpsPrepOptions) -> PendingConversion:
+    metrics = ConversionMetrics()
+
+    with metrics.measure('open'):
+        document = open_djvu_document(options.workdir.src)
+
+    if not options.in_memory:
+        with metrics.measure('schedule'):
+            job_id = start_processing_document(processor, options, document, metrics=metrics)
+
+        return PendingConversion(options, document, job_id, metrics)
+
+    combination = InMemoryCombination(options, len(document.pages))
+
+    try:
+        with metrics.measure('schedule'):
+            job_id = start_processing_document(processor, options, document, combination.handle_payload, metrics)
+    except BaseException:
+        combination.abort()
+        raise
+
+    return PendingConversion(options, document, job_id, metrics, combination)
+
+
+def finish_conversion(processor: SubprocessDocumentProcessor, conversion: PendingConversion, preserve_working: bool) -> None:
+    options = conversion.options
+    workdir = options.workdir
+    metrics = conversion.metrics
+
+    if conversion.combination is None:
+        with metrics.measure('process'):
+            finish_processing_document(processor, conversion.job_id)
+
+        # The workers continue with the next documents of a batch in the meantime
+        with processor.handle_messages_in_background(), profile_section(options.profile_dir, PARENT_PROFILE_NAME):
+            combine_document(options, conversion.document, metrics)
+
+        combined_path = workdir.combined_pdf_path
+    else:
+        try:
+            with metrics.measure('process'):
+                finish_processing_document(processor, conversion.job_id)
+
+            with processor.handle_messages_in_background(), profile_section(options.profile_dir, PARENT_PROFILE_NAME):
+                combined_path = conversion.combination.finish(conversion.document, metrics)
+        except BaseException:
+            conversion.combination.abort()
+            raise
+
+    djvu_size = workdir.src.stat().st_size
+    combined_size = combined_path.stat().st_size
+    logger.info(f'Produced a combined output file with size {human_readable_size(combined_size)} in {time() - metrics.start_time:.2f}s. This is {round(100 * combined_size / djvu_size, 2)}% of the DjVu source file.')
+
+    if combined_path != workdir.dest:
+        with metrics.measure('optimize'), processor.handle_messages_in_background(), profile_section(options.profile_dir, PARENT_PROFILE_NAME):
+            attempt_to_optimize_result(options, djvu_size, combined_size)
+
+    metrics.write_report(options, len(conversion.document.pages))
+    prune_page_cache(options)
+
+    if preserve_working:
+        logger.info(f'Working directory {workdir.working} will be preserved.')
+    else:
+        logger.info(f'Deleting the working directory {workdir.working}.')
+        destroy_workdir(workdir)
+
+
+def iter_batch_sources(src: pathlib.Path) -> Iterable[pathlib.Path]:
+    """Iterate the DjVu files in a directory (recursively) or listed in a text file.
+
+    List files contain one path per line. Paths are relative to the list file, while empty lines and
+    lines starting with "#" are ignored.
+    """
+    if src.is_dir():
+        yield from sorted(path for path in src.rglob('*') if path.suffix.lower() in DJVU_SUFFIXES and path.is_file())
+        return
+
+    with open(src, encoding='utf-8') as file:
+        for line in file:
+            if (stripped := line.strip()) and not stripped.startswith('#'):
+                yield (src.parent / stripped).resolve()
+
+
+def get_batch_destination(src: pathlib.Path, batch_root: pathlib.Path, dest_dir: pathlib.Path | None) -> pathlib.Path:
+    if dest_dir is None:
+        return src.with_suffix('.pdf')
+
+    try:
+        relative = src.relative_to(batch_root)
+    except ValueError:
+        relative = pathlib.Path(src.name)
+
+    return dest_dir / relative.with_suffix('.pdf')
+
+
+def is_destination_up_to_date(src: pathlib.Path, dest: pathlib.Path) -> bool:
+    return dest.exists() and dest.stat().st_mtime >= src.stat().st_mtime
+
+
+def convert_batch(
+    processor: SubprocessDocumentProcessor,
+    make_options: Callable[[WorkingDirectory], DpsPrepOptions],
+    src: pathlib.Path,
+    dest_dir: pathlib.Path | None,
+    tmp_root: pathlib.Path | str | None,
+    *,
+    delete_working: bool,
+    preserve_working: bool,
+    overwrite: bool,
+    fast_fingerprint: bool = False,
+) -> int:
+    """Convert every document from a batch source using a shared worker pool.
+
+    Returns the number of documents that failed to convert.
+    """
+    batch_root = src if src.is_dir() else src.parent
+    pending = deque[PendingConversion]()
+    failures = 0
+
+    def finish_oldest() -> None:
+        nonlocal failures
+        conversion = pending.popleft()
+
+        try:
+            finish_conversion(processor, conversion, preserve_working)
+        except Exception:
+            logger.exception(f'Failed to convert {conversion.options.workdir.src}.')
+            failures += 1
+
+    try:
+        for djvu_path in iter_batch_sources(src):
+            if not djvu_path.is_file():
+                logger.error(f'Source file {djvu_path} does not exist.')
+                failures += 1
+                continue
+
+            dest = get_batch_destination(djvu_path, batch_root, dest_dir)
+
+            if not overwrite and is_destination_up_to_date(djvu_path, dest):
+                logger.info(f'Skipping {djvu_path} because {dest} is up to date.')
+                continue
+
+            workdir = resolve_workdir(djvu_path, dest, tmp_root, fast_fingerprint=fast_fingerprint)
+
+            # Documents with identical contents share a working directory, so we must not process them simultaneously.
+            if any(conversion.options.workdir.working == workdir.working for conversion in pending):
+                while pending:
+                    finish_oldest()
+
+            prepare_workdir(workdir, delete_existing=delete_working)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+
+            try:
+                pending.append(start_conversion(processor, make_options(workdir)))
+            except Exception:
+                logger.exception(f'Failed to open {djvu_path}.')
+                failures += 1
+                continue
+
+            while len(pending) > BATCH_LOOKAHEAD:
+                finish_oldest()
+
+        while pending:
+            finish_oldest()
+
+    except BaseException:
+        # Do not leave partially combined files behind when interrupted
+        for conversion in pending:
+            if conversion.combination is not None:
+                conversion.combination.abort()
+
+        raise
+
+    return failures
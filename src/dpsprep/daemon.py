@@ -0,0 +1,206 @@
+import io
+import json
+import logging
+import os
+import pathlib
+import signal
+import socket
+from collections.abc import Callable, Sequence
+from time import time
+from types import FrameType
+
+import click
+
+from dpsprep.cli import dpsprep
+from dpsprep.concurrency import SubprocessDocumentProcessor
+from dpsprep.logging import configure_logging
+from dpsprep.resources import get_default_max_memory, get_default_pool_size
+
+
+logger = logging.getLogger(__name__)
+
+
+# The protocol consists of JSON objects, one per line. The client sends a single request and the daemon
+# responds with status messages, the last of which has the status "done" or "failed".
+JobStatusSender = Callable[[dict[str, object]], None]
+
+
+class JobLogHandler(logging.Handler):
+    """Forward the log messages produced during a job to the client that submitted it."""
+    send: JobStatusSender
+
+    def __init__(self, send: JobStatusSender) -> None:
+        super().__init__()
+        self.send = send
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.send({'status': 'log', 'level': record.levelname, 'message': record.getMessage()})
+
+
+def get_status_sender(file: io.BufferedIOBase) -> JobStatusSender:
+    def send(status: dict[str, object]) -> None:
+        # The client may disconnect at any time, but we still finish the job
+        try:
+            file.write(json.dumps(status).encode('utf-8') + b'\n')
+            file.flush()
+        except OSError:
+            pass
+
+    return send
+
+
+def run_job(processor: SubprocessDocumentProcessor, args: Sequence[str], cwd: str, send: JobStatusSender) -> None:
+    start_time = time()
+    base_logger = logging.getLogger('dpsprep')
+    handler = JobLogHandler(send)
+    base_logger.addHandler(handler)
+    previous_cwd = os.getcwd()
+
+    try:
+        # Relative paths are resolved by the command relative to the working directory of the client
+        os.chdir(cwd)
+        exit_code = dpsprep.main(list(args), prog_name='dpsprep', standalone_mode=False, obj=processor)
+    except click.ClickException as err:
+        send({'status': 'failed', 'message': err.format_message()})
+    except click.Abort as err:
+        send({'status': 'failed', 'message': 'The conversion has been aborted.'})
+
+        # Click converts interruptions (e.g. via SIGTERM) into aborts, but they are meant to stop the daemon.
+        # The processor has already terminated its pool in this case, so it cannot be used for further jobs.
+        if isinstance(err.__context__, KeyboardInterrupt):
+            raise KeyboardInterrupt from err
+    except Exception as err:
+        logger.exception('Job error.', exc_info=err)
+        send({'status': 'failed', 'message': str(err)})
+    else:
+        if exit_code:
+            send({'status': 'failed', 'message': f'The conversion finished with exit code {exit_code}.'})
+        else:
+            send({'status': 'done', 'duration': round(time() - start_time, 2)})
+    finally:
+        os.chdir(previous_cwd)
+        base_logger.removeHandler(handler)
+
+
+def handle_connection(processor: SubprocessDocumentProcessor, conn: socket.socket, job_id: int) -> None:
+    with conn.makefile('rwb') as file:
+        send = get_status_sender(file)
+
+        try:
+            request = json.loads(file.readline())
+            args = [str(arg) for arg in request['args']]
+            cwd = str(request['cwd'])
+        except (ValueError, KeyError, TypeError):
+            send({'status': 'failed', 'message': 'Invalid request.'})
+            return
+
+        logger.info(f'Starting job {job_id}: dpsprep {" ".join(args)}')
+        send({'status': 'started', 'job': job_id})
+        run_job(processor, args, cwd, send)
+
+
+def stop_serving(_signum: int, _frame: FrameType | None) -> None:
+    raise KeyboardInterrupt
+
+
+def is_socket_in_use(socket_path: pathlib.Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+        except OSError:
+            return False
+        else:
+            return True
+
+
+@click.group(epilog='See dpsprep(1) for the conversion options.')
+def dpsprep_daemon() -> None:
+    """Convert DjVu files using a long-running pool of workers.
+
+    This avoids the startup cost of dpsprep (loading the libraries and spawning the workers) for every document.
+    """
+
+
+@dpsprep_daemon.command()
+@click.option('-p', '--pool-size', type=click.IntRange(min=1), default=None, help='Size of the MultiProcessing pool that is shared by all jobs. Defaults to os.process_cpu_count() with a fallback to 2 * os.cpu_count(), limited by the cgroup CPU quota and memory limit.')
+@click.option('--max-memory', type=click.IntRange(min=1), default=None, help='The amount of memory in MiB that the pages processed at the same time may use. Defaults to the cgroup memory limit without the memory needed by the processes themselves.')
+@click.option('-v', '--verbose', is_flag=True, help='Display debug messages and forward them to the clients.')
+@click.argument('socket_path', metavar='SOCKET', type=click.Path(dir_okay=False, path_type=pathlib.Path))
+def serve(socket_path: pathlib.Path, pool_size: int | None, max_memory: int | None, verbose: bool) -> None:
+    """Accept conversion jobs via the Unix socket SOCKET.
+
+    Jobs are processed one at a time, each using the entire pool. The pool size, memory limit and verbosity of individual jobs are ignored.
+    """
+    configure_logging(verbose=verbose)
+
+    if socket_path.exists():
+        if is_socket_in_use(socket_path):
+            raise click.ClickException(f'Another daemon is already listening on {socket_path}.')
+
+        socket_path.unlink()
+
+    pool_size = pool_size or get_default_pool_size()
+    max_memory = get_default_max_memory(pool_size) if max_memory is None else max_memory * 1024 * 1024
+
+    # The interruption must leave the processor's context, so that it terminates the pool rather than waiting for it
+    try:
+        with SubprocessDocumentProcessor(pool_size, verbose, max_memory) as processor, socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            # Service managers stop daemons via SIGTERM, which we handle like an interruption
+            signal.signal(signal.SIGTERM, stop_serving)
+            server.bind(str(socket_path))
+
+            try:
+                server.listen()
+                logger.info(f'Listening on {socket_path} with {pool_size} workers.')
+                job_id = 0
+
+                while True:
+                    conn, _ = server.accept()
+                    job_id += 1
+
+                    with conn:
+                        handle_connection(processor, conn, job_id)
+
+            finally:
+                socket_path.unlink(missing_ok=True)
+
+    except KeyboardInterrupt:
+        logger.info('Shutting down.')
+
+
+@dpsprep_daemon.command(context_settings={'ignore_unknown_options': True})
+@click.argument('socket_path', metavar='SOCKET', type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path))
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def submit(socket_path: pathlib.Path, args: tuple[str, ...]) -> None:
+    """Submit a conversion job to the daemon listening on SOCKET and wait for it to finish.
+
+    ARGS are passed to dpsprep, e.g. `dpsprep-daemon submit daemon.sock -- --mode bitonal input.djvu`.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+        except OSError as err:
+            raise click.ClickException(f'Cannot connect to {socket_path}: {err}') from err
+
+        with client.makefile('rwb') as file:
+            file.write(json.dumps({'args': args, 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+            file.flush()
+
+            for line in file:
+                status = json.loads(line)
+
+                match status['status']:
+                    case 'log':
+                        click.echo(f'{status["level"]:<8} {status["message"]}', err=True)
+
+                    case 'started':
+                        click.echo(f'Job {status["job"]} started.', err=True)
+
+                    case 'done':
+                        click.echo(f'Job finished in {status["duration"]:.2f}s.', err=True)
+                        return
+
+                    case 'failed':
+                        raise click.ClickException(status['message'])
+
+    raise click.ClickException('The daemon closed the connection before the job finished.')
@@ -0,0 +1,18 @@
+import os
+import pathlib
+import tempfile
+
+
+def write_file_atomically(path: pathlib.Path, data: bytes) -> None:
+    """Write the file so that it either appears with its complete contents or not at all, even if the process is killed.
+
+    Several processes may write the same file concurrently, in which case the last one wins.
+    """
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f'{path.name}_', delete=False) as file:
+        try:
+            file.write(data)
+        except BaseException:
+            os.unlink(file.name)
+            raise
+
+    os.replace(file.name, path)
@@ -1,10 +1,14 @@
+import json
 import logging
-import pathlib
-from typing import NamedTuple
+import zlib
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from dataclasses import asdict, dataclass, replace
+from io import BytesIO
+from typing import Any, NamedTuple
 
 import djvu.decode
 import PIL.features
-from PIL import Image, ImageOps
+from PIL import Image, ImageChops, ImageMath, ImageStat, TiffImagePlugin
 
 from dpsprep.options import DpsPrepOptions, ImageMode
 
@@ -31,22 +35,367 @@ pil_modes = {
 }
 
 
+# I have experimentally determined that we need to invert the black-and-white images. -- Ianis, 2023-05-13
+# See also https://github.com/kcroker/dpsprep/issues/16
+# libdjvu uses 1 for black pixels, while Pillow uses 1 for white pixels. Rather than inverting the image afterwards,
+# we let Pillow invert the bits while unpacking them, which it does anyway in order to expand them to bytes.
+pil_raw_modes = {
+    ImageMode.RGB: 'RGB',
+    ImageMode.GRAYSCALE: 'L',
+    ImageMode.BITONAL: '1;I',
+}
+
+
+# Layered pages mirror the structure of DjVu compound pages. The mask is stored at full resolution,
+# while the background and the foreground colors are subsampled by the given factors.
+BACKGROUND_SUBSAMPLING = 3
+FOREGROUND_SUBSAMPLING = 6
+
+
+# With ImageMode.AUTO, the mode is chosen based on statistics of a sample of the pixels
+# We sample at most this many pixels along each side of the page
+AUTO_MODE_SAMPLE_SIZE = 512
+# A pixel is considered colorful if two of its channels differ by at least this much
+AUTO_MODE_CHROMA_THRESHOLD = 32
+AUTO_MODE_MAX_COLOR_FRACTION = 0.005
+# Pages with few gray pixels are considered bitonal. Some gray pixels are expected around the edges of glyphs.
+AUTO_MODE_MIDTONE_RANGE = (64, 192)
+AUTO_MODE_MAX_MIDTONE_FRACTION = 0.03
+
+
+def estimate_render_size(width: int, height: int, mode: ImageMode) -> int:
+    """Estimate the size of the buffer needed for rendering a page in the given mode."""
+    if mode == ImageMode.BITONAL:
+        return (width + 7) // 8 * height
+
+    if mode == ImageMode.GRAYSCALE:
+        return width * height
+
+    # We cannot know what ImageMode.INFER and ImageMode.AUTO will resolve to, so we assume the worst case
+    # ImageMode.LAYERED also needs to render the foreground at full resolution
+    return 3 * width * height
+
+
+# Pages whose rendered image would exceed the memory limit are rendered and encoded in horizontal strips.
+# The strip heights are multiples of the JPEG block height, so that no block straddles two strips.
+STRIP_ALIGNMENT = 16
+# Pillow copies the rendered strip when unpacking it (except for grayscale), so two copies must fit into the limit
+RENDER_MEMORY_FACTOR = 2
+
+
+def get_strip_height(width: int, mode: ImageMode, memory_limit: int) -> int:
+    rows = memory_limit // (RENDER_MEMORY_FACTOR * estimate_render_size(width, 1, mode))
+    return max(rows // STRIP_ALIGNMENT * STRIP_ALIGNMENT, STRIP_ALIGNMENT)
+
+
+def exceeds_memory_limit(width: int, height: int, mode: ImageMode, memory_limit: int | None) -> bool:
+    return memory_limit is not None and RENDER_MEMORY_FACTOR * estimate_render_size(width, height, mode) > memory_limit
+
+
+def get_render_size(width: int, height: int, dpi: int, target_dpi: int | None) -> tuple[int, int]:
+    """Determine the size of the rendered image of a page. Pages are scaled down if their DPI exceeds the target, but never up."""
+    if target_dpi is None or target_dpi >= dpi:
+        return (width, height)
+
+    return (
+        max(round(width * target_dpi / dpi), 1),
+        max(round(height * target_dpi / dpi), 1),
+    )
+
+
 class ProcessedPageBackground(NamedTuple):
     pil_image: Image.Image
     resolution: int
     mode: ImageMode
+    # Only for layered pages, in which case pil_image is the background
+    foreground: Image.Image | None = None
+    mask: Image.Image | None = None
+
+
+class RenderBuffer:
+    """A buffer for rendering pages that is reused for all pages processed by a worker.
+
+    The buffer only grows. We allocate a new bytearray rather than resizing the existing one because
+    a bytearray cannot be resized while a Pillow image created via Image.frombuffer() refers to it.
+
+    Images created over the buffer are only valid until the next page is rendered.
+    """
+    data: bytearray
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def get(self, size: int) -> memoryview:
+        if len(self.data) < size:
+            self.data = bytearray(size)
+
+        return memoryview(self.data)[:size]
+
+
+def subsample_foreground(foreground: Image.Image, mask: Image.Image, factor: int) -> Image.Image:
+    """Reduce the resolution of the foreground by averaging only the colors of the pixels covered by the mask.
+
+    libdjvu renders the foreground colors only under the mask, with white elsewhere. Simply reducing the image
+    would blend thin glyphs with the surrounding white.
+    """
+    # The mask uses 0 for covered pixels
+    coverage = ImageChops.invert(mask.convert('L'))
+    covered = Image.new('RGB', foreground.size)
+    covered.paste(foreground, mask=coverage)
+
+    color_sums = covered.reduce(factor)
+    coverage_sums = coverage.reduce(factor)
+    averages = Image.merge('RGB', [
+        ImageMath.lambda_eval(lambda args: args['color'] * 255 / args['coverage'], color=band, coverage=coverage_sums).convert('L')
+        for band in color_sums.split()
+    ])
+
+    # The uncovered areas are never painted. Filling them with the average color rather than black avoids JPEG artifacts around the glyphs.
+    fill = tuple(round(value) for value in ImageStat.Stat(foreground, coverage).mean) if coverage.getbbox() else 0
+    result = Image.new('RGB', averages.size, fill)
+    result.paste(averages, mask=coverage_sums.point(lambda value: 255 if value else 0))
+    return result
+
+
+def render_djvu_page_layers(page_job: djvu.decode.PageJob, size: tuple[int, int], resolution: int, render_buffer: RenderBuffer | None) -> ProcessedPageBackground:
+    width, height = size
+    rect = (0, 0, width, height)
+
+    mask_buffer = bytearray(estimate_render_size(width, height, ImageMode.BITONAL))
+    page_job.render(
+        mode=djvu.decode.RENDER_MASK_ONLY,
+        page_rect=rect,
+        render_rect=rect,
+        pixel_format=djvu_pixel_formats[ImageMode.BITONAL],
+        buffer=mask_buffer,
+    )
+    mask = Image.frombuffer(pil_modes[ImageMode.BITONAL], size, mask_buffer, 'raw', pil_raw_modes[ImageMode.BITONAL], 0, 1)
+
+    foreground_size = estimate_render_size(width, height, ImageMode.RGB)
+    foreground_buffer = bytearray(foreground_size) if render_buffer is None else render_buffer.get(foreground_size)
+    page_job.render(
+        mode=djvu.decode.RENDER_FOREGROUND,
+        page_rect=rect,
+        render_rect=rect,
+        pixel_format=djvu_pixel_formats[ImageMode.RGB],
+        buffer=foreground_buffer,
+    )
+    foreground = Image.frombuffer(pil_modes[ImageMode.RGB], size, foreground_buffer, 'raw', pil_raw_modes[ImageMode.RGB], 0, 1)
+
+    # Making page_rect smaller than the page makes libdjvu scale the page down
+    background_rect = (0, 0, -(-width // BACKGROUND_SUBSAMPLING), -(-height // BACKGROUND_SUBSAMPLING))
+    background_data = page_job.render(
+        mode=djvu.decode.RENDER_BACKGROUND,
+        page_rect=background_rect,
+        render_rect=background_rect,
+        pixel_format=djvu_pixel_formats[ImageMode.RGB],
+    )
+    background = Image.frombytes(pil_modes[ImageMode.RGB], background_rect[2:], background_data)
+
+    return ProcessedPageBackground(
+        background,
+        resolution,
+        ImageMode.LAYERED,
+        foreground=subsample_foreground(foreground, mask, FOREGROUND_SUBSAMPLING),
+        mask=mask,
+    )
+
+
+class PageStatistics(NamedTuple):
+    color_fraction: float
+    midtone_fraction: float
+
+
+def sample_page_statistics(image: Image.Image) -> PageStatistics:
+    """Determine the fraction of colorful and of gray pixels in a sample of an RGB image.
+
+    We pick individual pixels rather than averaging them, since averaging would produce gray pixels around every glyph.
+    """
+    scale = max(image.width, image.height) / AUTO_MODE_SAMPLE_SIZE
+
+    if scale > 1:
+        sample = image.resize((max(round(image.width / scale), 1), max(round(image.height / scale), 1)), Image.Resampling.NEAREST)
+    else:
+        sample = image
+
+    red, green, blue = sample.split()
+    chroma = ImageChops.lighter(
+        ImageChops.lighter(ImageChops.difference(red, green), ImageChops.difference(green, blue)),
+        ImageChops.difference(red, blue),
+    )
+
+    pixel_count = sample.width * sample.height
+    color_count = sum(chroma.histogram()[AUTO_MODE_CHROMA_THRESHOLD:])
+    midtone_count = sum(sample.convert('L').histogram()[slice(*AUTO_MODE_MIDTONE_RANGE)])
+    return PageStatistics(color_count / pixel_count, midtone_count / pixel_count)
+
+
+def choose_image_mode(stats: PageStatistics) -> ImageMode:
+    """Choose the cheapest mode that represents the page faithfully."""
+    if stats.color_fraction > AUTO_MODE_MAX_COLOR_FRACTION:
+        return ImageMode.RGB
+
+    if stats.midtone_fraction > AUTO_MODE_MAX_MIDTONE_FRACTION:
+        return ImageMode.GRAYSCALE
+
+    return ImageMode.BITONAL
+
+
+def convert_rgb_image(image: Image.Image, mode: ImageMode) -> Image.Image:
+    if mode == ImageMode.RGB:
+        return image
+
+    grayscale = image.convert(pil_modes[ImageMode.GRAYSCALE])
+
+    if mode == ImageMode.GRAYSCALE:
+        return grayscale
+
+    return grayscale.point(lambda value: 255 if value >= 128 else 0, pil_modes[ImageMode.BITONAL])
+
+
+@dataclass(frozen=True)
+class StripedPageBackground:
+    """A page that is too large to be rendered at once.
+
+    The strips are rendered on demand while the page is being encoded, so that only one of them is in memory at a time.
+    """
+    page_job: djvu.decode.PageJob
+    size: tuple[int, int]
+    resolution: int
+    mode: ImageMode
+    strip_height: int
+    render_buffer: RenderBuffer | None
+    i: int
+
+    def iter_strips(self) -> Iterator[tuple[int, Image.Image]]:
+        """Render the strips from top to bottom, together with their distance from the top of the page."""
+        width, height = self.size
+
+        for top in range(0, height, self.strip_height):
+            strip_height = min(self.strip_height, height - top)
+            buffer_size = estimate_render_size(width, strip_height, self.mode)
+            buffer = bytearray(buffer_size) if self.render_buffer is None else self.render_buffer.get(buffer_size)
+
+            try:
+                self.page_job.render(
+                    mode=djvu.decode.RENDER_COLOR,
+                    page_rect=(0, 0, width, height),
+                    # libdjvu measures the y coordinate from the bottom of the page
+                    render_rect=(0, height - top - strip_height, width, strip_height),
+                    pixel_format=djvu_pixel_formats[self.mode],
+                    buffer=buffer,
+                )
+            except djvu.decode.NotAvailable:
+                logger.warning(f'libdjvu claims that data for rows {top} to {top + strip_height} of page {self.i + 1} is not available. Producing a blank strip.')
+                yield top, Image.new(pil_modes[self.mode], (width, strip_height), 'white')
+                continue
+
+            yield top, Image.frombuffer(pil_modes[self.mode], (width, strip_height), buffer, 'raw', pil_raw_modes[self.mode], 0, 1)
+
+
+def infer_image_mode(image: Image.Image, i: int) -> ImageMode:
+    stats = sample_page_statistics(image)
+    mode = choose_image_mode(stats)
+    logger.debug(
+        f'Chose {mode} mode for page {i + 1} because {stats.color_fraction:.2%} of the sampled pixels are colorful '
+        f'and {stats.midtone_fraction:.2%} are gray.',
+    )
+    return mode
+
+
+def render_preview(page_job: djvu.decode.PageJob, size: tuple[int, int]) -> Image.Image:
+    """Render the page scaled down so that its statistics can be sampled without rendering it at full size.
+
+    libdjvu averages the pixels while scaling, so the preview contains more gray pixels than the page itself.
+    """
+    width, height = size
+    scale = max(max(width, height) / AUTO_MODE_SAMPLE_SIZE, 1)
+    rect = (0, 0, max(round(width / scale), 1), max(round(height / scale), 1))
+    data = page_job.render(
+        mode=djvu.decode.RENDER_COLOR,
+        page_rect=rect,
+        render_rect=rect,
+        pixel_format=djvu_pixel_formats[ImageMode.RGB],
+    )
+    return Image.frombytes(pil_modes[ImageMode.RGB], rect[2:], data)
+
+
+def process_djvu_page(
+    page: djvu.decode.Page,
+    mode: ImageMode,
+    i: int,
+    render_buffer: RenderBuffer | None = None,
+    *,
+    dpi: int | None = None,
+    target_dpi: int | None = None,
+    memory_limit: int | None = None,
+) -> ProcessedPageBackground | StripedPageBackground:
+    """Decode and render the page. See process_decoded_djvu_page for the arguments."""
+    return process_decoded_djvu_page(
+        page.decode(wait=True),
+        mode,
+        i,
+        render_buffer,
+        dpi=dpi,
+        target_dpi=target_dpi,
+        memory_limit=memory_limit,
+    )
+
 
+def process_decoded_djvu_page(
+    page_job: djvu.decode.PageJob,
+    mode: ImageMode,
+    i: int,
+    render_buffer: RenderBuffer | None = None,
+    *,
+    dpi: int | None = None,
+    target_dpi: int | None = None,
+    memory_limit: int | None = None,
+) -> ProcessedPageBackground | StripedPageBackground:
+    """Render the page.
 
-def process_djvu_page(page: djvu.decode.Page, mode: ImageMode, i: int) -> ProcessedPageBackground:
-    page_job = page.decode(wait=True)
-    width, height = page_job.size
-    buffer = bytearray(3 * width * height)  # RGB at most
+    The DPI encoded in the page can be overridden via dpi. If target_dpi is lower, libdjvu renders the page at that
+    resolution rather than the image being scaled afterwards.
 
+    If rendering the entire page would take more than memory_limit bytes, the page is instead rendered in strips
+    while it is being encoded.
+    """
+    source_dpi = dpi or page_job.dpi
+    page_width, page_height = page_job.size
+    size = get_render_size(page_width, page_height, source_dpi, target_dpi)
+    resolution = source_dpi if target_dpi is None else min(source_dpi, target_dpi)
+
+    # If the size differs from the size of the page, libdjvu scales the page while rendering it
+    width, height = size
     rect = (0, 0, width, height)
 
-    if mode == ImageMode.INFER:
+    if mode == ImageMode.LAYERED:
+        if page_job.type == djvu.decode.PAGE_TYPE_COMPOUND and not exceeds_memory_limit(width, height, mode, memory_limit):
+            try:
+                return render_djvu_page_layers(page_job, size, resolution, render_buffer)
+            except djvu.decode.NotAvailable:
+                logger.debug(f'Could not render the layers of page {i + 1} separately. Rendering it as a single image.')
+
+        mode = ImageMode.INFER
+
+    # There is no point in gathering statistics for pages that can only contain two colors
+    if mode == ImageMode.INFER or (mode == ImageMode.AUTO and page_job.type == djvu.decode.PAGE_TYPE_BITONAL):
         mode = ImageMode.BITONAL if page_job.type == djvu.decode.PAGE_TYPE_BITONAL else ImageMode.RGB
 
+    # For ImageMode.AUTO, we render the page in color and convert the image once we have chosen the mode
+    render_mode = ImageMode.RGB if mode == ImageMode.AUTO else mode
+
+    if memory_limit is not None and exceeds_memory_limit(width, height, render_mode, memory_limit):
+        if mode == ImageMode.AUTO:
+            mode = infer_image_mode(render_preview(page_job, size), i)
+
+        strip_height = get_strip_height(width, mode, memory_limit)
+        logger.debug(f'Page {i + 1} is too large to be rendered at once. Rendering it in strips of {strip_height} rows.')
+        return StripedPageBackground(page_job, size, resolution, mode, strip_height, render_buffer, i)
+
+    buffer_size = estimate_render_size(width, height, render_mode)
+    buffer = bytearray(buffer_size) if render_buffer is None else render_buffer.get(buffer_size)
+
     if mode == ImageMode.BITONAL:
         if not PIL.features.check_codec('libtiff'):
             logger.warning('Bitonal image compression may suffer because Pillow has been built without libtiff support.')
@@ -59,57 +408,265 @@ def process_djvu_page(page: djvu.decode.Page, mode: ImageMode, i: int) -> Proces
             mode=djvu.decode.RENDER_COLOR,
             page_rect=rect,
             render_rect=rect,
-            pixel_format=djvu_pixel_formats[mode],
+            pixel_format=djvu_pixel_formats[render_mode],
             buffer=buffer,
         )
     except djvu.decode.NotAvailable:
         logger.warning(f'libdjvu claims that data for page {i + 1} is not available. Producing a blank page.')
         image = Image.new(
             pil_modes[ImageMode.BITONAL],
-            page_job.size,
+            size,
             1,
         )
 
-        return ProcessedPageBackground(image, page_job.dpi, ImageMode.BITONAL)
+        return ProcessedPageBackground(image, resolution, ImageMode.BITONAL)
 
+    # For grayscale images, this does not copy the buffer
     image = Image.frombuffer(
-        pil_modes[mode],
-        page_job.size,
+        pil_modes[render_mode],
+        size,
         buffer,
         'raw',
+        pil_raw_modes[render_mode],
+        0,
+        1,
     )
 
-    return ProcessedPageBackground(
-        # I have experimentally determined that we need to invert the black-and-white images. -- Ianis, 2023-05-13
-        # See also https://github.com/kcroker/dpsprep/issues/16
-        ImageOps.invert(image) if mode == ImageMode.BITONAL else image,
-        page_job.dpi,
-        mode,
-    )
+    if mode == ImageMode.AUTO:
+        mode = infer_image_mode(image, i)
+        image = convert_rgb_image(image, mode)
 
+    return ProcessedPageBackground(image, resolution, mode)
 
-def failsafe_save_djvu_page(page_bg: ProcessedPageBackground, target: pathlib.Path, options: DpsPrepOptions, i: int) -> None:
-    quality = options.quality_overrides.get_value_for_zero_based_page(i)
-    dpi = options.dpi_overrides.get_value_for_zero_based_page(i) or page_bg.resolution
 
-    if quality is not None:
-        if page_bg.pil_image.mode in pil_modes[ImageMode.BITONAL] and PIL.features.check_codec('libtiff'):
-            logger.warning('Pillow uses TIFF for encoding bitonal PDF images. The encoder does not support a "quality" setting. If the conversion fails, please try again without specifying quality.')
+@dataclass(frozen=True)
+class EncodedPageImage:
+    """A compressed image stream that can be placed into a PDF as an image XObject without being decoded.
+
+    Args:
+        width: The width of the image in pixels.
+        height: The height of the image in pixels.
+        color_space: The name of the PDF color space.
+        bits_per_component: The PDF BitsPerComponent value.
+        filter: The name of the PDF filter that decodes the data, or None if the data is not compressed.
+        decode_parms: The PDF DecodeParms dictionary for the filter, if needed.
+        data: The compressed data.
+        mask: A bitonal image whose black pixels determine where the image is painted.
+        top: If given, the image is drawn at its own size this many pixels below the top of the page
+            rather than stretched over the entire page.
+
+    """
+    width: int
+    height: int
+    color_space: str
+    bits_per_component: int
+    filter: str | None
+    decode_parms: Mapping[str, int | bool] | None
+    data: bytes
+    mask: 'EncodedPageImage | None' = None
+    top: int | None = None
+
+
+def get_image_header(image: EncodedPageImage) -> dict[str, Any]:
+    header = {key: value for key, value in asdict(image).items() if key not in {'data', 'mask'}}
+    header['size'] = len(image.data)
+    header['mask'] = None if image.mask is None else get_image_header(image.mask)
+    return header
+
+
+def get_image_data(image: EncodedPageImage) -> Iterable[bytes]:
+    yield image.data
+
+    if image.mask is not None:
+        yield from get_image_data(image.mask)
+
+
+def read_image(header: dict[str, Any], serialized: memoryview) -> tuple[EncodedPageImage, memoryview]:
+    size = header.pop('size', None)
+    mask_header = header.pop('mask', None)
+
+    if not isinstance(size, int) or len(serialized) < size:
+        raise ValueError(f'Expected {size} bytes of image data, but only {len(serialized)} are available')
+
+    data = serialized[:size].tobytes()
+    serialized = serialized[size:]
+    mask = None
+
+    if mask_header is not None:
+        mask, serialized = read_image(mask_header, serialized)
+
+    try:
+        return EncodedPageImage(**header, data=data, mask=mask), serialized
+    except TypeError as err:
+        raise ValueError('Invalid page image header') from err
+
+
+@dataclass(frozen=True)
+class EncodedPage:
+    """The compressed images that make up a page.
+
+    Layers (images whose top is None) are drawn on top of each other and stretched over the entire page, regardless
+    of their own size. Strips of pages that are too large to render at once are placed at their full-resolution size,
+    starting top pixels below the top edge of the page. See get_image_placement in dpsprep.pdf.
+
+    Args:
+        width: The width of the page in pixels at full resolution.
+        height: The height of the page in pixels at full resolution.
+        resolution: The DPI used for determining the size of the page.
+        layers: The images, from bottom to top.
+
+    """
+    width: int
+    height: int
+    resolution: int
+    layers: Sequence[EncodedPageImage]
+
+    def serialize(self) -> bytes:
+        """Represent the page as a JSON header line followed by the raw data of every image."""
+        header = json.dumps({
+            'width': self.width,
+            'height': self.height,
+            'resolution': self.resolution,
+            'layers': [get_image_header(image) for image in self.layers],
+        }).encode('utf-8')
+
+        return b''.join([header, b'\n', *(data for image in self.layers for data in get_image_data(image))])
+
+    @classmethod
+    def deserialize(cls, serialized: bytes) -> 'EncodedPage':
+        header_str, separator, _ = serialized.partition(b'\n')
+
+        if not separator:
+            raise ValueError('The page image has no header')
+
+        header = json.loads(header_str)
+
+        if not isinstance(header, dict) or not isinstance(header.get('layers'), list) or len(header['layers']) == 0:
+            raise ValueError('Invalid page image header')
+
+        remaining = memoryview(serialized)[len(header_str) + 1:]
+        layers = []
+
+        for image_header in header.pop('layers'):
+            image, remaining = read_image(image_header, remaining)
+            layers.append(image)
+
+        if len(remaining) > 0:
+            raise ValueError(f'Unexpected {len(remaining)} bytes after the image data')
 
         try:
-            page_bg.pil_image.save(
-                target,
-                format='PDF',
-                quality=quality,
-                resolution=dpi,
-            )
-        except ValueError:
-            logger.warning(f'Failed to encode page {i}. Trying again without setting quality.')
+            return cls(**header, layers=layers)
+        except TypeError as err:
+            raise ValueError('Invalid page image header') from err
+
+
+def encode_g4(image: Image.Image) -> bytes:
+    """Compress a bitonal image using CCITT Group 4 via libtiff and extract the raw strip from the TIFF container."""
+    buffer = BytesIO()
+    # A single strip covers the entire image
+    image.save(buffer, format='TIFF', compression='group4', strip_size=(image.width + 7) // 8 * image.height)
+
+    with Image.open(buffer) as tiff:
+        assert isinstance(tiff, TiffImagePlugin.TiffImageFile)
+        offset = tiff.tag_v2[TiffImagePlugin.STRIPOFFSETS]
+        size = tiff.tag_v2[TiffImagePlugin.STRIPBYTECOUNTS]
+
+    # The tags contain one value per strip
+    if isinstance(offset, tuple):
+        (offset,) = offset
+
+    if isinstance(size, tuple):
+        (size,) = size
+
+    return buffer.getbuffer()[offset:offset + size].tobytes()
+
+
+def encode_bitonal_pil_image(image: Image.Image) -> EncodedPageImage:
+    width, height = image.size
+
+    if PIL.features.check_codec('libtiff'):
+        return EncodedPageImage(
+            width, height, 'DeviceGray', 1, 'CCITTFaxDecode',
+            {'K': -1, 'BlackIs1': True, 'Columns': width, 'Rows': height},
+            encode_g4(image),
+        )
+
+    return EncodedPageImage(width, height, 'DeviceGray', 1, 'FlateDecode', None, zlib.compress(image.tobytes()))
+
+
+def encode_bitonal_image(image: EncodedPageImage) -> EncodedPageImage:
+    """Compress an uncompressed bitonal image."""
+    return encode_bitonal_pil_image(Image.frombytes(pil_modes[ImageMode.BITONAL], (image.width, image.height), image.data))
+
+
+def encode_multitonal_pil_image(image: Image.Image, quality: int | None) -> EncodedPageImage:
+    width, height = image.size
+    color_space = 'DeviceGray' if image.mode == pil_modes[ImageMode.GRAYSCALE] else 'DeviceRGB'
+
+    if PIL.features.check_codec('jpg'):
+        buffer = BytesIO()
+
+        if quality is None:
+            image.save(buffer, format='JPEG')
         else:
-            return
+            image.save(buffer, format='JPEG', quality=quality)
 
-    page_bg.pil_image.save(
-        target,
-        format='PDF',
-        resolution=dpi,
-    )
+        return EncodedPageImage(width, height, color_space, 8, 'DCTDecode', None, buffer.getvalue())
+
+    return EncodedPageImage(width, height, color_space, 8, 'FlateDecode', None, zlib.compress(image.tobytes()))
+
+
+def encode_page_strips(page_bg: StripedPageBackground, resolution: int, quality: int | None) -> EncodedPage:
+    """Render and compress the strips one by one.
+
+    Bitonal strips are never left to jbig2enc because only pages that consist of a single image are compressed that way.
+    """
+    strips = []
+
+    for top, strip in page_bg.iter_strips():
+        if page_bg.mode == ImageMode.BITONAL:
+            strips.append(replace(encode_bitonal_pil_image(strip), top=top))
+        else:
+            strips.append(replace(encode_multitonal_pil_image(strip, quality), top=top))
+
+    return EncodedPage(*page_bg.size, resolution, strips)
+
+
+def encode_djvu_page(page_bg: ProcessedPageBackground | StripedPageBackground, resolution: int, quality: int | None, *, defer_bitonal: bool = False) -> EncodedPage:
+    """Compress the page images.
+
+    With defer_bitonal, bitonal images are left uncompressed so that the main process can compress them in batches.
+    """
+    if isinstance(page_bg, StripedPageBackground):
+        return encode_page_strips(page_bg, resolution, quality)
+
+    image = page_bg.pil_image
+
+    if page_bg.mode == ImageMode.LAYERED:
+        assert page_bg.foreground is not None
+        assert page_bg.mask is not None
+
+        # The background and foreground are subsampled, so the mask determines the size of the page
+        background = encode_multitonal_pil_image(image, quality)
+        foreground = encode_multitonal_pil_image(page_bg.foreground, quality)
+        mask = encode_bitonal_pil_image(page_bg.mask)
+        return EncodedPage(*page_bg.mask.size, resolution, [background, replace(foreground, mask=mask)])
+
+    if image.mode == pil_modes[ImageMode.BITONAL]:
+        if defer_bitonal:
+            width, height = image.size
+            return EncodedPage(width, height, resolution, [EncodedPageImage(width, height, 'DeviceGray', 1, None, None, image.tobytes())])
+
+        return EncodedPage(*image.size, resolution, [encode_bitonal_pil_image(image)])
+
+    return EncodedPage(*image.size, resolution, [encode_multitonal_pil_image(image, quality)])
+
+
+def failsafe_encode_djvu_page(page_bg: ProcessedPageBackground | StripedPageBackground, options: DpsPrepOptions, quality: int | None, i: int) -> EncodedPage:
+    if quality is not None:
+        try:
+            return encode_djvu_page(page_bg, page_bg.resolution, quality, defer_bitonal=options.jbig2)
+        except ValueError:
+            logger.warning(f'Failed to encode page {i + 1}. Trying again without setting quality.')
+
+    return encode_djvu_page(page_bg, page_bg.resolution, quality=None, defer_bitonal=options.jbig2)
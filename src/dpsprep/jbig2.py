@@ -0,0 +1,115 @@
+# jbig2enc is an external executable, so there is no Python dependency to install.
+# See https://github.com/agl/jbig2enc
+
+import logging
+import pathlib
+import shutil
+import subprocess
+import tempfile
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+
+from dpsprep.images import EncodedPage, encode_bitonal_image
+from dpsprep.options import DpsPrepOptions
+from dpsprep.workdir import TEXT_LAYER_CHUNK_SIZE
+
+
+JBIG2ENC_EXECUTABLE = 'jbig2'
+
+# The pages of a batch share a symbol dictionary. Batches never cross the boundaries of text layer chunks,
+# so that the PDF writer can forget the objects of a chunk once it has been written.
+JBIG2_BATCH_SIZE = TEXT_LAYER_CHUNK_SIZE
+
+# Pillow uses 1 for white pixels, while PBM uses 1 for black pixels
+PBM_INVERSION_TABLE = bytes(255 - byte for byte in range(256))
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class EncodedPageGroup:
+    """Consecutive pages that share a JBIG2 symbol dictionary, if any."""
+    pages: Sequence[EncodedPage]
+    jbig2_globals: bytes | None = None
+
+
+def find_jbig2enc() -> str | None:
+    return shutil.which(JBIG2ENC_EXECUTABLE)
+
+
+def is_jbig2_candidate(page: EncodedPage) -> bool:
+    """Determine whether the worker has left the compression of a bitonal page to jbig2enc."""
+    return len(page.layers) == 1 and page.layers[0].bits_per_component == 1 and page.layers[0].filter is None
+
+
+def encode_jbig2_group(executable: str, pages: Sequence[EncodedPage], tmp_root: pathlib.Path) -> EncodedPageGroup:
+    with tempfile.TemporaryDirectory(prefix='jbig2_', dir=tmp_root) as tmp_str:
+        tmp = pathlib.Path(tmp_str)
+        pbm_names = []
+
+        for k, page in enumerate(pages):
+            (image,) = page.layers
+            pbm_names.append(f'page_{k:04}.pbm')
+            with open(tmp / pbm_names[-1], 'wb') as file:
+                file.write(f'P4\n{image.width} {image.height}\n'.encode('ascii'))
+                file.write(image.data.translate(PBM_INVERSION_TABLE))
+
+        # -s enables symbol mode, which produces the shared dictionary, and -p produces the fragments for embedding into a PDF
+        subprocess.run(
+            [executable, '-s', '-p', '-b', 'output', *pbm_names],
+            cwd=tmp,
+            check=True,
+            capture_output=True,
+        )
+
+        return EncodedPageGroup(
+            [
+                replace(page, layers=[replace(page.layers[0], filter='JBIG2Decode', data=(tmp / f'output.{k:04}').read_bytes())])
+                for k, page in enumerate(pages)
+            ],
+            jbig2_globals=(tmp / 'output.sym').read_bytes(),
+        )
+
+
+def encode_page_group(executable: str, pages: Sequence[EncodedPage], tmp_root: pathlib.Path) -> EncodedPageGroup:
+    try:
+        return encode_jbig2_group(executable, pages, tmp_root)
+    except (OSError, subprocess.CalledProcessError) as err:
+        stderr = err.stderr.decode(errors='replace').strip() if isinstance(err, subprocess.CalledProcessError) else str(err)
+        logger.warning(f'jbig2enc failed to compress {len(pages)} pages, falling back to the default bitonal compression: {stderr}')
+        return EncodedPageGroup([replace(page, layers=[encode_bitonal_image(page.layers[0])]) for page in pages])
+
+
+class Jbig2Encoder:
+    """Compress batches of bitonal images via jbig2enc in background threads.
+
+    The threads only wait for the jbig2enc processes, so they do not compete with the main thread for the GIL.
+    """
+    executable: str
+    tmp_root: pathlib.Path
+    executor: ThreadPoolExecutor
+
+    def __init__(self, executable: str, tmp_root: pathlib.Path, max_workers: int) -> None:
+        self.executable = executable
+        self.tmp_root = tmp_root
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jbig2')
+
+    def submit(self, pages: Sequence[EncodedPage]) -> Future[EncodedPageGroup]:
+        return self.executor.submit(encode_page_group, self.executable, pages, self.tmp_root)
+
+    def shutdown(self, *, cancel_futures: bool = False) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=cancel_futures)
+
+
+def create_jbig2_encoder(options: DpsPrepOptions) -> Jbig2Encoder | None:
+    if not options.jbig2:
+        return None
+
+    executable = find_jbig2enc()
+
+    if executable is None:
+        logger.error('Cannot detect jbig2enc. Bitonal images will be compressed using the default method.')
+        return None
+
+    return Jbig2Encoder(executable, options.workdir.working, options.pool_size)
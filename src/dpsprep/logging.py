@@ -1,9 +1,13 @@
-import logging
+# Rich takes a noticeable amount of time to import, so we only import it once logging is actually configured
+
+# ruff: noqa: PLC0415
 
-from rich.logging import RichHandler
+import logging
 
 
 def configure_logging(verbose: bool) -> None:
+    from rich.logging import RichHandler
+
     base_logger = logging.getLogger('dpsprep')
     base_logger.setLevel(logging.DEBUG if verbose else logging.INFO)
     base_logger.addHandler(RichHandler(log_time_format='%X'))
@@ -0,0 +1,118 @@
+import json
+import logging
+import pathlib
+from dataclasses import asdict, dataclass
+
+from dpsprep.files import write_file_atomically
+from dpsprep.options import DpsPrepOptions
+from dpsprep.page_cache import get_page_options
+from dpsprep.page_plan import PagePlan, PageSettings
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """A file in the working directory that has been completely written by a worker.
+
+    Args:
+        name: The name of the file within the working directory.
+        size: The size of the file.
+        mtime_ns: The modification time of the file in nanoseconds.
+        options: A canonical representation of the options that the file was generated with.
+
+    """
+    name: str
+    size: int
+    mtime_ns: int
+    options: str
+
+
+def get_page_bg_fingerprint(options: DpsPrepOptions, settings: PageSettings) -> str:
+    return json.dumps(get_page_options(options, settings), sort_keys=True)
+
+
+def get_text_layer_fingerprint(plan: PagePlan, chunk: range) -> str:
+    # The text layer is positioned based on the page resolution
+    return json.dumps({'dpi': [plan[i].dpi for i in chunk]})
+
+
+def write_atomically(path: pathlib.Path, data: bytes, fingerprint: str) -> ManifestEntry:
+    """Write the file atomically and return its manifest entry."""
+    write_file_atomically(path, data)
+    stat = path.stat()
+    return ManifestEntry(path.name, stat.st_size, stat.st_mtime_ns, fingerprint)
+
+
+class WorkdirManifest:
+    """A record of the completed files in a working directory, which allows resuming without reading the files.
+
+    Only the parent process writes the manifest. Every line is a separate JSON object, so an interrupted
+    write can only damage the last line, which is then ignored.
+    """
+    path: pathlib.Path
+    entries: dict[str, ManifestEntry]
+
+    def __init__(self, path: pathlib.Path, entries: dict[str, ManifestEntry]) -> None:
+        self.path = path
+        self.entries = entries
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> 'WorkdirManifest':
+        entries = {}
+
+        try:
+            lines = path.read_text(encoding='utf-8').splitlines()
+        except FileNotFoundError:
+            lines = []
+
+        for line in lines:
+            try:
+                entry = ManifestEntry(**json.loads(line))
+            except (ValueError, TypeError):
+                logger.debug(f'Ignoring invalid line in {path}.')
+                continue
+
+            entries[entry.name] = entry
+
+        manifest = cls(path, entries)
+
+        # Resumed conversions append to the manifest, so we drop the lines that are superseded or damaged
+        if len(entries) < len(lines):
+            manifest.compact()
+
+        return manifest
+
+    def is_complete(self, path: pathlib.Path, fingerprint: str) -> bool:
+        """Determine whether the file has been completely written with the given options.
+
+        The files are written atomically, so it suffices to check that the file has not been modified or replaced since,
+        which changes its size or modification time. The contents are not read.
+        """
+        entry = self.entries.get(path.name)
+
+        if entry is None or entry.options != fingerprint:
+            return False
+
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+
+        return stat.st_size == entry.size and stat.st_mtime_ns == entry.mtime_ns
+
+    def compact(self) -> None:
+        """Rewrite the manifest with a single line per file."""
+        data = ''.join(json.dumps(asdict(entry)) + '\n' for entry in self.entries.values()).encode('utf-8')
+
+        try:
+            write_file_atomically(self.path, data)
+        except OSError as err:
+            logger.debug(f'Could not compact {self.path}: {err}')
+
+    def record(self, entry: ManifestEntry) -> None:
+        self.entries[entry.name] = entry
+
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(asdict(entry)) + '\n')
@@ -0,0 +1,118 @@
+import contextlib
+import json
+import os
+import sys
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass, field
+from time import perf_counter, time
+
+from dpsprep.options import DpsPrepOptions
+
+
+try:
+    import resource
+except ImportError:
+    # The module is not available on Windows
+    resource = None  # type: ignore[assignment]
+
+
+def get_max_rss() -> int | None:
+    """Determine the peak resident set size of the current process in bytes."""
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes while other systems report kibibytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@dataclass
+class TaskMetrics:
+    """Metrics of a single task, which are gathered by the worker and sent to the parent process.
+
+    The stages of a page are "decode", "render", "encode" and "write" (or "cache" for pages reused from the page cache),
+    while the stages of a text layer chunk are "extract" and "write". Large pages that are rendered in strips are
+    rendered during the "encode" stage.
+    """
+    kind: str
+    index: int
+    stages: dict[str, float] = field(default_factory=dict)
+    mode: str | None = None
+    size: int | None = None
+    cached: bool = False
+    pid: int | None = None
+    max_rss: int | None = None
+
+    @contextlib.contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        start_time = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0) + perf_counter() - start_time
+
+    def finish(self) -> 'TaskMetrics':
+        self.pid = os.getpid()
+        self.max_rss = get_max_rss()
+        return self
+
+
+@dataclass(frozen=True)
+class StageMetrics:
+    duration: float
+    # The peak resident set size of the parent process up to the end of the stage
+    max_rss: int | None
+
+
+class ConversionMetrics:
+    """Metrics of the conversion of a document, gathered by the parent process."""
+    start_time: float
+    stages: dict[str, StageMetrics]
+    tasks: list[TaskMetrics]
+
+    def __init__(self) -> None:
+        self.start_time = time()
+        self.stages = {}
+        self.tasks = []
+
+    @contextlib.contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        start_time = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages[stage] = StageMetrics(perf_counter() - start_time, get_max_rss())
+
+    def add_task(self, task: TaskMetrics) -> None:
+        self.tasks.append(task)
+
+    def get_report(self, options: DpsPrepOptions, page_count: int) -> dict[str, object]:
+        workers: dict[int, int] = {}
+
+        # The peak memory usage of a worker only grows, but its tasks may be reported out of order
+        for task in self.tasks:
+            if task.pid is not None and task.max_rss is not None:
+                workers[task.pid] = max(workers.get(task.pid, 0), task.max_rss)
+
+        return {
+            'src': str(options.workdir.src),
+            'dest': str(options.workdir.dest),
+            'page_count': page_count,
+            'pool_size': options.pool_size,
+            'duration': time() - self.start_time,
+            'stages': {name: asdict(stage) for name, stage in self.stages.items()},
+            'max_rss': get_max_rss(),
+            'workers': [{'pid': pid, 'max_rss': max_rss} for pid, max_rss in workers.items()],
+            'tasks': [asdict(task) for task in sorted(self.tasks, key=lambda task: (task.kind, task.index))],
+        }
+
+    def write_report(self, options: DpsPrepOptions, page_count: int) -> None:
+        """Append the report as a single line to the metrics file, so that batches produce one line per document."""
+        if options.metrics_path is None:
+            return
+
+        with open(options.metrics_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(self.get_report(options, page_count)) + '\n')
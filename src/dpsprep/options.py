@@ -1,6 +1,6 @@
 import enum
 import json
-import os
+import pathlib
 import sys
 from collections.abc import Mapping
 from dataclasses import dataclass
@@ -32,11 +32,16 @@ class ImageMode(enum.StrEnum):
     RGB = 'rgb'
     GRAYSCALE = 'grayscale'
     BITONAL = 'bitonal'
+    LAYERED = 'layered'
     INFER = 'infer'
+    AUTO = 'auto'
 
 
 DEFAULT_IMAGE_MODE = ImageMode.INFER
 
+# In MiB. Pages that would need more memory for rendering are rendered and compressed in strips.
+DEFAULT_MAX_PAGE_MEMORY = 512
+
 
 @dataclass(frozen=True)
 class DpsPrepOptions:
@@ -45,12 +50,20 @@ class DpsPrepOptions:
     # Range options
     mode_overrides: RangeOptionGroup[ImageMode]
     dpi_overrides: RangeOptionGroup[int]
+    target_dpi_overrides: RangeOptionGroup[int]
     quality_overrides: RangeOptionGroup[int]
 
     # Other options
     no_text: bool
+    # In bytes, or None if the page cache is disabled
+    page_cache_size: int | None
+    in_memory: bool
+    jbig2: bool
+    max_page_memory: int
     pool_size: int
     verbose: bool
+    metrics_path: pathlib.Path | None
+    profile_dir: pathlib.Path | None
     ocr_options: JsonObject | None
     optlevel: int | None
 
@@ -165,13 +178,3 @@ class QualityOverridesClickType(click.ParamType):
                 self.fail(f'Expected quality option to be between 1 and 100, but got {range_option.value}', param, ctx)
 
         return group
-
-
-def get_default_pool_size() -> int:
-    if sys.version_info < (3, 13):
-        if cpu_count := os.cpu_count():
-            return 2 * cpu_count
-    elif lcpu_count := os.process_cpu_count():
-        return lcpu_count
-
-    return 1
@@ -9,7 +9,7 @@ import djvu.decode
 import djvu.sexpr
 from fpdf import FPDF
 
-from dpsprep.options import DpsPrepOptions
+from dpsprep.page_plan import PagePlan
 
 from .sexpr_visitor import SExpressionVisitor
 
@@ -166,7 +166,8 @@ class TextDrawVisitor(SExpressionVisitor):
     visit_list_region = visit_list_column
 
 
-def extract_text_as_fpdf(document: djvu.decode.Document, options: DpsPrepOptions) -> FPDF:
+def extract_text_as_fpdf(document: djvu.decode.Document, plan: PagePlan, page_indices: Iterable[int] | None = None) -> FPDF:
+    """Draw the text layers of the given pages (by default, all pages) into a new FPDF document. The plan must cover these pages."""
     pdf = FPDF(unit='in')
     pdf.add_font(
         family='Invisible',
@@ -174,9 +175,10 @@ def extract_text_as_fpdf(document: djvu.decode.Document, options: DpsPrepOptions
         style='',
     )
 
-    for i, page in enumerate(document.pages):
+    for i in range(len(document.pages)) if page_indices is None else page_indices:
+        page = document.pages[i]
         page_job = page.decode(wait=True)
-        page_dpi = options.dpi_overrides.get_value_for_zero_based_page(i) or page_job.dpi
+        page_dpi = plan[i].dpi or page_job.dpi
         pdf.add_page(format=(page_job.width / page_dpi, page_job.height / page_dpi))
         logger.debug(f'Processing text for page {i + 1}.')
         visitor = TextDrawVisitor(pdf, page_dpi)
@@ -0,0 +1,319 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from collections import OrderedDict
+from collections.abc import Iterator, Mapping
+from typing import BinaryIO, NamedTuple
+
+import djvu.decode
+
+from dpsprep.files import write_file_atomically
+from dpsprep.images import EncodedPage
+from dpsprep.options import DpsPrepOptions
+from dpsprep.page_plan import PageSettings
+
+
+# Bump this whenever the rendering or encoding changes in a way that invalidates cached pages
+PAGE_CACHE_VERSION = 1
+
+IFF_MAGIC = b'AT&T'
+IFF_HEADER_SIZE = 8
+
+logger = logging.getLogger(__name__)
+
+
+class IffChunk(NamedTuple):
+    id: bytes
+    # The offset of the chunk header
+    offset: int
+    # The size of the chunk data, excluding the header
+    size: int
+
+
+def iter_iff_chunks(file: BinaryIO, start: int, end: int) -> Iterator[IffChunk]:
+    """Iterate over the IFF chunks between the given offsets without reading their contents."""
+    offset = start
+
+    while offset + IFF_HEADER_SIZE <= end:
+        file.seek(offset)
+        header = file.read(IFF_HEADER_SIZE)
+
+        if len(header) < IFF_HEADER_SIZE:
+            return
+
+        size = int.from_bytes(header[4:], 'big')
+        yield IffChunk(header[:4], offset, size)
+        # Chunks are aligned to even offsets
+        offset += IFF_HEADER_SIZE + size + (size & 1)
+
+
+class DjvuComponentIndex:
+    """Locate the raw data of the component files of a DjVu document.
+
+    Bundled documents store their components as nested FORM chunks in the same order as their directory, which is
+    also the order of Document.files. Indirect documents store every component in a separate file next to the index.
+    """
+    path: pathlib.Path
+    offsets: Mapping[str, IffChunk]
+
+    def __init__(self, path: pathlib.Path, offsets: Mapping[str, IffChunk]) -> None:
+        self.path = path
+        self.offsets = offsets
+
+    def read(self, file_id: str) -> bytes | None:
+        if file_id in self.offsets:
+            chunk = self.offsets[file_id]
+
+            with open(self.path, 'rb') as file:
+                file.seek(chunk.offset)
+                return file.read(IFF_HEADER_SIZE + chunk.size)
+
+        try:
+            return (self.path.parent / file_id).read_bytes()
+        except OSError:
+            return None
+
+
+def read_djvu_component_index(path: pathlib.Path, document: djvu.decode.Document) -> DjvuComponentIndex | None:
+    with open(path, 'rb') as file:
+        if file.read(len(IFF_MAGIC)) != IFF_MAGIC:
+            return None
+
+        (form,) = iter_iff_chunks(file, len(IFF_MAGIC), len(IFF_MAGIC) + IFF_HEADER_SIZE)
+        form_type = file.read(4)
+
+        if form.id != b'FORM':
+            return None
+
+        # Single-page documents consist of the page itself
+        if form_type == b'DJVU':
+            return DjvuComponentIndex(path, {'': form})
+
+        if form_type != b'DJVM':
+            return None
+
+        components = [
+            chunk for chunk in iter_iff_chunks(file, form.offset + IFF_HEADER_SIZE + 4, form.offset + IFF_HEADER_SIZE + form.size)
+            if chunk.id == b'FORM'
+        ]
+
+    files = list(document.files)
+
+    # Indirect documents contain only the directory
+    if len(components) == 0:
+        return DjvuComponentIndex(path, {})
+
+    if len(components) != len(files):
+        logger.debug(f'Could not match the {len(components)} components of {path} with its {len(files)} files.')
+        return None
+
+    return DjvuComponentIndex(path, {file.id: chunk for file, chunk in zip(files, components, strict=True)})
+
+
+# Workers open at most two documents at a time
+MAX_CACHED_COMPONENT_INDEXES = 2
+
+# The daemon keeps its workers while files are replaced between jobs, so the indexes are identified by the path
+# together with the modification time and size of the file
+component_indexes: OrderedDict[tuple[pathlib.Path, int, int], DjvuComponentIndex | None] = OrderedDict()
+
+
+def get_djvu_component_index(path: pathlib.Path, document: djvu.decode.Document) -> DjvuComponentIndex | None:
+    """Read the component index of the file or reuse the one that has already been read by this process."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+
+    key = (path, stat.st_mtime_ns, stat.st_size)
+
+    if key in component_indexes:
+        component_indexes.move_to_end(key)
+        return component_indexes[key]
+
+    try:
+        index = read_djvu_component_index(path, document)
+    except (OSError, ValueError):
+        logger.debug(f'Could not read the structure of {path}.')
+        index = None
+
+    component_indexes[key] = index
+
+    while len(component_indexes) > MAX_CACHED_COMPONENT_INDEXES:
+        component_indexes.popitem(last=False)
+
+    return index
+
+
+def iter_included_ids(component: bytes) -> Iterator[str]:
+    """Find the INCL chunks of a component, which refer to shared components like JB2 dictionaries."""
+    # The component is a FORM chunk with a four-byte type
+    offset = IFF_HEADER_SIZE + 4
+
+    while offset + IFF_HEADER_SIZE <= len(component):
+        size = int.from_bytes(component[offset + 4:offset + IFF_HEADER_SIZE], 'big')
+
+        if component[offset:offset + 4] == b'INCL':
+            yield component[offset + IFF_HEADER_SIZE:offset + IFF_HEADER_SIZE + size].decode('utf-8', errors='replace').strip()
+
+        offset += IFF_HEADER_SIZE + size + (size & 1)
+
+
+def read_page_components(index: DjvuComponentIndex, file_id: str) -> list[bytes] | None:
+    """Read the page component and all components that it includes, directly or indirectly."""
+    pending = [file_id]
+    visited = set()
+    components = []
+
+    while pending:
+        current = pending.pop()
+
+        if current in visited:
+            continue
+
+        visited.add(current)
+        component = index.read(current)
+
+        if component is None:
+            return None
+
+        components.append(component)
+        pending.extend(iter_included_ids(component))
+
+    return components
+
+
+def get_page_options(options: DpsPrepOptions, settings: PageSettings) -> dict[str, object]:
+    """Determine the options that affect the encoded image of a page."""
+    return {
+        'version': PAGE_CACHE_VERSION,
+        'mode': settings.mode,
+        'dpi': settings.dpi,
+        'target_dpi': settings.target_dpi,
+        'quality': settings.quality,
+        'jbig2': options.jbig2,
+        'max_page_memory': options.max_page_memory,
+    }
+
+
+def get_page_cache_size(options: DpsPrepOptions) -> int | None:
+    """Determine the size limit of the page cache in bytes, or None if the cache is disabled."""
+    # In-memory conversions avoid writing every page to disk, which the cache would defeat
+    return None if options.in_memory else options.page_cache_size
+
+
+def get_page_cache_key(options: DpsPrepOptions, settings: PageSettings, document: djvu.decode.Document, i: int) -> str | None:
+    """Determine a key that identifies the encoded image of a page based on its data and the options used for it.
+
+    Identical pages in different documents (e.g. different editions of the same book) have the same key.
+    Returns None if the cache is disabled or if the page data cannot be located.
+    """
+    if get_page_cache_size(options) is None:
+        return None
+
+    index = get_djvu_component_index(options.workdir.src, document)
+
+    if index is None:
+        return None
+
+    file_id = '' if '' in index.offsets else document.pages[i].file.id
+    components = read_page_components(index, file_id)
+
+    if components is None:
+        return None
+
+    page_hash = hashlib.blake2b(digest_size=20)
+    page_hash.update(json.dumps(get_page_options(options, settings), sort_keys=True).encode('utf-8'))
+
+    for component in components:
+        page_hash.update(len(component).to_bytes(8, 'big'))
+        page_hash.update(component)
+
+    return page_hash.hexdigest()
+
+
+class PageCache:
+    """A content-addressed store of encoded pages that is shared between conversions.
+
+    Reading an entry updates its modification time, which determines the order in which prune removes the entries.
+    Access times are not used because they are often not recorded.
+    """
+    root: pathlib.Path
+
+    def __init__(self, root: pathlib.Path) -> None:
+        self.root = root
+
+    def get_path(self, key: str) -> pathlib.Path:
+        # Spread the entries over subdirectories to keep the directories small
+        return self.root / key[:2] / f'{key}.img'
+
+    def get(self, key: str) -> bytes | None:
+        path = self.get_path(key)
+
+        try:
+            data = path.read_bytes()
+            EncodedPage.deserialize(data)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            os.utime(path)
+        except OSError as err:
+            logger.debug(f'Could not mark page {key} in the cache as used: {err}')
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Several workers may store the same page concurrently, so the entry must appear atomically
+        write_file_atomically(path, data)
+
+    def try_put(self, key: str, data: bytes) -> None:
+        """Store the page unless the cache cannot be written to, since the cache is not essential."""
+        try:
+            self.put(key, data)
+        except OSError as err:
+            logger.debug(f'Could not store page {key} in the cache: {err}')
+
+    def prune(self, max_size: int) -> None:
+        """Remove the least recently used entries until the total size of the cache is at most max_size bytes.
+
+        Temporary files left behind by killed workers are removed the same way.
+        """
+        entries = []
+
+        for path in self.root.glob('*/*'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        removed_count = 0
+
+        for _, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+
+            try:
+                path.unlink()
+            except OSError as err:
+                logger.debug(f'Could not remove {path} from the page cache: {err}')
+            else:
+                total_size -= size
+                removed_count += 1
+
+        if removed_count > 0:
+            logger.debug(f'Removed the {removed_count} least recently used pages from the page cache.')
+
+
+def prune_page_cache(options: DpsPrepOptions) -> None:
+    """Keep the page cache within its size limit. The parent process does this once per conversion."""
+    if (max_size := get_page_cache_size(options)) is not None:
+        PageCache(options.workdir.page_cache_path).prune(max_size)
@@ -0,0 +1,122 @@
+from array import array
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from typing import TypeVar
+
+from dpsprep.options import DEFAULT_IMAGE_MODE, DpsPrepOptions, ImageMode
+from dpsprep.range import RangeOptionGroup
+
+
+T = TypeVar('T')
+
+IMAGE_MODES = list(ImageMode)
+
+# The arrays store absent values as zero, which is not a valid DPI or quality
+ABSENT = 0
+
+
+@dataclass(frozen=True)
+class PageSettings:
+    """The effective settings of a single page after applying the range options."""
+    mode: ImageMode
+    dpi: int | None
+    target_dpi: int | None
+    quality: int | None
+
+    def __str__(self) -> str:
+        parts = [str(self.mode)]
+
+        if self.dpi is not None:
+            parts.append(f'DPI {self.dpi}')
+
+        if self.target_dpi is not None:
+            parts.append(f'target DPI {self.target_dpi}')
+
+        if self.quality is not None:
+            parts.append(f'quality {self.quality}')
+
+        return ', '.join(parts)
+
+
+def paint_range_group(values: array, group: RangeOptionGroup[T], first_page: int, encode: Callable[[T], int]) -> None:
+    """Assign the values of the group to the pages in its ranges, starting with the zero-based page first_page."""
+    # The first matching range takes precedence, so we paint the ranges in reverse order
+    for range_ in reversed(group.ranges):
+        start = 0 if range_.start is None else max(range_.start - 1 - first_page, 0)
+        end = len(values) if range_.end is None else min(range_.end - first_page, len(values))
+
+        if start < end:
+            values[start:end] = array(values.typecode, [encode(range_.value)]) * (end - start)
+
+
+@dataclass(frozen=True)
+class PagePlan:
+    """The settings of consecutive pages of a document, compiled once from the range options.
+
+    Looking up the value of a range option requires going through all its ranges, which adds up for long documents
+    with many ranges. The plan stores one compact entry per page instead. Workers receive the part of the plan
+    that covers the pages of their task.
+    """
+    first_page: int
+    modes: array
+    dpis: array
+    target_dpis: array
+    qualities: array
+
+    @classmethod
+    def compile(cls, options: DpsPrepOptions, pages: range) -> 'PagePlan':
+        count = len(pages)
+        modes = array('B', [IMAGE_MODES.index(DEFAULT_IMAGE_MODE)]) * count
+        dpis = array('I', [ABSENT]) * count
+        target_dpis = array('I', [ABSENT]) * count
+        qualities = array('B', [ABSENT]) * count
+
+        paint_range_group(modes, options.mode_overrides, pages.start, IMAGE_MODES.index)
+        paint_range_group(dpis, options.dpi_overrides, pages.start, int)
+        paint_range_group(target_dpis, options.target_dpi_overrides, pages.start, int)
+        paint_range_group(qualities, options.quality_overrides, pages.start, int)
+
+        return cls(pages.start, modes, dpis, target_dpis, qualities)
+
+    @property
+    def pages(self) -> range:
+        return range(self.first_page, self.first_page + len(self.modes))
+
+    def __getitem__(self, i: int) -> PageSettings:
+        """Get the settings of the zero-based page i."""
+        if i not in self.pages:
+            raise IndexError(f'The plan for pages {self.first_page + 1} to {self.pages.stop} does not cover page {i + 1}.')
+
+        k = i - self.first_page
+
+        return PageSettings(
+            mode=IMAGE_MODES[self.modes[k]],
+            dpi=self.dpis[k] or None,
+            target_dpi=self.target_dpis[k] or None,
+            quality=self.qualities[k] or None,
+        )
+
+    def restrict(self, pages: range) -> 'PagePlan':
+        """Get the part of the plan that covers the given pages, e.g. in order to pass it to a worker."""
+        start = pages.start - self.first_page
+        stop = pages.stop - self.first_page
+
+        if start < 0 or stop > len(self.modes):
+            raise IndexError(f'The plan for pages {self.first_page + 1} to {self.pages.stop} does not cover pages {pages.start + 1} to {pages.stop}.')
+
+        return PagePlan(pages.start, self.modes[start:stop], self.dpis[start:stop], self.target_dpis[start:stop], self.qualities[start:stop])
+
+    def iter_runs(self) -> Iterator[tuple[range, PageSettings]]:
+        """Iterate over the maximal runs of consecutive pages with identical settings."""
+        start = self.first_page
+
+        for i in self.pages[1:]:
+            if self[i] != self[start]:
+                yield range(start, i), self[start]
+                start = i
+
+        if len(self.pages) > 0:
+            yield range(start, self.pages.stop), self[start]
+
+    def describe(self) -> str:
+        return '; '.join(f'pages {run.start + 1} to {run.stop}: {settings}' for run, settings in self.iter_runs())
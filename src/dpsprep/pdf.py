@@ -1,43 +1,429 @@
 import pathlib
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, replace
+from typing import BinaryIO
 
 import pdfrw
+from pdfrw.pdfwriter import user_fmt
 
+from dpsprep.images import EncodedPage, EncodedPageImage, encode_bitonal_image
+from dpsprep.jbig2 import JBIG2_BATCH_SIZE, EncodedPageGroup, Jbig2Encoder, create_jbig2_encoder, is_jbig2_candidate
 from dpsprep.options import DpsPrepOptions
+from dpsprep.workdir import get_text_layer_chunks
 
 
-def is_valid_pdf(path: pathlib.Path) -> bool:
-    try:
-        pdfrw.PdfReader(path)
-    except pdfrw.errors.PdfParseError:
-        return False
+def get_image_xobject_name(k: int) -> pdfrw.PdfName:
+    return pdfrw.PdfName(f'DpsPrepImage{k}')
+
+
+def create_stream(data: str | bytes, **kwargs: object) -> pdfrw.IndirectPdfDict:
+    result = pdfrw.IndirectPdfDict(**kwargs)
+    # pdfrw represents binary data as Latin-1 strings
+    result.stream = data if isinstance(data, str) else data.decode('latin-1')
+    return result
+
+
+def create_image_xobject(image: EncodedPageImage, jbig2_globals: pdfrw.PdfDict | None = None, *, is_mask: bool = False) -> pdfrw.IndirectPdfDict:
+    if jbig2_globals is not None:
+        decode_parms = pdfrw.PdfDict(JBIG2Globals=jbig2_globals)
+    elif image.decode_parms is not None:
+        decode_parms = pdfrw.PdfDict(**image.decode_parms)
     else:
-        return True
+        decode_parms = None
+
+    return create_stream(
+        image.data,
+        Type=pdfrw.PdfName.XObject,
+        Subtype=pdfrw.PdfName.Image,
+        Width=image.width,
+        Height=image.height,
+        # Image masks have no color space. With the default decode array, the black pixels are painted.
+        ColorSpace=None if is_mask else pdfrw.PdfName(image.color_space),
+        ImageMask=True if is_mask else None,
+        Mask=None if image.mask is None else create_image_xobject(image.mask, is_mask=True),
+        BitsPerComponent=image.bits_per_component,
+        Filter=None if image.filter is None else pdfrw.PdfName(image.filter),
+        DecodeParms=decode_parms,
+    )
+
+
+def create_page_xobjects(page: EncodedPage, jbig2_globals: pdfrw.PdfDict | None = None) -> dict[pdfrw.PdfName, pdfrw.IndirectPdfDict]:
+    # Only pages consisting of a single bitonal image are compressed via JBIG2
+    return {
+        get_image_xobject_name(k): create_image_xobject(image, jbig2_globals if k == 0 else None)
+        for k, image in enumerate(page.layers)
+    }
+
+
+def get_page_size(page: EncodedPage) -> tuple[float, float]:
+    return (
+        round(page.width * 72 / page.resolution, 4),
+        round(page.height * 72 / page.resolution, 4),
+    )
+
+
+def get_image_placement(page: EncodedPage, image: EncodedPageImage) -> tuple[float, float, float]:
+    """Determine the width, height and vertical offset of the image on the page."""
+    # Layers are stretched over the entire page, regardless of their resolution
+    if image.top is None:
+        width, height = get_page_size(page)
+        return (width, height, 0)
+
+    # Strips are placed at their full-resolution size. PDF measures the offset from the bottom of the page.
+    return (
+        round(image.width * 72 / page.resolution, 4),
+        round(image.height * 72 / page.resolution, 4),
+        round((page.height - image.top - image.height) * 72 / page.resolution, 4),
+    )
+
+
+def get_page_drawing_operators(page: EncodedPage) -> str:
+    operators = []
+
+    for k, image in enumerate(page.layers):
+        width, height, offset = get_image_placement(page, image)
+        operators.append(f'q {width} 0 0 {height} 0 {offset} cm {get_image_xobject_name(k)} Do Q')
+
+    return ' '.join(operators)
+
+
+def create_image_page(page: EncodedPage, jbig2_globals: pdfrw.PdfDict | None = None) -> pdfrw.PdfDict:
+    width, height = get_page_size(page)
+
+    return pdfrw.PdfDict(
+        Type=pdfrw.PdfName.Page,
+        MediaBox=pdfrw.PdfArray([0, 0, width, height]),
+        Resources=pdfrw.PdfDict(
+            XObject=pdfrw.PdfDict(create_page_xobjects(page, jbig2_globals)),
+        ),
+        Contents=create_stream(get_page_drawing_operators(page)),
+    )
+
+
+def add_image_to_page(page: pdfrw.PdfDict, image_page: EncodedPage, jbig2_globals: pdfrw.PdfDict | None = None) -> None:
+    """Draw the page images on top of the existing contents of the page."""
+    resources = page.inheritable.Resources or pdfrw.PdfDict()
+    xobjects = pdfrw.PdfDict(resources.XObject or {})
+    xobjects.update(create_page_xobjects(image_page, jbig2_globals))
+
+    # The resource dictionaries may be shared between pages, so we copy them instead of modifying them
+    page.Resources = pdfrw.PdfDict(resources, XObject=xobjects)
+
+    match page.Contents:
+        case None:
+            existing = []
+
+        case pdfrw.PdfArray() as contents:
+            existing = list(contents)
+
+        case contents:
+            existing = [contents]
+
+    # We isolate the existing contents so that they cannot modify the graphics state used for the images
+    page.Contents = pdfrw.PdfArray([
+        create_stream('q'),
+        *existing,
+        create_stream('Q ' + get_page_drawing_operators(image_page)),
+    ])
+
+
+class StreamingPdfWriter:
+    """A PDF writer that outputs the objects of every page as soon as the page is added.
+
+    pdfrw's PdfWriter keeps every object in memory until the entire file is written, so its memory usage
+    grows linearly with the number of pages. Here, only the object numbers are retained. The catalog and
+    the page tree have reserved object numbers, and they are written last, along with the outline.
+
+    Objects are identified via id(), so the writer holds a reference to every object it has numbered in
+    order to prevent the identifiers from being reused. Call forget_objects() once the objects that
+    have been written can no longer be shared with subsequent pages.
+    """
+    CATALOG_NUMBER = 1
+    PAGE_TREE_NUMBER = 2
+
+    file: BinaryIO
+    offset: int
+    object_offsets: list[int]
+    object_numbers: dict[int, tuple[object, int]]
+    page_numbers: list[int]
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.offset = 0
+        self.object_offsets = [0, 0]
+        self.object_numbers = {}
+        self.page_numbers = []
+        self.write('%PDF-1.3\n%\xe2\xe3\xcf\xd3\n')
+
+    def write(self, string: str) -> None:
+        data = string.encode('latin-1')
+        self.file.write(data)
+        self.offset += len(data)
+
+    def write_object(self, number: int, body: str) -> None:
+        self.object_offsets[number - 1] = self.offset
+        self.write(f'{number} 0 obj\n{body}\nendobj\n')
+
+    def reference(self, obj: object, pending: list[tuple[int, object]]) -> str:
+        if (known := self.object_numbers.get(id(obj))) is not None:
+            return f'{known[1]} 0 R'
+
+        self.object_offsets.append(0)
+        number = len(self.object_offsets)
+        self.object_numbers[id(obj)] = (obj, number)
+        pending.append((number, obj))
+        return f'{number} 0 R'
+
+    def format(self, obj: object, pending: list[tuple[int, object]]) -> str:
+        # Stream objects must always be indirect
+        if isinstance(obj, pdfrw.PdfDict):
+            indirect = obj.indirect or obj.stream is not None
+        else:
+            indirect = getattr(obj, 'indirect', False)
+
+        if indirect:
+            return self.reference(obj, pending)
+
+        return self.format_direct(obj, pending)
+
+    def format_direct(self, obj: object, pending: list[tuple[int, object]]) -> str:
+        if isinstance(obj, pdfrw.PdfDict):
+            pairs = sorted((getattr(key, 'encoded', None) or key, value) for key, value in obj.iteritems())
+            result = '<<' + ' '.join(f'{key} {self.format(value, pending)}' for key, value in pairs) + '>>'
+
+            if obj.stream is not None:
+                return f'{result}\nstream\n{obj.stream}\nendstream'
+
+            return result
+
+        if isinstance(obj, dict):
+            return self.format_direct(pdfrw.PdfDict(obj), pending)
+
+        if isinstance(obj, list | tuple):
+            return '[' + ' '.join(self.format(item, pending) for item in obj) + ']'
+
+        # pdfrw objects with an "indirect" attribute know how to represent themselves
+        if hasattr(obj, 'indirect'):
+            return str(getattr(obj, 'encoded', None) or obj)
+
+        # pdfrw's formatter does not know about PDF booleans
+        if isinstance(obj, bool):
+            return 'true' if obj else 'false'
+
+        return user_fmt(obj)
+
+    def write_pending(self, pending: list[tuple[int, object]]) -> None:
+        while pending:
+            number, obj = pending.pop()
+            self.write_object(number, self.format_direct(obj, pending))
+
+    def add_page(self, page: pdfrw.PdfDict) -> None:
+        if page.Type != pdfrw.PdfName.Page:
+            raise pdfrw.errors.PdfOutputError(f'Bad /Type: Expected {pdfrw.PdfName.Page}, found {page.Type}')
+
+        inheritable = page.inheritable
+        new_page = pdfrw.PdfDict(
+            page,
+            Resources=inheritable.Resources,
+            MediaBox=inheritable.MediaBox,
+            CropBox=inheritable.CropBox,
+            Rotate=inheritable.Rotate,
+        )
+        new_page.Parent = pdfrw.PdfObject(f'{self.PAGE_TREE_NUMBER} 0 R')
+
+        pending: list[tuple[int, object]] = []
+        self.reference(new_page, pending)
+        self.page_numbers.append(pending[0][0])
+        self.write_pending(pending)
+
+    def forget_objects(self) -> None:
+        self.object_numbers.clear()
+
+    def close(self, outline: pdfrw.PdfDict) -> None:
+        pending: list[tuple[int, object]] = []
+        outline_ref = self.reference(outline, pending)
+        self.write_pending(pending)
+
+        kids = ' '.join(f'{number} 0 R' for number in self.page_numbers)
+        self.write_object(self.PAGE_TREE_NUMBER, f'<</Count {len(self.page_numbers)} /Kids [{kids}] /Type /Pages>>')
+        self.write_object(self.CATALOG_NUMBER, f'<</Outlines {outline_ref} /Pages {self.PAGE_TREE_NUMBER} 0 R /Type /Catalog>>')
+
+        xref_offset = self.offset
+        self.write(f'xref\n0 {len(self.object_offsets) + 1}\n')
+        self.write('0000000000 65535 f\r\n')
+        self.write(''.join(f'{offset:010} 00000 n\r\n' for offset in self.object_offsets))
+        self.write(f'trailer\n\n<</Root {self.CATALOG_NUMBER} 0 R /Size {len(self.object_offsets) + 1}>>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self.forget_objects()
+
+
+@dataclass(frozen=True)
+class PendingPageGroup:
+    pages: Future[EncodedPageGroup]
+    text_pages: list[pdfrw.PdfDict | None]
+
+
+def get_completed_future(group: EncodedPageGroup) -> Future[EncodedPageGroup]:
+    future = Future[EncodedPageGroup]()
+    future.set_result(group)
+    return future
+
+
+class IncrementalPdfCombiner:
+    """Combine page images and text layer chunks in page order as soon as they become available.
+
+    The parts can arrive in any order. Those that cannot be written yet are kept in memory until all
+    preceding pages have been written, so the pages should be supplied roughly in order.
+
+    If a JBIG2 encoder is given, consecutive uncompressed bitonal images are compressed in batches
+    in the background, while the following pages wait in a queue.
+    """
+    writer: StreamingPdfWriter
+    page_count: int
+    with_text: bool
+    jbig2_encoder: Jbig2Encoder | None
+
+    next_page: int
+    page_images: dict[int, EncodedPage]
+    text_pages: dict[int, pdfrw.PdfDict]
+    text_chunk_ends: set[int]
+
+    jbig2_batch: list[tuple[EncodedPage, pdfrw.PdfDict | None]]
+    pending_groups: deque[PendingPageGroup]
+    written_pages: int
+
+    def __init__(self, file: BinaryIO, page_count: int, *, with_text: bool, jbig2_encoder: Jbig2Encoder | None = None) -> None:
+        self.writer = StreamingPdfWriter(file)
+        self.page_count = page_count
+        self.with_text = with_text
+        self.jbig2_encoder = jbig2_encoder
+
+        self.next_page = 0
+        self.page_images = {}
+        self.text_pages = {}
+        self.text_chunk_ends = set()
+
+        self.jbig2_batch = []
+        self.pending_groups = deque()
+        self.written_pages = 0
+
+    def add_page_image(self, i: int, page: EncodedPage) -> None:
+        self.page_images[i] = page
+        self.flush()
+
+    def add_text_layer_pdf(self, chunk_start: int, data: bytes | pathlib.Path) -> None:
+        pages = read_pdf(data).pages
+        self.text_pages.update(enumerate(pages, start=chunk_start))
+        self.text_chunk_ends.add(chunk_start + len(pages))
+        self.flush()
+
+    def flush(self) -> None:
+        while self.next_page in self.page_images and (not self.with_text or self.next_page in self.text_pages):
+            i = self.next_page
+            page = self.page_images.pop(i)
+            text_page = self.text_pages.pop(i) if self.with_text else None
+            self.next_page += 1
+
+            if not is_jbig2_candidate(page):
+                self.submit_jbig2_batch()
+                self.pending_groups.append(PendingPageGroup(get_completed_future(EncodedPageGroup([page])), [text_page]))
+            elif self.jbig2_encoder is None:
+                self.submit_jbig2_batch()
+                bitonal_page = replace(page, layers=[encode_bitonal_image(page.layers[0])])
+                self.pending_groups.append(PendingPageGroup(get_completed_future(EncodedPageGroup([bitonal_page])), [text_page]))
+            else:
+                self.jbig2_batch.append((page, text_page))
+
+                if self.next_page % JBIG2_BATCH_SIZE == 0 or self.next_page == self.page_count:
+                    self.submit_jbig2_batch()
+
+        self.write_pending_groups(wait=False)
+
+    def submit_jbig2_batch(self) -> None:
+        if not self.jbig2_batch:
+            return
+
+        assert self.jbig2_encoder is not None
+        pages, text_pages = zip(*self.jbig2_batch, strict=True)
+        self.pending_groups.append(PendingPageGroup(self.jbig2_encoder.submit(pages), list(text_pages)))
+        self.jbig2_batch = []
+
+    def write_pending_groups(self, *, wait: bool) -> None:
+        while self.pending_groups and (wait or self.pending_groups[0].pages.done()):
+            pending = self.pending_groups.popleft()
+            group = pending.pages.result()
+            jbig2_globals = None if group.jbig2_globals is None else create_stream(group.jbig2_globals)
+
+            for page, text_page in zip(group.pages, pending.text_pages, strict=True):
+                if text_page is None:
+                    self.writer.add_page(create_image_page(page, jbig2_globals))
+                else:
+                    # We take the one-page text PDF and add the image layer on top
+                    # Even if the font was not invisible, it would be hidden visually (but not during search or text highlight)
+                    add_image_to_page(text_page, page, jbig2_globals)
+                    self.writer.add_page(text_page)
+
+            self.written_pages += len(group.pages)
+
+            # The pages of a text layer chunk share their fonts, so we can only forget the objects after the entire chunk is written
+            # Similarly, the pages of a JBIG2 group share their symbol dictionary
+            if not self.with_text or self.written_pages in self.text_chunk_ends:
+                self.writer.forget_objects()
+
+    def close(self, outline: pdfrw.PdfDict) -> None:
+        if self.next_page != self.page_count:
+            raise pdfrw.errors.PdfOutputError(f'Expected {self.page_count} pages, but only the first {self.next_page} are available')
+
+        self.submit_jbig2_batch()
+        self.write_pending_groups(wait=True)
+
+        if self.jbig2_encoder is not None:
+            self.jbig2_encoder.shutdown()
+
+        self.writer.close(outline)
+
+    def abort(self) -> None:
+        if self.jbig2_encoder is not None:
+            self.jbig2_encoder.shutdown(cancel_futures=True)
+
+
+def read_pdf(data: bytes | pathlib.Path) -> pdfrw.PdfReader:
+    if isinstance(data, pathlib.Path):
+        return pdfrw.PdfReader(data)
+
+    return pdfrw.PdfReader(fdata=data)
+
+
+def read_page_image(path: pathlib.Path) -> EncodedPage:
+    return EncodedPage.deserialize(path.read_bytes())
+
 
+def combine_pdfs_on_fs_with_text(options: DpsPrepOptions, outline: pdfrw.IndirectPdfDict, max_page: int) -> None:
+    with open(options.workdir.combined_pdf_path, 'wb') as file:
+        combiner = IncrementalPdfCombiner(file, max_page, with_text=True, jbig2_encoder=create_jbig2_encoder(options))
 
-def combine_pdfs_on_fs_with_text(options: DpsPrepOptions, outline: pdfrw.IndirectPdfDict) -> None:
-    text_pdf = pdfrw.PdfReader(options.workdir.text_layer_pdf_path)
-    writer = pdfrw.PdfWriter()
+        try:
+            for chunk in get_text_layer_chunks(max_page):
+                combiner.add_text_layer_pdf(chunk.start, options.workdir.get_text_layer_pdf_path(chunk))
 
-    for i, text_page in enumerate(text_pdf.pages):
-        # We take the one-page text PDF and add the image layer on top
-        # Even if the font was not invisible, it would be hidden visually (but not during search or text highlight)
-        image_pdf = pdfrw.PdfReader(options.workdir.get_page_pdf_path(i))
-        image_page = image_pdf.pages[0]
-        merger = pdfrw.PageMerge(text_page)
-        merger.add(image_page).render()
-        writer.addpage(text_page)
+                for i in chunk:
+                    combiner.add_page_image(i, read_page_image(options.workdir.get_page_image_path(i)))
 
-    writer.trailer.Root.Outlines = outline
-    writer.write(options.workdir.combined_pdf_path)
+            combiner.close(outline)
+        except BaseException:
+            combiner.abort()
+            raise
 
 
 def combine_pdfs_on_fs_without_text(options: DpsPrepOptions, outline: pdfrw.IndirectPdfDict, max_page: int) -> None:
-    writer = pdfrw.PdfWriter()
+    with open(options.workdir.combined_pdf_without_text_path, 'wb') as file:
+        combiner = IncrementalPdfCombiner(file, max_page, with_text=False, jbig2_encoder=create_jbig2_encoder(options))
 
-    for i in range(max_page):
-        image_pdf = pdfrw.PdfReader(options.workdir.get_page_pdf_path(i))
-        image_page = image_pdf.pages[0]
-        writer.addpage(image_page)
+        try:
+            for i in range(max_page):
+                combiner.add_page_image(i, read_page_image(options.workdir.get_page_image_path(i)))
 
-    writer.trailer.Root.Outlines = outline
-    writer.write(options.workdir.combined_pdf_without_text_path)
+            combiner.close(outline)
+        except BaseException:
+            combiner.abort()
+            raise
@@ -0,0 +1,119 @@
+import contextlib
+import cProfile
+import logging
+import os
+import pathlib
+import pstats
+import threading
+from collections.abc import Iterator
+from time import monotonic
+
+
+PROFILE_SUFFIX = '.prof'
+PARENT_PROFILE_NAME = 'parent'
+MERGED_PROFILE_NAME = 'merged'
+# Workers are terminated rather than shut down when a conversion fails, so they also write their profiles every so often (in seconds)
+WORKER_PROFILE_DUMP_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class SectionProfiler:
+    """A profiler that only runs within explicit sections, which may span several tasks or documents."""
+    path: pathlib.Path
+    profile: cProfile.Profile
+    last_dump_time: float
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.last_dump_time = monotonic()
+
+    @contextlib.contextmanager
+    def section(self) -> Iterator[None]:
+        self.profile.enable()
+
+        try:
+            yield
+        finally:
+            self.profile.disable()
+
+    def dump(self) -> None:
+        self.profile.dump_stats(self.path)
+        self.last_dump_time = monotonic()
+
+
+# There is at most one profiler per file in every process
+profilers: dict[pathlib.Path, SectionProfiler] = {}
+
+
+def get_profiler(profile_dir: pathlib.Path, name: str) -> SectionProfiler:
+    path = profile_dir / f'{name}{PROFILE_SUFFIX}'
+
+    if path not in profilers:
+        profilers[path] = SectionProfiler(path)
+
+    return profilers[path]
+
+
+def get_worker_profile_name() -> str:
+    return f'worker-{os.getpid()}'
+
+
+def dump_profiles() -> None:
+    """Write the profiles of the current process, e.g. when a worker shuts down."""
+    for profiler in profilers.values():
+        profiler.dump()
+
+
+@contextlib.contextmanager
+def profile_section(profile_dir: pathlib.Path | None, name: str, *, dump_interval: float | None = None) -> Iterator[None]:
+    """Profile the section if profiling is enabled.
+
+    If dump_interval is given, the profile is also written after the section if the previous write is at least that many seconds ago.
+    Only the main thread enables the profilers, since a profiler cannot be enabled by several threads at once.
+    """
+    if profile_dir is None or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    profiler = get_profiler(profile_dir, name)
+
+    with profiler.section():
+        yield
+
+    if dump_interval is not None and monotonic() - profiler.last_dump_time >= dump_interval:
+        profiler.dump()
+
+
+def merge_profiles(profile_dir: pathlib.Path) -> pathlib.Path | None:
+    merged_path = profile_dir / f'{MERGED_PROFILE_NAME}{PROFILE_SUFFIX}'
+    paths = sorted(path for path in profile_dir.glob(f'*{PROFILE_SUFFIX}') if path != merged_path)
+
+    if len(paths) == 0:
+        return None
+
+    stats = pstats.Stats(*(str(path) for path in paths))
+    stats.dump_stats(merged_path)
+    return merged_path
+
+
+@contextlib.contextmanager
+def open_profiling_session(profile_dir: pathlib.Path) -> Iterator[None]:
+    """Remove the profiles of previous runs, and merge the profiles of all processes once the session ends.
+
+    The workers write their profiles when they shut down, so the session must only end once the pool has been joined.
+    """
+    profile_dir.mkdir(parents=True, exist_ok=True)
+
+    for path in profile_dir.glob(f'*{PROFILE_SUFFIX}'):
+        path.unlink()
+
+    try:
+        yield
+    finally:
+        if (parent_profiler := profilers.pop(profile_dir / f'{PARENT_PROFILE_NAME}{PROFILE_SUFFIX}', None)) is not None:
+            parent_profiler.dump()
+
+        if (merged_path := merge_profiles(profile_dir)) is not None:
+            logger.info(f'Wrote the merged profile to {merged_path}. It can be inspected via "python -m pstats {merged_path}".')
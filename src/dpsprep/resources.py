@@ -0,0 +1,155 @@
+import logging
+import math
+import os
+import pathlib
+import sys
+
+
+CGROUP_ROOT = pathlib.Path('/sys/fs/cgroup')
+PROC_SELF_CGROUP = pathlib.Path('/proc/self/cgroup')
+
+# cgroup v1 reports "no limit" as the largest page-aligned 64-bit integer rather than a special value
+UNLIMITED_THRESHOLD = 2 ** 62
+
+# A conservative estimate of the memory used by a worker for the libraries and the document, excluding the rendered page.
+# The actual usage of a document can be checked via the peak memory reported by --metrics-json.
+WORKER_BASE_MEMORY = 128 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def read_cgroup_file(path: pathlib.Path) -> str | None:
+    try:
+        return path.read_text(encoding='ascii').strip()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def read_cgroup_int(path: pathlib.Path) -> int | None:
+    content = read_cgroup_file(path)
+
+    try:
+        return None if content is None else int(content)
+    except ValueError:
+        return None
+
+
+def read_proc_cgroup(proc_cgroup: pathlib.Path) -> dict[str, str]:
+    """Map the cgroup v1 controllers to the paths of the process's cgroups. The cgroup v2 path is mapped from the empty string."""
+    paths = {}
+
+    for line in (read_cgroup_file(proc_cgroup) or '').splitlines():
+        _, _, rest = line.partition(':')
+        controllers, _, path = rest.partition(':')
+
+        for controller in controllers.split(','):
+            paths[controller] = path
+
+    return paths
+
+
+def get_cgroup_dirs(mount: pathlib.Path, path: str | None) -> list[pathlib.Path]:
+    """Determine the directory of a cgroup and of all its ancestors, whose limits also apply.
+
+    Within a cgroup namespace (e.g. in a container), the process's own cgroup is the root of the mounted hierarchy.
+    """
+    own_dir = mount / (path or '/').lstrip('/')
+
+    if not own_dir.is_dir():
+        return [mount]
+
+    return [own_dir, *(parent for parent in own_dir.parents if parent.is_relative_to(mount))]
+
+
+def get_cgroup_v2_dirs(root: pathlib.Path, paths: dict[str, str]) -> list[pathlib.Path]:
+    if '' not in paths or not (root / 'cgroup.controllers').exists():
+        return []
+
+    return get_cgroup_dirs(root, paths[''])
+
+
+def parse_cgroup_v2_cpu_max(content: str) -> float | None:
+    """Parse a quota like "400000 100000", i.e. 400ms of CPU time every 100ms, or "max 100000"."""
+    quota, _, period = content.partition(' ')
+
+    if not quota.isdigit() or not period.isdigit() or int(period) == 0:
+        return None
+
+    return int(quota) / int(period)
+
+
+def get_cpu_limit(root: pathlib.Path = CGROUP_ROOT, proc_cgroup: pathlib.Path = PROC_SELF_CGROUP) -> float | None:
+    """Determine the number of CPUs the process may use according to its cgroup quota, if any."""
+    paths = read_proc_cgroup(proc_cgroup)
+    limits = []
+
+    for cgroup_dir in get_cgroup_v2_dirs(root, paths):
+        if (content := read_cgroup_file(cgroup_dir / 'cpu.max')) and (limit := parse_cgroup_v2_cpu_max(content)) is not None:
+            limits.append(limit)
+
+    # cgroup v1 mounts the CPU controller under different names depending on the distribution
+    for mount in [root / 'cpu', root / 'cpu,cpuacct', root / 'cpuacct,cpu']:
+        for cgroup_dir in get_cgroup_dirs(mount, paths.get('cpu')):
+            quota = read_cgroup_int(cgroup_dir / 'cpu.cfs_quota_us')
+            period = read_cgroup_int(cgroup_dir / 'cpu.cfs_period_us')
+
+            # The quota is -1 if unlimited
+            if quota is not None and period is not None and quota > 0 and period > 0:
+                limits.append(quota / period)
+
+    return min(limits, default=None)
+
+
+def get_memory_limit(root: pathlib.Path = CGROUP_ROOT, proc_cgroup: pathlib.Path = PROC_SELF_CGROUP) -> int | None:
+    """Determine the amount of memory in bytes the process may use according to its cgroup, if limited."""
+    paths = read_proc_cgroup(proc_cgroup)
+    limits = []
+
+    # The file contains "max" if unlimited
+    for cgroup_dir in get_cgroup_v2_dirs(root, paths):
+        if (limit := read_cgroup_int(cgroup_dir / 'memory.max')) is not None:
+            limits.append(limit)
+
+    for cgroup_dir in get_cgroup_dirs(root / 'memory', paths.get('memory')):
+        if (limit := read_cgroup_int(cgroup_dir / 'memory.limit_in_bytes')) is not None and limit < UNLIMITED_THRESHOLD:
+            limits.append(limit)
+
+    return min(limits, default=None)
+
+
+def get_cpu_count() -> int:
+    if sys.version_info < (3, 13):
+        if cpu_count := os.cpu_count():
+            return 2 * cpu_count
+    elif lcpu_count := os.process_cpu_count():
+        return lcpu_count
+
+    return 1
+
+
+def get_default_pool_size() -> int:
+    """Determine the pool size from the CPU count, while respecting the CPU quota and memory limit of a container."""
+    pool_size = get_cpu_count()
+
+    if (cpu_limit := get_cpu_limit()) is not None:
+        logger.debug(f'The cgroup CPU quota allows using {cpu_limit:g} CPUs.')
+        pool_size = min(pool_size, math.ceil(cpu_limit))
+
+    if (memory_limit := get_memory_limit()) is not None:
+        logger.debug(f'The cgroup memory limit is {memory_limit} bytes.')
+        # The main process needs about as much memory as a worker
+        pool_size = min(pool_size, memory_limit // WORKER_BASE_MEMORY - 1)
+
+    return max(pool_size, 1)
+
+
+def get_default_max_memory(pool_size: int) -> int | None:
+    """Determine the memory available for rendering pages, i.e. the memory limit without the base memory of the processes.
+
+    Without a memory limit, the number of pages rendered at the same time is only limited by the pool size.
+    """
+    if (memory_limit := get_memory_limit()) is None:
+        return None
+
+    # At least one page is always processed, even if it does not fit into the budget
+    return max(memory_limit - (pool_size + 1) * WORKER_BASE_MEMORY, 0)
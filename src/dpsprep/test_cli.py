@@ -0,0 +1,25 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+
+# These modules are only needed once a conversion actually starts
+HEAVY_MODULES = ['djvu', 'PIL', 'fpdf', 'pdfrw', 'rich', 'multiprocessing.pool', 'ocrmypdf']
+
+
+def run_python(code: str) -> str:
+    env = {**os.environ, 'PYTHONPATH': str(pathlib.Path(__file__).parent.parent)}
+    return subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+
+
+def test_cli_startup_imports() -> None:
+    output = run_python('import json, sys, dpsprep.cli; print(json.dumps(list(sys.modules)))')
+    loaded = set(json.loads(output))
+
+    assert [module for module in HEAVY_MODULES if module in loaded] == []
+
+
+def test_cli_version() -> None:
+    assert 'version' in run_python('from dpsprep.cli import dpsprep; dpsprep(["--version"])')
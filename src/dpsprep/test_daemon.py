@@ -0,0 +1,82 @@
+import json
+import os
+import pathlib
+import signal
+import socket
+from typing import cast
+
+import click
+import pytest
+
+from . import daemon
+from .concurrency import SubprocessDocumentProcessor
+from .daemon import handle_connection, stop_serving
+
+
+# None of the jobs below get as far as using the processor
+NO_PROCESSOR = cast('SubprocessDocumentProcessor', None)
+
+
+def handle_request(request: bytes, statuses: list[dict[str, object]]) -> None:
+    """Let the daemon handle a single request and collect its responses, even if the daemon is interrupted."""
+    server, client = socket.socketpair()
+
+    with client:
+        try:
+            with server:
+                client.sendall(request)
+                handle_connection(NO_PROCESSOR, server, 1)
+        finally:
+            with client.makefile('rb') as file:
+                statuses.extend(json.loads(line) for line in file)
+
+
+def make_request(args: list[str], cwd: pathlib.Path) -> bytes:
+    return json.dumps({'args': args, 'cwd': str(cwd)}).encode('utf-8') + b'\n'
+
+
+def test_invalid_request() -> None:
+    statuses: list[dict[str, object]] = []
+    handle_request(b'{"args": []}\n', statuses)
+
+    assert statuses == [{'status': 'failed', 'message': 'Invalid request.'}]
+
+
+def test_failed_job(tmp_path: pathlib.Path) -> None:
+    cwd = pathlib.Path.cwd()
+    statuses: list[dict[str, object]] = []
+    handle_request(make_request(['missing.djvu'], tmp_path), statuses)
+
+    assert [status['status'] for status in statuses] == ['started', 'failed']
+    assert 'missing.djvu' in str(statuses[-1]['message'])
+    # The daemon restores its working directory after every job
+    assert pathlib.Path.cwd() == cwd
+
+
+def test_finished_job(tmp_path: pathlib.Path) -> None:
+    statuses: list[dict[str, object]] = []
+    handle_request(make_request(['--help'], tmp_path), statuses)
+
+    assert statuses[0] == {'status': 'started', 'job': 1}
+    assert statuses[-1]['status'] == 'done'
+
+
+@click.command()
+def terminated_job() -> None:
+    # Like a service manager stopping the daemon while the processor waits for the workers
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def test_terminated_job(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(daemon, 'dpsprep', terminated_job)
+    previous_handler = signal.signal(signal.SIGTERM, stop_serving)
+    statuses: list[dict[str, object]] = []
+
+    try:
+        # The interruption must reach the serving loop rather than only aborting the job
+        with pytest.raises(KeyboardInterrupt):
+            handle_request(make_request([], tmp_path), statuses)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+    assert statuses[-1] == {'status': 'failed', 'message': 'The conversion has been aborted.'}
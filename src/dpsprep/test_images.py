@@ -3,7 +3,7 @@ from PIL import Image, ImageChops, ImageStat
 
 from dpsprep.options import ImageMode
 
-from .images import process_djvu_page
+from .images import EncodedPage, ProcessedPageBackground, StripedPageBackground, choose_image_mode, encode_djvu_page, get_render_size, process_djvu_page, sample_page_statistics
 
 
 # A simple score function for Pillow images.
@@ -26,9 +26,77 @@ def test_process_djvu_page_bitonal() -> None:
 
     fixture = Image.open('fixtures/lipsum_01.png')
     result = process_djvu_page(document.pages[0], mode=ImageMode.INFER, i=0)
+    assert isinstance(result, ProcessedPageBackground)
 
     page_decode_job = document.pages[0].decode()
     page_decode_job.wait()
     assert result.resolution == page_decode_job.dpi
 
     assert calculate_image_diff_score(fixture, result.pil_image) < 0.05
+
+
+def test_process_djvu_page_in_strips() -> None:
+    document = djvu.decode.Context().new_document(
+        djvu.decode.FileURI('fixtures/lipsum_words.djvu'),
+    )
+    document.decoding_job.wait()
+
+    full = process_djvu_page(document.pages[0], mode=ImageMode.GRAYSCALE, i=0)
+    striped = process_djvu_page(document.pages[0], mode=ImageMode.GRAYSCALE, i=0, memory_limit=64 * 1024)
+    assert isinstance(full, ProcessedPageBackground)
+    assert isinstance(striped, StripedPageBackground)
+
+    assembled = Image.new('L', striped.size)
+
+    for top, strip in striped.iter_strips():
+        assert strip.height <= striped.strip_height
+        assembled.paste(strip, (0, top))
+
+    assert calculate_image_diff_score(full.pil_image, assembled) < 0.01
+
+
+def test_get_render_size() -> None:
+    assert get_render_size(5100, 6600, 600, 200) == (1700, 2200)
+    assert get_render_size(5100, 6600, 600, None) == (5100, 6600)
+    assert get_render_size(1700, 2200, 200, 600) == (1700, 2200)
+
+
+def test_choose_image_mode() -> None:
+    text = Image.new('RGB', (2000, 3000), 'white')
+    text.paste((0, 0, 0), (200, 200, 1800, 260))
+    assert choose_image_mode(sample_page_statistics(text)) == ImageMode.BITONAL
+
+    photo = Image.linear_gradient('L').resize((2000, 3000)).convert('RGB')
+    assert choose_image_mode(sample_page_statistics(photo)) == ImageMode.GRAYSCALE
+
+    illustration = text.copy()
+    illustration.paste((200, 30, 30), (200, 1000, 1800, 1500))
+    assert choose_image_mode(sample_page_statistics(illustration)) == ImageMode.RGB
+
+
+def test_encoded_page_image_serialization() -> None:
+    page_bg = ProcessedPageBackground(Image.new('1', (100, 200), 1), 300, ImageMode.BITONAL)
+    encoded = encode_djvu_page(page_bg, 300, quality=None)
+
+    assert encoded.layers[0].bits_per_component == 1
+    assert EncodedPage.deserialize(encoded.serialize()) == encoded
+
+
+def test_encoded_layered_page_serialization() -> None:
+    mask = Image.new('1', (300, 600), 1)
+    mask.paste(0, (10, 10, 200, 40))
+    page_bg = ProcessedPageBackground(
+        Image.new('RGB', (100, 200), 'yellow'),
+        300,
+        ImageMode.LAYERED,
+        foreground=Image.new('RGB', (50, 100), 'blue'),
+        mask=mask,
+    )
+    encoded = encode_djvu_page(page_bg, 300, quality=None)
+    background, foreground = encoded.layers
+
+    # The layers have different sizes, but the mask determines the size of the page
+    assert (background.width, foreground.width, encoded.width) == (100, 50, 300)
+    assert foreground.mask is not None
+    assert foreground.mask.width == 300
+    assert EncodedPage.deserialize(encoded.serialize()) == encoded
@@ -0,0 +1,40 @@
+import os
+import pathlib
+
+from .manifest import WorkdirManifest, write_atomically
+
+
+def test_workdir_manifest(tmp_path: pathlib.Path) -> None:
+    manifest_path = tmp_path / 'manifest.jsonl'
+    manifest = WorkdirManifest.load(manifest_path)
+
+    page_path = tmp_path / 'page_bg_1.img'
+    manifest.record(write_atomically(page_path, b'page', 'options'))
+    # No temporary files are left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['manifest.jsonl', 'page_bg_1.img']
+
+    # A process killed while writing the manifest may leave a truncated line
+    with open(manifest_path, 'a', encoding='utf-8') as file:
+        file.write('{"name": "page_bg_2.img", "si')
+
+    manifest = WorkdirManifest.load(manifest_path)
+    assert manifest.is_complete(page_path, 'options')
+    assert not manifest.is_complete(page_path, 'other options')
+    assert not manifest.is_complete(tmp_path / 'page_bg_2.img', 'options')
+
+    # The damaged line has been removed
+    assert len(manifest_path.read_text(encoding='utf-8').splitlines()) == 1
+
+    # Resumed conversions append to the manifest, which is compacted when loaded again
+    manifest.record(write_atomically(page_path, b'page', 'options'))
+    manifest = WorkdirManifest.load(manifest_path)
+    assert len(manifest_path.read_text(encoding='utf-8').splitlines()) == 1
+    assert manifest.is_complete(page_path, 'options')
+
+    # Files that have been modified since are detected by their size or modification time
+    stat = page_path.stat()
+    os.utime(page_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert not manifest.is_complete(page_path, 'options')
+
+    page_path.write_bytes(b'truncated')
+    assert not manifest.is_complete(page_path, 'options')
@@ -0,0 +1,16 @@
+from .metrics import TaskMetrics
+
+
+def test_task_metrics_accumulate_stages() -> None:
+    metrics = TaskMetrics('page', 0)
+
+    # Striped pages are encoded strip by strip
+    for _ in range(3):
+        with metrics.measure('encode'):
+            pass
+
+    assert list(metrics.stages.keys()) == ['encode']
+    assert metrics.stages['encode'] > 0
+
+    metrics.finish()
+    assert metrics.pid is not None
@@ -0,0 +1,80 @@
+import io
+import os
+import pathlib
+from typing import cast
+
+import djvu.decode
+from PIL import Image
+
+from .images import ProcessedPageBackground, encode_djvu_page
+from .options import ImageMode
+from .page_cache import PageCache, get_djvu_component_index, iter_iff_chunks, iter_included_ids
+
+
+def create_chunk(chunk_id: bytes, data: bytes) -> bytes:
+    return chunk_id + len(data).to_bytes(4, 'big') + data + b'\0' * (len(data) % 2)
+
+
+def test_iff_chunks() -> None:
+    page = create_chunk(b'FORM', b'DJVU' + create_chunk(b'INFO', b'abc') + create_chunk(b'INCL', b'dict0001.iff'))
+    data = b'AT&T' + create_chunk(b'FORM', b'DJVM' + create_chunk(b'DIRM', b'x') + page)
+
+    (form,) = iter_iff_chunks(io.BytesIO(data), 4, len(data))
+    assert (form.id, form.offset, form.size) == (b'FORM', 4, len(data) - 12)
+
+    dirm, component = iter_iff_chunks(io.BytesIO(data), 16, len(data))
+    # The odd-sized DIRM chunk is padded
+    assert dirm.id == b'DIRM'
+    assert component.offset == 16 + 8 + 2
+    assert data[component.offset:component.offset + 8 + component.size] == page
+
+    assert list(iter_included_ids(page)) == ['dict0001.iff']
+
+
+def test_component_index_of_replaced_file(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / 'page.djvu'
+    # Single-page documents do not need the document structure
+    document = cast('djvu.decode.Document', None)
+
+    path.write_bytes(b'AT&T' + create_chunk(b'FORM', b'DJVU' + create_chunk(b'INFO', b'abc')))
+    index = get_djvu_component_index(path, document)
+    assert index is not None
+    assert get_djvu_component_index(path, document) is index
+
+    # The index is read anew if the file changes, e.g. between the jobs of the daemon
+    path.write_bytes(b'AT&T' + create_chunk(b'FORM', b'DJVU' + create_chunk(b'INFO', b'abcdef')))
+    replaced_index = get_djvu_component_index(path, document)
+    assert replaced_index is not None
+    assert replaced_index.offsets[''] != index.offsets['']
+
+
+def test_page_cache(tmp_path: pathlib.Path) -> None:
+    cache = PageCache(tmp_path)
+    page_bg = ProcessedPageBackground(Image.new('1', (100, 200), 1), 300, ImageMode.BITONAL)
+    data = encode_djvu_page(page_bg, 300, quality=None).serialize()
+
+    assert cache.get('0123') is None
+
+    cache.put('0123', data)
+    assert cache.get('0123') == data
+    assert [path.name for path in tmp_path.rglob('*') if path.is_file()] == ['0123.img']
+
+    # Truncated entries are ignored
+    cache.get_path('0123').write_bytes(data[:-1])
+    assert cache.get('0123') is None
+
+
+def test_page_cache_pruning(tmp_path: pathlib.Path) -> None:
+    cache = PageCache(tmp_path)
+    page_bg = ProcessedPageBackground(Image.new('1', (100, 200), 1), 300, ImageMode.BITONAL)
+    data = encode_djvu_page(page_bg, 300, quality=None).serialize()
+
+    for i, key in enumerate(['aa01', 'bb02', 'cc03']):
+        cache.put(key, data)
+        os.utime(cache.get_path(key), (i + 1, i + 1))
+
+    # Reading an entry marks it as recently used, so the second entry is now the least recently used one
+    assert cache.get('aa01') == data
+
+    cache.prune(2 * len(data))
+    assert sorted(path.name for path in tmp_path.rglob('*') if path.is_file()) == ['aa01.img', 'cc03.img']
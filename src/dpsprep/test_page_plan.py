@@ -0,0 +1,51 @@
+import dataclasses
+
+import pytest
+
+from .options import DpsPrepOptions, ImageMode
+from .page_plan import PagePlan, PageSettings
+from .range import parse_enum_range_group, parse_int_range_group
+
+
+def with_ranges(options: DpsPrepOptions, mode: str, dpi: str) -> DpsPrepOptions:
+    return dataclasses.replace(options, mode_overrides=parse_enum_range_group(mode, ImageMode), dpi_overrides=parse_int_range_group(dpi))
+
+
+def test_page_plan(default_options: DpsPrepOptions) -> None:
+    options = with_ranges(default_options, 'bitonal[2-4],rgb[3-end]', '150[6-end]')
+    plan = PagePlan.compile(options, range(10))
+
+    # The plan agrees with the range options, where the first matching range takes precedence
+    for i in range(10):
+        assert plan[i] == PageSettings(
+            mode=options.mode_overrides.get_value_for_zero_based_page(i) or ImageMode.INFER,
+            dpi=options.dpi_overrides.get_value_for_zero_based_page(i),
+            target_dpi=None,
+            quality=None,
+        )
+
+    assert [(run.start, run.stop, settings.mode) for run, settings in plan.iter_runs()] == [
+        (0, 1, ImageMode.INFER),
+        (1, 4, ImageMode.BITONAL),
+        (4, 5, ImageMode.RGB),
+        (5, 10, ImageMode.RGB),
+    ]
+
+    chunk_plan = plan.restrict(range(3, 6))
+    assert [chunk_plan[i] for i in range(3, 6)] == [plan[i] for i in range(3, 6)]
+
+    with pytest.raises(IndexError):
+        chunk_plan[6]
+
+
+def test_page_plan_from_later_page(default_options: DpsPrepOptions) -> None:
+    options = with_ranges(default_options, 'bitonal[2-4],rgb[3-end]', '150[6-end]')
+    full_plan = PagePlan.compile(options, range(10))
+    plan = PagePlan.compile(options, range(3, 8))
+
+    assert plan.pages == range(3, 8)
+    assert [plan[i] for i in range(3, 8)] == [full_plan[i] for i in range(3, 8)]
+    assert [(run.start, run.stop) for run, _ in plan.iter_runs()] == [(3, 4), (4, 5), (5, 8)]
+
+    with pytest.raises(IndexError):
+        plan[2]
@@ -0,0 +1,177 @@
+import io
+from collections.abc import Sequence
+from concurrent.futures import Future
+from dataclasses import replace
+
+import pdfrw
+from fpdf import FPDF
+from PIL import Image
+
+from .images import EncodedPage, ProcessedPageBackground, encode_djvu_page, encode_multitonal_pil_image
+from .jbig2 import EncodedPageGroup, Jbig2Encoder
+from .options import ImageMode
+from .pdf import IncrementalPdfCombiner, StreamingPdfWriter, create_image_page, get_completed_future, get_image_xobject_name, get_page_drawing_operators
+
+
+def create_page_image(color: str) -> EncodedPage:
+    page_bg = ProcessedPageBackground(Image.new('RGB', (100, 200), color), 100, ImageMode.RGB)
+    return encode_djvu_page(page_bg, 100, quality=None)
+
+
+def create_uncompressed_bitonal_image() -> EncodedPage:
+    page_bg = ProcessedPageBackground(Image.new('1', (100, 200), 1), 100, ImageMode.BITONAL)
+    return encode_djvu_page(page_bg, 100, quality=None, defer_bitonal=True)
+
+
+def create_colored_page(color: str) -> pdfrw.PdfDict:
+    return create_image_page(create_page_image(color))
+
+
+def create_text_pdf_data(page_count: int) -> bytes:
+    fpdf = FPDF(unit='in')
+    fpdf.set_font('helvetica', size=10)
+
+    for i in range(page_count):
+        fpdf.add_page(format=(1, 2))
+        fpdf.text(x=0.1, y=0.5, text=f'Page {i + 1}')
+
+    return bytes(fpdf.output())
+
+
+def create_text_pdf(page_count: int) -> pdfrw.PdfReader:
+    return pdfrw.PdfReader(fdata=create_text_pdf_data(page_count))
+
+
+def test_streaming_writer_pages() -> None:
+    file = io.BytesIO()
+    writer = StreamingPdfWriter(file)
+
+    for color in ['red', 'green', 'blue']:
+        writer.add_page(create_colored_page(color))
+        writer.forget_objects()
+
+    writer.close(pdfrw.IndirectPdfDict())
+
+    result = pdfrw.PdfReader(fdata=file.getvalue())
+    assert len(result.pages) == 3
+    assert [float(x) for x in result.pages[0].MediaBox] == [0, 0, 72, 144]
+    assert result.pages[0].Parent.Count == '3'
+
+
+def test_streaming_writer_shared_objects() -> None:
+    file = io.BytesIO()
+    writer = StreamingPdfWriter(file)
+    text_pdf = create_text_pdf(3)
+
+    for text_page in text_pdf.pages:
+        pdfrw.PageMerge(text_page).add(create_colored_page('white')).render()
+        writer.add_page(text_page)
+
+    writer.close(pdfrw.IndirectPdfDict())
+
+    result = pdfrw.PdfReader(fdata=file.getvalue())
+    fonts = {id(page.Resources.Font.F1) for page in result.pages}
+    assert len(result.pages) == 3
+    assert len(fonts) == 1
+
+
+def test_streaming_writer_outline() -> None:
+    file = io.BytesIO()
+    writer = StreamingPdfWriter(file)
+    writer.add_page(create_colored_page('white'))
+
+    outline = pdfrw.IndirectPdfDict()
+    bookmark = pdfrw.IndirectPdfDict(
+        Parent=outline,
+        Title='Chapter 1',
+        A=pdfrw.PdfDict(D=[0, pdfrw.PdfName.Fit], S=pdfrw.PdfName.GoTo),
+    )
+    outline.First = outline.Last = bookmark
+    outline.Count = 1
+    writer.close(outline)
+
+    result = pdfrw.PdfReader(fdata=file.getvalue())
+    assert result.Root.Outlines.Count == '1'
+    assert result.Root.Outlines.First.Title.decode() == 'Chapter 1'
+
+
+def test_incremental_combiner_out_of_order() -> None:
+    file = io.BytesIO()
+    combiner = IncrementalPdfCombiner(file, 3, with_text=True)
+
+    combiner.add_page_image(2, create_page_image('blue'))
+    combiner.add_page_image(0, create_page_image('red'))
+    assert combiner.next_page == 0
+
+    combiner.add_text_layer_pdf(0, create_text_pdf_data(3))
+    assert combiner.next_page == 1
+
+    combiner.add_page_image(1, create_page_image('green'))
+    combiner.close(pdfrw.IndirectPdfDict())
+
+    result = pdfrw.PdfReader(fdata=file.getvalue())
+    assert len(result.pages) == 3
+    assert [bool(page.Resources.XObject) for page in result.pages] == [True, True, True]
+    assert [page.Resources.Font is not None for page in result.pages] == [True, True, True]
+
+
+class FakeJbig2Encoder(Jbig2Encoder):
+    def __init__(self) -> None:
+        self.batch_sizes: list[int] = []
+
+    def submit(self, pages: Sequence[EncodedPage]) -> Future[EncodedPageGroup]:
+        self.batch_sizes.append(len(pages))
+        return get_completed_future(
+            EncodedPageGroup([replace(page, layers=[replace(page.layers[0], filter='JBIG2Decode')]) for page in pages], jbig2_globals=b'globals'),
+        )
+
+    def shutdown(self, *, cancel_futures: bool = False) -> None:
+        pass
+
+
+def test_incremental_combiner_jbig2_batches() -> None:
+    file = io.BytesIO()
+    encoder = FakeJbig2Encoder()
+    combiner = IncrementalPdfCombiner(file, 20, with_text=False, jbig2_encoder=encoder)
+
+    for i in range(20):
+        combiner.add_page_image(i, create_page_image('red') if i == 3 else create_uncompressed_bitonal_image())
+
+    combiner.close(pdfrw.IndirectPdfDict())
+
+    # Batches are interrupted by non-bitonal pages and by text layer chunk boundaries
+    assert encoder.batch_sizes == [3, 12, 4]
+
+    result = pdfrw.PdfReader(fdata=file.getvalue())
+    images = [page.Resources.XObject.DpsPrepImage0 for page in result.pages]
+    assert [image.Filter for image in images].count('/JBIG2Decode') == 19
+    assert len({id(image.DecodeParms.JBIG2Globals) for image in images if image.DecodeParms}) == 3
+
+
+def test_layered_page() -> None:
+    page_bg = ProcessedPageBackground(
+        Image.new('RGB', (50, 100), 'yellow'),
+        100,
+        ImageMode.LAYERED,
+        foreground=Image.new('RGB', (25, 50), 'blue'),
+        mask=Image.new('1', (100, 200), 1),
+    )
+    page = create_image_page(encode_djvu_page(page_bg, 100, quality=None))
+
+    assert [float(x) for x in page.MediaBox] == [0, 0, 72, 144]
+    background = page.Resources.XObject[get_image_xobject_name(0)]
+    foreground = page.Resources.XObject[get_image_xobject_name(1)]
+    assert background.Mask is None
+    assert foreground.Mask.ImageMask
+    assert foreground.Mask.ColorSpace is None
+
+
+def test_page_strips() -> None:
+    top = replace(encode_multitonal_pil_image(Image.new('RGB', (100, 64), 'red'), quality=None), top=0)
+    bottom = replace(encode_multitonal_pil_image(Image.new('RGB', (100, 36), 'blue'), quality=None), top=64)
+    page = EncodedPage(100, 100, 100, [top, bottom])
+
+    assert get_page_drawing_operators(page) == (
+        f'q 72.0 0 0 46.08 0 25.92 cm {get_image_xobject_name(0)} Do Q '
+        f'q 72.0 0 0 25.92 0 0.0 cm {get_image_xobject_name(1)} Do Q'
+    )
@@ -0,0 +1,47 @@
+import pathlib
+import pstats
+
+import pytest
+
+from . import profiling
+from .profiling import dump_profiles, merge_profiles, open_profiling_session, profile_section
+
+
+def profiled_function() -> int:
+    return sum(range(100))
+
+
+@pytest.fixture(autouse=True)
+def isolated_profilers(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(profiling, 'profilers', {})
+
+
+def test_profiles_are_merged(tmp_path: pathlib.Path) -> None:
+    (tmp_path / 'stale.prof').write_bytes(b'')
+
+    with open_profiling_session(tmp_path):
+        # Simulate the profiles of two workers
+        for name in ['worker-1', 'worker-2']:
+            with profile_section(tmp_path, name, dump_interval=0):
+                profiled_function()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['merged.prof', 'worker-1.prof', 'worker-2.prof']
+
+    stats = pstats.Stats(str(tmp_path / 'merged.prof'))
+    call_counts = {function: call_count for (_, _, function), (_, call_count, *_) in stats.stats.items()}  # type: ignore[attr-defined]
+    assert call_counts['profiled_function'] == 2
+
+
+def test_merge_without_profiles(tmp_path: pathlib.Path) -> None:
+    assert merge_profiles(tmp_path) is None
+
+
+def test_profiles_are_dumped_periodically(tmp_path: pathlib.Path) -> None:
+    with profile_section(tmp_path, 'worker-1', dump_interval=3600):
+        profiled_function()
+
+    assert not (tmp_path / 'worker-1.prof').exists()
+
+    # E.g. when the worker shuts down
+    dump_profiles()
+    assert (tmp_path / 'worker-1.prof').exists()
@@ -0,0 +1,46 @@
+import pathlib
+
+from .resources import get_cpu_limit, get_memory_limit
+
+
+def write_file(path: pathlib.Path, content: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content, encoding='ascii')
+
+
+def test_cgroup_v2_limits(tmp_path: pathlib.Path) -> None:
+    root = tmp_path / 'cgroup'
+    proc_cgroup = tmp_path / 'proc_self_cgroup'
+    write_file(proc_cgroup, '0::/kubepods/pod/container\n')
+    write_file(root / 'cgroup.controllers', 'cpu memory')
+
+    assert get_cpu_limit(root, proc_cgroup) is None
+    assert get_memory_limit(root, proc_cgroup) is None
+
+    write_file(root / 'kubepods/pod/container/cpu.max', 'max 100000')
+    write_file(root / 'kubepods/pod/container/memory.max', 'max')
+    # Limits of ancestors also apply
+    write_file(root / 'kubepods/pod/cpu.max', '250000 100000')
+    write_file(root / 'kubepods/pod/memory.max', str(2 ** 31))
+
+    assert get_cpu_limit(root, proc_cgroup) == 2.5
+    assert get_memory_limit(root, proc_cgroup) == 2 ** 31
+
+
+def test_cgroup_v1_limits(tmp_path: pathlib.Path) -> None:
+    root = tmp_path / 'cgroup'
+    proc_cgroup = tmp_path / 'proc_self_cgroup'
+    # Within a cgroup namespace, the paths do not exist in the mounted hierarchy
+    write_file(proc_cgroup, '4:memory:/docker/abc\n2:cpu,cpuacct:/docker/abc\n')
+    write_file(root / 'cpu,cpuacct/cpu.cfs_quota_us', '-1')
+    write_file(root / 'cpu,cpuacct/cpu.cfs_period_us', '100000')
+    write_file(root / 'memory/memory.limit_in_bytes', '9223372036854771712')
+
+    assert get_cpu_limit(root, proc_cgroup) is None
+    assert get_memory_limit(root, proc_cgroup) is None
+
+    write_file(root / 'cpu,cpuacct/cpu.cfs_quota_us', '400000')
+    write_file(root / 'memory/memory.limit_in_bytes', str(2 ** 30))
+
+    assert get_cpu_limit(root, proc_cgroup) == 4
+    assert get_memory_limit(root, proc_cgroup) == 2 ** 30
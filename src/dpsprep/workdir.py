@@ -2,18 +2,42 @@ import pathlib
 from dataclasses import dataclass
 
 
+# The text layer is generated in chunks of pages. Every chunk embeds its own copy of the (small) invisible font,
+# so the chunks should not be too small.
+TEXT_LAYER_CHUNK_SIZE = 16
+
+
+def get_text_layer_chunks(page_count: int) -> list[range]:
+    return [
+        range(start, min(start + TEXT_LAYER_CHUNK_SIZE, page_count))
+        for start in range(0, page_count, TEXT_LAYER_CHUNK_SIZE)
+    ]
+
+
 @dataclass(frozen=True)
 class WorkingDirectory:
     src: pathlib.Path
     dest: pathlib.Path
     working: pathlib.Path
 
-    def get_page_pdf_path(self, i: int) -> pathlib.Path:
-        return self.working / f'page_bg_{i + 1}.pdf'
+    def get_page_image_path(self, i: int) -> pathlib.Path:
+        return self.working / f'page_bg_{i + 1}.img'
+
+    def get_text_layer_pdf_path(self, chunk: range) -> pathlib.Path:
+        return self.working / f'text_layer_{chunk.start + 1}-{chunk.stop}.pdf'
+
+    @property
+    def manifest_path(self) -> pathlib.Path:
+        return self.working / 'manifest.jsonl'
+
+    @property
+    def page_cache_path(self) -> pathlib.Path:
+        # The cache is shared by all working directories within the same temporary directory
+        return self.working.parent / 'page_cache'
 
     @property
-    def text_layer_pdf_path(self) -> pathlib.Path:
-        return self.working / 'text_layer.pdf'
+    def partial_dest_path(self) -> pathlib.Path:
+        return self.dest.with_name(f'{self.dest.name}.part')
 
     @property
     def ocrmypdf_tmp_path(self) -> pathlib.Path:
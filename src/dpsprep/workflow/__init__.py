@@ -1,4 +1,10 @@
-from .combination import combine_document
+from .combination import (
+    combine_document,
+    extract_outline,
+    finish_combination_without_text,
+    get_combination_target,
+    is_combined_directly_into_destination,
+)
 from .optimization import attempt_to_optimize_result
-from .processing import process_page_bg, process_text
-from .workdir import destroy_workdir, initialize_workdir
+from .processing import process_page_bg, process_page_bg_in_memory, process_text, process_text_in_memory
+from .workdir import destroy_workdir, initialize_workdir, prepare_workdir, resolve_workdir
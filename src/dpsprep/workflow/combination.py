@@ -1,9 +1,11 @@
 import logging
+import pathlib
 import shutil
 
 import djvu.decode
 import pdfrw
 
+from dpsprep.metrics import ConversionMetrics
 from dpsprep.ocrmypdf_adapter import perform_ocr
 from dpsprep.options import DpsPrepOptions
 from dpsprep.outline import extract_outline_as_pdfdict
@@ -13,33 +15,64 @@ from dpsprep.pdf import combine_pdfs_on_fs_with_text, combine_pdfs_on_fs_without
 logger = logging.getLogger(__name__)
 
 
-def combine_document(options: DpsPrepOptions, document: djvu.decode.Document) -> None:
-    outline = pdfrw.IndirectPdfDict()
+def is_combined_directly_into_destination(options: DpsPrepOptions) -> bool:
+    """Determine whether the combined file needs no further processing in the working directory.
 
+    This is only attempted in in-memory mode because the files in the working directory allow resuming interrupted conversions otherwise.
+    """
+    return options.in_memory and options.optlevel is None and not options.ocr_options
+
+
+def get_combination_target(options: DpsPrepOptions) -> pathlib.Path:
+    if is_combined_directly_into_destination(options):
+        return options.workdir.partial_dest_path
+
+    if options.no_text:
+        return options.workdir.combined_pdf_without_text_path
+
+    return options.workdir.combined_pdf_path
+
+
+def extract_outline(document: djvu.decode.Document) -> pdfrw.PdfDict:
     if len(document.outline.sexpr) > 0:
         logger.info('Processing metadata.')
         outline = extract_outline_as_pdfdict(document)
         logger.info('Metadata processed.')
+        return outline
+
+    logger.info('No metadata to process.')
+    return pdfrw.IndirectPdfDict()
+
+
+def finish_combination_without_text(options: DpsPrepOptions, metrics: ConversionMetrics) -> None:
+    ocr_success = False
+
+    if options.ocr_options:
+        logger.info('Performing OCR.')
+
+        with metrics.measure('ocr'):
+            ocr_success = perform_ocr(options)
     else:
-        logger.info('No metadata to process.')
+        logger.info('Skipping the text layer.')
+
+    if not ocr_success:
+        shutil.copy(
+            options.workdir.combined_pdf_without_text_path,
+            options.workdir.combined_pdf_path,
+        )
+
+
+def combine_document(options: DpsPrepOptions, document: djvu.decode.Document, metrics: ConversionMetrics) -> None:
+    with metrics.measure('outline'):
+        outline = extract_outline(document)
 
     logger.info('Combining everything.')
 
     if options.no_text:
-        combine_pdfs_on_fs_without_text(options, outline, len(document.pages))
+        with metrics.measure('combine'):
+            combine_pdfs_on_fs_without_text(options, outline, len(document.pages))
 
-        ocr_success = False
-
-        if options.ocr_options:
-            logger.info('Performing OCR.')
-            ocr_success = perform_ocr(options)
-        else:
-            logger.info('Skipping the text layer.')
-
-        if not ocr_success:
-            shutil.copy(
-                options.workdir.combined_pdf_without_text_path,
-                options.workdir.combined_pdf_path,
-            )
+        finish_combination_without_text(options, metrics)
     else:
-        combine_pdfs_on_fs_with_text(options, outline)
+        with metrics.measure('combine'):
+            combine_pdfs_on_fs_with_text(options, outline, len(document.pages))
@@ -3,60 +3,120 @@ from time import time
 
 import djvu.decode
 
-from dpsprep.images import failsafe_save_djvu_page, process_djvu_page
+from dpsprep.images import ProcessedPageBackground, RenderBuffer, StripedPageBackground, failsafe_encode_djvu_page, process_decoded_djvu_page
 from dpsprep.logging import human_readable_size
-from dpsprep.options import DEFAULT_IMAGE_MODE, DpsPrepOptions
+from dpsprep.manifest import ManifestEntry, get_page_bg_fingerprint, get_text_layer_fingerprint, write_atomically
+from dpsprep.metrics import TaskMetrics
+from dpsprep.options import DpsPrepOptions
 from dpsprep.outline import extract_text_as_fpdf
-from dpsprep.pdf import is_valid_pdf
+from dpsprep.page_cache import PageCache, get_page_cache_key
+from dpsprep.page_plan import PagePlan, PageSettings
 
 
 logger = logging.getLogger(__name__)
 
 
-def process_page_bg(options: DpsPrepOptions, document: djvu.decode.Document, i: int) -> None:
-    page_number = i + 1
+def encode_page_bg(options: DpsPrepOptions, settings: PageSettings, document: djvu.decode.Document, i: int, render_buffer: RenderBuffer | None, metrics: TaskMetrics) -> bytes:
+    start_time = time()
 
-    if options.workdir.get_page_pdf_path(i).exists():
-        if is_valid_pdf(options.workdir.get_page_pdf_path(i)):
-            logger.debug(f'Image data from page {page_number} already processed.')
-            return
-        logger.debug(f'Invalid page generated for {page_number}, regenerating.')
-    else:
-        logger.debug(f'Processing image data from page {page_number}.')
+    with metrics.measure('decode'):
+        page_job = document.pages[i].decode(wait=True)
 
-    start_time = time()
-    mode = options.mode_overrides.get_value_for_zero_based_page(i) or DEFAULT_IMAGE_MODE
-    page_bg = process_djvu_page(document.pages[i], mode, i)
-    failsafe_save_djvu_page(
-        page_bg,
-        options.workdir.get_page_pdf_path(i),
-        options,
-        page_number,
-    )
+    with metrics.measure('render'):
+        page_bg = process_decoded_djvu_page(
+            page_job,
+            settings.mode,
+            i,
+            render_buffer,
+            dpi=settings.dpi,
+            target_dpi=settings.target_dpi,
+            memory_limit=options.max_page_memory,
+        )
+
+    with metrics.measure('encode'):
+        data = failsafe_encode_djvu_page(page_bg, options, settings.quality, i).serialize()
+
+    metrics.mode = page_bg.mode
+    log_processed_page_bg(page_bg, i, len(data), time() - start_time)
+    return data
 
-    dpi_override = options.dpi_overrides.get_value_for_zero_based_page(i)
-    pdf_size = options.workdir.get_page_pdf_path(i).stat().st_size
+
+def log_processed_page_bg(page_bg: ProcessedPageBackground | StripedPageBackground, i: int, size: int, duration: float) -> None:
+    if isinstance(page_bg, StripedPageBackground):
+        width, height = page_bg.size
+    else:
+        width, height = page_bg.pil_image.size if page_bg.mask is None else page_bg.mask.size
 
     message = (
-        f'Processed and saved image data for page {page_number} in {time() - start_time:.2f}s. '
-        f'The result has {page_bg.mode} mode, DPI {page_bg.resolution} '
-        + ('' if dpi_override is None else f'(will be rescaled to {dpi_override}) ') +
-        f'and size {human_readable_size(pdf_size)}.'
+        f'Processed image data for page {i + 1} in {duration:.2f}s. '
+        f'The result has {page_bg.mode} mode, {width}x{height} pixels at DPI {page_bg.resolution} '
+        f'and size {human_readable_size(size)}.'
     )
 
     logger.debug(message)
 
 
-def process_text(options: DpsPrepOptions, document: djvu.decode.Document) -> None:
-    if options.workdir.text_layer_pdf_path.exists():
-        logger.info('Text data already processed.')
-        return
+def encode_page_bg_with_cache(options: DpsPrepOptions, settings: PageSettings, document: djvu.decode.Document, i: int, render_buffer: RenderBuffer | None, metrics: TaskMetrics) -> bytes:
+    with metrics.measure('cache'):
+        key = get_page_cache_key(options, settings, document, i)
+        cache = PageCache(options.workdir.page_cache_path)
+        data = None if key is None else cache.get(key)
+
+    if data is not None:
+        logger.debug(f'Reusing cached image data for page {i + 1}.')
+        metrics.cached = True
+        return data
+
+    logger.debug(f'Processing image data from page {i + 1} ({settings}).')
+    data = encode_page_bg(options, settings, document, i, render_buffer, metrics)
+
+    if key is not None:
+        with metrics.measure('cache'):
+            cache.try_put(key, data)
+
+    return data
 
-    logger.debug('Processing text data.')
+
+def process_page_bg(options: DpsPrepOptions, plan: PagePlan, document: djvu.decode.Document, i: int, render_buffer: RenderBuffer | None = None, metrics: TaskMetrics | None = None) -> ManifestEntry:
+    """Write the image data of the page to the working directory.
+
+    Pages that are already done are skipped by the parent process based on the working directory's manifest,
+    so we always (re)generate the page here.
+    """
+    metrics = metrics or TaskMetrics('page', i)
+    settings = plan[i]
+    data = encode_page_bg_with_cache(options, settings, document, i, render_buffer, metrics)
+    metrics.size = len(data)
+
+    with metrics.measure('write'):
+        return write_atomically(options.workdir.get_page_image_path(i), data, get_page_bg_fingerprint(options, settings))
+
+
+def process_page_bg_in_memory(options: DpsPrepOptions, plan: PagePlan, document: djvu.decode.Document, i: int, render_buffer: RenderBuffer | None = None, metrics: TaskMetrics | None = None) -> bytes:
+    metrics = metrics or TaskMetrics('page', i)
+    data = encode_page_bg_with_cache(options, plan[i], document, i, render_buffer, metrics)
+    metrics.size = len(data)
+    return data
+
+
+def process_text(options: DpsPrepOptions, plan: PagePlan, document: djvu.decode.Document, chunk: range, metrics: TaskMetrics | None = None) -> ManifestEntry:
+    metrics = metrics or TaskMetrics('text', chunk.start)
+    data = process_text_in_memory(plan, document, chunk, metrics)
+
+    with metrics.measure('write'):
+        return write_atomically(options.workdir.get_text_layer_pdf_path(chunk), data, get_text_layer_fingerprint(plan, chunk))
+
+
+def process_text_in_memory(plan: PagePlan, document: djvu.decode.Document, chunk: range, metrics: TaskMetrics | None = None) -> bytes:
+    metrics = metrics or TaskMetrics('text', chunk.start)
+    logger.debug(f'Processing text data for pages {chunk.start + 1} to {chunk.stop}.')
 
     start_time = time()
-    fpdf = extract_text_as_fpdf(document, options)
-    fpdf.output(str(options.workdir.text_layer_pdf_path))
 
-    pdf_size = options.workdir.text_layer_pdf_path.stat().st_size
-    logger.info(f'Text data with size {human_readable_size(pdf_size) } processed in {time() - start_time:.2f}s and written to working directory')
+    with metrics.measure('extract'):
+        data = bytes(extract_text_as_fpdf(document, plan, chunk).output())
+
+    metrics.size = len(data)
+    logger.debug(f'Text data for pages {chunk.start + 1} to {chunk.stop} with size {human_readable_size(len(data))} processed in {time() - start_time:.2f}s.')
+
+    return data
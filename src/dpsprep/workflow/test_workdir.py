@@ -0,0 +1,47 @@
+import hashlib
+import pathlib
+
+from dpsprep.workdir import WorkingDirectory
+
+from .workdir import destroy_workdir, get_fast_file_key, get_file_fingerprint, get_file_hash
+
+
+def test_file_hash(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / 'empty.djvu'
+    path.write_bytes(b'')
+    assert get_file_hash(path) == hashlib.blake2b(b'').hexdigest()
+
+    path.write_bytes(b'AT&T' * 1000)
+    assert get_file_hash(path) == hashlib.blake2b(b'AT&T' * 1000).hexdigest()
+
+
+def test_fast_file_fingerprint(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / 'book.djvu'
+    path.write_bytes(b'AT&T')
+    fingerprint_root = tmp_path / 'fingerprints'
+
+    fingerprint = get_file_fingerprint(path, fingerprint_root)
+    assert (fingerprint_root / get_fast_file_key(path)).read_text() == fingerprint
+
+    # The stored hash is trusted as long as the metadata is unchanged
+    (fingerprint_root / get_fast_file_key(path)).write_text('0' * len(fingerprint))
+    assert get_file_fingerprint(path, fingerprint_root, fast=True) == '0' * len(fingerprint)
+    assert get_file_fingerprint(path, fingerprint_root) == fingerprint
+
+
+def test_destroy_workdir_prunes_fingerprints(tmp_path: pathlib.Path) -> None:
+    fingerprint_root = tmp_path / 'fingerprints'
+    kept_path = tmp_path / 'kept.djvu'
+    kept_path.write_bytes(b'AT&T')
+    destroyed_path = tmp_path / 'destroyed.djvu'
+    destroyed_path.write_bytes(b'AT&T' * 2)
+
+    kept = get_file_fingerprint(kept_path, fingerprint_root)
+    destroyed = get_file_fingerprint(destroyed_path, fingerprint_root)
+    (tmp_path / kept).mkdir()
+    (tmp_path / destroyed).mkdir()
+    # E.g. left over by an older version that did not write the hashes atomically
+    (fingerprint_root / 'truncated').write_text(kept[:4])
+
+    destroy_workdir(WorkingDirectory(destroyed_path, tmp_path / 'destroyed.pdf', tmp_path / destroyed))
+    assert [path.name for path in fingerprint_root.iterdir()] == [get_fast_file_key(kept_path)]
@@ -1,38 +1,90 @@
 import hashlib
 import logging
+import mmap
 import os
 import pathlib
 import shutil
 import tempfile
 
+from dpsprep.files import write_file_atomically
 from dpsprep.workdir import WorkingDirectory
 
 
 PERSISTENT_TMP = pathlib.Path('/var/tmp')  # See the initialize_workdir documentation below.
-HASHING_BUFFER_SIZE = 64 * 1024
+HASHING_BUFFER_SIZE = 4 * 1024 * 1024
+FINGERPRINT_LENGTH = 2 * hashlib.blake2b().digest_size
+# The directory next to the working directories in which the hashes of the source files are stored
+FINGERPRINTS_DIR_NAME = 'fingerprints'
 logger = logging.getLogger(__name__)
 
 
 def get_file_hash(path: os.PathLike | str) -> str:
-    h = hashlib.blake2b(digest_size=4)
+    h = hashlib.blake2b()
 
     with open(path, 'rb') as file:
-        data = file.read(HASHING_BUFFER_SIZE)
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and some special files cannot be mapped
+            mapped = None
+
+        if mapped is None:
+            while data := file.read(HASHING_BUFFER_SIZE):
+                h.update(data)
+        else:
+            with mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
 
-        while len(data) > 0:
-            h.update(data)
-            data = file.read(HASHING_BUFFER_SIZE)
+                h.update(mapped)
 
     return h.hexdigest()
 
 
-def initialize_workdir(
+def get_fast_file_key(path: pathlib.Path) -> str:
+    """Identify the file contents based on its metadata, which changes (with overwhelming likelihood) whenever the contents change."""
+    stat = path.stat()
+    return f'{stat.st_dev:x}-{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+
+def get_file_fingerprint(path: pathlib.Path, fingerprint_root: pathlib.Path, fast: bool = False) -> str:
+    """Determine the hash of the file contents, which identifies its working directory.
+
+    Hashing large files may take a long time, especially on network storage. So we store the hash of every file
+    along with the file's metadata, and, if fast is set, we reuse the hash for as long as the metadata is unchanged.
+    """
+    fingerprint_path = fingerprint_root / get_fast_file_key(path)
+
+    if fast:
+        try:
+            fingerprint = fingerprint_path.read_text(encoding='ascii')
+        except (OSError, ValueError):
+            pass
+        else:
+            # The file may have been truncated by an interrupted write
+            if len(fingerprint) == FINGERPRINT_LENGTH:
+                logger.debug(f'Reusing the stored hash of {path}.')
+                return fingerprint
+
+    fingerprint = get_file_hash(path)
+
+    try:
+        fingerprint_root.mkdir(parents=True, exist_ok=True)
+        write_file_atomically(fingerprint_path, fingerprint.encode('ascii'))
+    except OSError as err:
+        logger.debug(f'Could not store the hash of {path}: {err}')
+
+    return fingerprint
+
+
+def resolve_workdir(
     src: os.PathLike | str,
     dest: os.PathLike | str | None,
     tmp_root: os.PathLike | str | None,
-    delete_existing: bool = False,
+    *,
+    fast_fingerprint: bool = False,
 ) -> WorkingDirectory:
-    """Create a working directory and initialize a WorkingDirectory structure.
+    """Initialize a WorkingDirectory structure without creating the working directory.
 
     Cross-platform temporary directories are difficult to handle. The standard library's documentation
     for tempfile.gettempdir() lists a procedure for determining which directory to use.
@@ -48,6 +100,8 @@ def initialize_workdir(
     Finally, we allow explicit overrides via the tmp_root variable. We assume the it is writable.
     Click checks this for us explicitly in the CLI.
 
+    The working directory is named after the hash of the source file. See get_file_fingerprint for how it is determined.
+
     [1] https://www.pathname.com/fhs/pub/fhs-2.3.html#VARTMPTEMPORARYFILESPRESERVEDBETWEE
     [2] https://github.com/kcroker/dpsprep/issues/59
     """
@@ -61,17 +115,23 @@ def initialize_workdir(
         logger.debug(f'Using default system storage {tmp_root}.')
 
     src_ = pathlib.Path(src)
-    working = pathlib.Path(tmp_root) / 'dpsprep' / get_file_hash(src_)
-    workdir = WorkingDirectory(
+    dpsprep_root = pathlib.Path(tmp_root) / 'dpsprep'
+
+    return WorkingDirectory(
         src=src_,
         dest=pathlib.Path(src_.with_suffix('.pdf').name if dest is None else dest),
-        working=working,
+        working=dpsprep_root / get_file_fingerprint(src_, dpsprep_root / FINGERPRINTS_DIR_NAME, fast_fingerprint),
     )
 
-    if workdir.working.exists():
+
+def prepare_workdir(workdir: WorkingDirectory, delete_existing: bool = False) -> None:
+    working = workdir.working
+
+    if working.exists():
         if delete_existing:
             logger.debug(f'Removing existing working directory {working}.')
-            destroy_workdir(workdir)
+            # The stored hash still applies, since the working directory is recreated right away
+            shutil.rmtree(working)
             logger.info(f'Removed existing working directory {working}.')
         else:
             logger.info(f'Reusing working directory {working}.')
@@ -85,8 +145,43 @@ def initialize_workdir(
     if not workdir.ocrmypdf_tmp_path.exists():
         logger.debug(f'Creating {workdir.ocrmypdf_tmp_path}.')
 
+
+def initialize_workdir(
+    src: os.PathLike | str,
+    dest: os.PathLike | str | None,
+    tmp_root: os.PathLike | str | None,
+    delete_existing: bool = False,
+    *,
+    fast_fingerprint: bool = False,
+) -> WorkingDirectory:
+    """Create a working directory and initialize a WorkingDirectory structure."""
+    workdir = resolve_workdir(src, dest, tmp_root, fast_fingerprint=fast_fingerprint)
+    prepare_workdir(workdir, delete_existing)
     return workdir
 
 
+def prune_file_fingerprints(fingerprint_root: pathlib.Path) -> None:
+    """Remove the stored hashes that no longer identify an existing working directory."""
+    try:
+        fingerprint_paths = list(fingerprint_root.iterdir())
+    except OSError:
+        return
+
+    for fingerprint_path in fingerprint_paths:
+        try:
+            fingerprint = fingerprint_path.read_text(encoding='ascii')
+        except (OSError, ValueError):
+            fingerprint = ''
+
+        if len(fingerprint) == FINGERPRINT_LENGTH and (fingerprint_root.parent / fingerprint).is_dir():
+            continue
+
+        try:
+            fingerprint_path.unlink()
+        except OSError as err:
+            logger.debug(f'Could not remove {fingerprint_path}: {err}')
+
+
 def destroy_workdir(workdir: WorkingDirectory) -> None:
     shutil.rmtree(workdir.working)
+    prune_file_fingerprints(workdir.working.parent / FINGERPRINTS_DIR_NAME)
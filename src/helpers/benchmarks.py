@@ -0,0 +1,190 @@
+import functools
+import json
+import logging
+import pathlib
+import platform
+import statistics
+import tempfile
+from collections.abc import Callable, Iterable, Mapping
+from time import perf_counter
+
+import click
+import djvu.decode
+
+from dpsprep.concurrency import SubprocessDocumentProcessor
+from dpsprep.conversion import finish_conversion, open_djvu_document, start_conversion
+from dpsprep.images import ProcessedPageBackground, RenderBuffer, StripedPageBackground, encode_djvu_page, process_djvu_page
+from dpsprep.metrics import ConversionMetrics
+from dpsprep.options import DEFAULT_MAX_PAGE_MEMORY, DpsPrepOptions, ImageMode
+from dpsprep.outline import extract_text_as_fpdf
+from dpsprep.page_plan import PagePlan
+from dpsprep.range import RangeOptionGroup
+from dpsprep.workdir import WorkingDirectory
+from dpsprep.workflow import combine_document, extract_outline, initialize_workdir, process_page_bg, process_text
+
+
+ROOT = pathlib.Path(__file__).parent.parent.parent
+FIXTURES = ROOT / 'fixtures'
+
+BENCHMARKED_IMAGE_MODES = [ImageMode.BITONAL, ImageMode.GRAYSCALE, ImageMode.RGB, ImageMode.LAYERED, ImageMode.AUTO]
+DEFAULT_POOL_SIZES = [1, 2, 4]
+DEFAULT_REPEAT = 3
+# Timings are noisy, so only slowdowns above this fraction of the baseline are reported as regressions
+DEFAULT_TOLERANCE = 0.2
+
+BenchmarkResults = dict[str, dict[str, float]]
+
+
+def measure(function: Callable[[], object], repeat: int) -> dict[str, float]:
+    durations = []
+
+    for _ in range(repeat):
+        start_time = perf_counter()
+        function()
+        durations.append(perf_counter() - start_time)
+
+    return {'min': min(durations), 'median': statistics.median(durations)}
+
+
+def make_benchmark_options(workdir: WorkingDirectory, pool_size: int = 1) -> DpsPrepOptions:
+    # The page cache stays disabled, since it would make every repetition but the first one meaningless
+    return DpsPrepOptions(
+        workdir=workdir,
+        mode_overrides=RangeOptionGroup([]),
+        dpi_overrides=RangeOptionGroup([]),
+        target_dpi_overrides=RangeOptionGroup([]),
+        quality_overrides=RangeOptionGroup([]),
+        no_text=False,
+        page_cache_size=None,
+        in_memory=False,
+        jbig2=False,
+        max_page_memory=DEFAULT_MAX_PAGE_MEMORY * 1024 * 1024,
+        pool_size=pool_size,
+        verbose=False,
+        metrics_path=None,
+        profile_dir=None,
+        ocr_options=None,
+        optlevel=None,
+    )
+
+
+def iter_benchmark_fixtures(fixtures: pathlib.Path) -> Iterable[pathlib.Path]:
+    # The invalid fixture only differs from the valid one in its text layer
+    return sorted(path for path in fixtures.glob('*.djvu') if 'invalid' not in path.stem)
+
+
+def render_pages(document: djvu.decode.Document, mode: ImageMode, render_buffer: RenderBuffer | None) -> list[ProcessedPageBackground | StripedPageBackground]:
+    return [process_djvu_page(page, mode, i, render_buffer) for i, page in enumerate(document.pages)]
+
+
+def encode_pages(page_bgs: Iterable[ProcessedPageBackground | StripedPageBackground]) -> None:
+    for page_bg in page_bgs:
+        encode_djvu_page(page_bg, page_bg.resolution, quality=None).serialize()
+
+
+def benchmark_pages(document: djvu.decode.Document, repeat: int) -> Iterable[tuple[str, dict[str, float]]]:
+    render_buffer = RenderBuffer()
+
+    for mode in BENCHMARKED_IMAGE_MODES:
+        yield f'render/{mode}', measure(functools.partial(render_pages, document, mode, render_buffer), repeat)
+        # The pages are kept until they are encoded, so each of them needs its own buffer rather than the shared one
+        yield f'encode/{mode}', measure(functools.partial(encode_pages, render_pages(document, mode, render_buffer=None)), repeat)
+
+
+def benchmark_document(src: pathlib.Path, tmp_root: pathlib.Path, repeat: int) -> Iterable[tuple[str, dict[str, float]]]:
+    document = open_djvu_document(src)
+    workdir = initialize_workdir(src, tmp_root / src.with_suffix('.pdf').name, tmp_root, delete_existing=True)
+    options = make_benchmark_options(workdir)
+    chunk = range(len(document.pages))
+    plan = PagePlan.compile(options, chunk)
+
+    yield from benchmark_pages(document, repeat)
+    yield 'text_layer', measure(lambda: extract_text_as_fpdf(document, plan, chunk).output(), repeat)
+    yield 'outline', measure(lambda: extract_outline(document), repeat)
+
+    for i in chunk:
+        process_page_bg(options, plan, document, i)
+
+    process_text(options, plan, document, chunk)
+    yield 'combine', measure(lambda: combine_document(options, document, ConversionMetrics()), repeat)
+
+
+def convert(src: pathlib.Path, pool_size: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_root = pathlib.Path(tmp_dir)
+        workdir = initialize_workdir(src, tmp_root / src.with_suffix('.pdf').name, tmp_root)
+        options = make_benchmark_options(workdir, pool_size)
+
+        with SubprocessDocumentProcessor(pool_size, verbose=False) as processor:
+            finish_conversion(processor, start_conversion(processor, options), preserve_working=False)
+
+
+def run_benchmarks(fixtures: pathlib.Path, pool_sizes: Iterable[int], repeat: int) -> BenchmarkResults:
+    results = {}
+
+    for src in iter_benchmark_fixtures(fixtures):
+        click.echo(f'Benchmarking {src.name}.', err=True)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, timings in benchmark_document(src, pathlib.Path(tmp_dir), repeat):
+                results[f'{src.name}/{name}'] = timings
+
+        for pool_size in pool_sizes:
+            # The end-to-end conversion includes starting the pool
+            results[f'{src.name}/convert/pool_{pool_size}'] = measure(functools.partial(convert, src, pool_size), repeat)
+
+    return results
+
+
+def compare_with_baseline(results: BenchmarkResults, baseline: Mapping[str, Mapping[str, float]], tolerance: float) -> list[str]:
+    """Print a comparison of the median timings and return the names of the benchmarks that have regressed."""
+    regressions = []
+
+    for name, timings in results.items():
+        if name not in baseline:
+            click.echo(f'{name:<48} {timings["median"]:>9.4f}s (new)')
+            continue
+
+        ratio = timings['median'] / baseline[name]['median']
+        click.echo(f'{name:<48} {timings["median"]:>9.4f}s {ratio:>7.2f}x')
+
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+
+    return regressions
+
+
+@click.command()
+@click.option('-f', '--fixtures', type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path), default=FIXTURES, help='The directory with the DjVu documents to benchmark. Defaults to the fixtures of the test suite.')
+@click.option('-o', '--output', type=click.Path(dir_okay=False, path_type=pathlib.Path), default=None, help='Write the results to the given JSON file, e.g. in order to use them as a baseline later.')
+@click.option('-b', '--baseline', type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path), default=None, help='Compare the results with a JSON file written previously via --output.')
+@click.option('-t', '--tolerance', type=click.FloatRange(min=0), default=DEFAULT_TOLERANCE, help='The relative slowdown above which a benchmark counts as a regression.')
+@click.option('-r', '--repeat', type=click.IntRange(min=1), default=DEFAULT_REPEAT, help='How many times to run every benchmark.')
+@click.option('-p', '--pool-size', 'pool_sizes', type=click.IntRange(min=1), multiple=True, default=DEFAULT_POOL_SIZES, help='The pool sizes for the end-to-end conversion. Can be passed multiple times.')
+def benchmark(fixtures: pathlib.Path, output: pathlib.Path | None, baseline: pathlib.Path | None, tolerance: float, repeat: int, pool_sizes: tuple[int, ...]) -> None:
+    """Time the stages of the conversion on the fixture documents.
+
+    The process exits with a non-zero status if any of the median timings has regressed compared to the baseline.
+    """
+    logging.getLogger('dpsprep').setLevel(logging.WARNING)
+    results = run_benchmarks(fixtures, pool_sizes, repeat)
+
+    if output is not None:
+        output.write_text(
+            json.dumps({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, indent=2),
+            encoding='utf-8',
+        )
+
+    if baseline is None:
+        for name, timings in results.items():
+            click.echo(f'{name:<48} {timings["median"]:>9.4f}s')
+        return
+
+    regressions = compare_with_baseline(results, json.loads(baseline.read_text(encoding='utf-8'))['results'], tolerance)
+
+    if regressions:
+        raise click.ClickException(f'{len(regressions)} benchmark(s) have regressed by more than {tolerance:.0%}: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    benchmark()
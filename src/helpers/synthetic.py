@@ -0,0 +1,224 @@
+# Generate large synthetic DjVu documents for load testing.
+#
+# The pages are drawn via Pillow and encoded via the djvulibre command-line tools (cjb2 for bitonal pages and c44 for
+# grayscale and color pages), which must be installed. The pages are then bundled via djvm, and the text layer and
+# outline are added via djvused.
+#
+# The script does not import dpsprep, so it can be run directly, e.g. from fixtures/Makefile.
+
+import os
+import pathlib
+import random
+import subprocess
+import tempfile
+from collections.abc import Iterable, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import click
+from PIL import Image, ImageDraw, ImageFont
+
+
+# US letter
+PAGE_SIZE_INCHES = (8.5, 11)
+MARGIN_INCHES = 1
+FONT_SIZE_POINTS = 11
+LINE_SPACING = 1.5
+
+# How many entries every level of the outline has (at most)
+OUTLINE_BRANCHING = 8
+
+PAGE_KINDS = ('bitonal', 'gray', 'color')
+VOCABULARY = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+    'magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat '
+    'duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur excepteur sint occaecat '
+    'cupidatat non proident sunt culpa qui officia deserunt mollit anim id est laborum'
+).split()
+
+
+class SyntheticWord(NamedTuple):
+    text: str
+    # DjVu coordinates, i.e. with the origin at the bottom left
+    xmin: int
+    ymin: int
+    xmax: int
+    ymax: int
+
+
+class SyntheticPage(NamedTuple):
+    number: int
+    kind: str
+    width: int
+    height: int
+    words: Sequence[SyntheticWord]
+
+
+def parse_page_mix(value: str) -> dict[str, int]:
+    """Parse weights like "bitonal=8,gray=1,color=1"."""
+    mix = {}
+
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+
+        if kind not in PAGE_KINDS or not weight.isdigit():
+            raise click.BadParameter(f'Expected comma-separated weights for {", ".join(PAGE_KINDS)}, got {item!r}.')
+
+        mix[kind] = int(weight)
+
+    if sum(mix.values()) == 0:
+        raise click.BadParameter('At least one weight must be positive.')
+
+    return mix
+
+
+def create_background(kind: str, width: int, height: int, rng: random.Random) -> Image.Image:
+    if kind == 'bitonal':
+        return Image.new('1', (width, height), 1)
+
+    # A gradient with some noise resembles a scanned page and does not compress trivially
+    gradient = Image.linear_gradient('L').resize((width, height)).point(lambda value: 160 + value // 3)
+    noise = Image.effect_noise((width, height), 24)
+    gray = Image.blend(gradient, noise.point(lambda value: 160 + value // 3), 0.25)
+
+    if kind == 'gray':
+        return gray
+
+    tint = Image.new('RGB', (width, height), (rng.randrange(160, 256), rng.randrange(160, 256), rng.randrange(160, 256)))
+    return Image.blend(Image.merge('RGB', (gray, gray, gray)), tint, 0.5)
+
+
+def draw_page(number: int, kind: str, dpi: int, words_per_page: int, seed: int) -> tuple[Image.Image, SyntheticPage]:
+    rng = random.Random(f'{seed}-{number}')
+    width = round(PAGE_SIZE_INCHES[0] * dpi)
+    height = round(PAGE_SIZE_INCHES[1] * dpi)
+    margin = MARGIN_INCHES * dpi
+    font = ImageFont.load_default(size=FONT_SIZE_POINTS * dpi / 72)
+    line_height = round(LINE_SPACING * FONT_SIZE_POINTS * dpi / 72)
+
+    image = create_background(kind, width, height, rng)
+    draw = ImageDraw.Draw(image)
+    words = []
+    x: float = margin
+    y = margin
+
+    draw.text((x, y), f'Page {number}', fill=0, font=font)
+    y += 2 * line_height
+
+    for _ in range(words_per_page):
+        text = rng.choice(VOCABULARY)
+        left, top, right, bottom = draw.textbbox((x, y), text, font=font)
+
+        if right > width - margin:
+            x = margin
+            y += line_height
+            left, top, right, bottom = draw.textbbox((x, y), text, font=font)
+
+        # The page is full
+        if bottom > height - margin:
+            break
+
+        draw.text((x, y), text, fill=0, font=font)
+        words.append(SyntheticWord(text, round(left), height - round(bottom), round(right), height - round(top)))
+        x = right + font.getlength(' ')
+
+    return image, SyntheticPage(number, kind, width, height, words)
+
+
+def encode_page(image: Image.Image, kind: str, dpi: int, path: pathlib.Path) -> None:
+    # Pillow chooses the PBM, PGM or PPM format based on the image mode
+    image_path = path.with_suffix('.pnm')
+    image.save(image_path, format='PPM')
+    subprocess.run(['cjb2' if kind == 'bitonal' else 'c44', '-dpi', str(dpi), image_path, path], check=True)
+
+
+def escape_sexpr_string(text: str) -> str:
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def get_text_sexpr(page: SyntheticPage) -> str:
+    words = ' '.join(f'(word {word.xmin} {word.ymin} {word.xmax} {word.ymax} {escape_sexpr_string(word.text)})' for word in page.words)
+    return f'(page 0 0 {page.width} {page.height} {words})'
+
+
+def iter_outline_sexprs(first_page: int, last_page: int, depth: int, prefix: str) -> Iterable[str]:
+    """Split the page range into up to OUTLINE_BRANCHING sections, which are themselves split up to the given depth."""
+    page_count = last_page - first_page + 1
+    section_size = -(-page_count // OUTLINE_BRANCHING)
+
+    for k, start in enumerate(range(first_page, last_page + 1, section_size), start=1):
+        end = min(start + section_size - 1, last_page)
+        title = f'{prefix}{k}'
+        children = ' '.join(iter_outline_sexprs(start, end, depth - 1, f'{title}.')) if depth > 1 and end > start else ''
+        yield f'({escape_sexpr_string(f"Section {title}")} "#{start}" {children})'
+
+
+def get_djvused_script(pages: Sequence[SyntheticPage], outline_depth: int) -> str:
+    lines = []
+
+    for page in pages:
+        if page.words:
+            lines.extend([f'select {page.number}', 'set-txt', get_text_sexpr(page), '.'])
+
+    if outline_depth > 0:
+        lines.extend(['select', 'set-outline', f'(bookmarks {" ".join(iter_outline_sexprs(1, len(pages), outline_depth, ""))})', '.'])
+
+    return '\n'.join(lines) + '\n'
+
+
+def generate_document(
+    dest: pathlib.Path,
+    *,
+    page_count: int,
+    dpi: int,
+    mix: Mapping[str, int],
+    words_per_page: int,
+    outline_depth: int,
+    seed: int,
+) -> None:
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix.keys()), weights=list(mix.values()), k=page_count)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+        page_paths = [tmp_path / f'page_{number:05}.djvu' for number in range(1, page_count + 1)]
+
+        def generate_page(number: int) -> SyntheticPage:
+            image, page = draw_page(number, kinds[number - 1], dpi, words_per_page, seed)
+            encode_page(image, page.kind, dpi, page_paths[number - 1])
+            return page
+
+        # Most of the time is spent in the encoders, which run in separate processes
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pages = list(executor.map(generate_page, range(1, page_count + 1)))
+
+        subprocess.run(['djvm', '-c', dest, *page_paths], check=True)
+
+        script_path = tmp_path / 'script.djvused'
+        script_path.write_text(get_djvused_script(pages, outline_depth), encoding='utf-8')
+        subprocess.run(['djvused', dest, '-f', script_path, '-s'], check=True)
+
+
+@click.command()
+@click.option('-n', '--pages', 'page_count', type=click.IntRange(min=1), default=1000, help='The number of pages.')
+@click.option('--dpi', type=click.IntRange(min=25), default=300, help='The resolution of the pages.')
+@click.option('--mix', type=parse_page_mix, default='bitonal=8,gray=1,color=1', help='The relative frequencies of bitonal, gray and color pages.')
+@click.option('--words', 'words_per_page', type=click.IntRange(min=0), default=300, help='The (maximal) number of words in the text layer of every page.')
+@click.option('--outline-depth', type=click.IntRange(min=0), default=2, help=f'The depth of the outline, every level of which has up to {OUTLINE_BRANCHING} entries.')
+@click.option('--seed', type=int, default=0, help='The seed for the random choices, which makes the documents reproducible.')
+@click.argument('dest', type=click.Path(dir_okay=False, path_type=pathlib.Path))
+def synthetic(dest: pathlib.Path, page_count: int, dpi: int, mix: Mapping[str, int], words_per_page: int, outline_depth: int, seed: int) -> None:
+    """Generate a synthetic DjVu document at DEST."""
+    generate_document(
+        dest,
+        page_count=page_count,
+        dpi=dpi,
+        mix=mix,
+        words_per_page=words_per_page,
+        outline_depth=outline_depth,
+        seed=seed,
+    )
+
+
+if __name__ == '__main__':
+    synthetic()